@@ -11,11 +11,19 @@ from logging_utils import setup_logging
 setup_logging("output_Axial_rsfMRI__Eyes_Open_dicom_to_nifti_parallel.log")
 
 NUM_CORES = 30
+TIMEOUT = 3600 # seconds per series
+RETRIES = 1
+
+# Cohort (R/ADNIMERGE/construct_cohort.R); its series are read in place from the full DICOM tree
+COHORT = "/root/Project/ADNI/result/ptid_date_list.csv"
 
 # fMRI (Axial rsfMRI (Eyes Open))
 convert_dicom_to_nifti_parallel(
-    dicom_dir="/root/data/ADNI/Axial_rsfMRI__Eyes_Open_/dicom",
+    dicom_dir="/root/data/ADNI/fMRI/dicom",
     nifti_dir="/root/data/ADNI/Axial_rsfMRI__Eyes_Open_/nifti",
     measurement_type_sequences=["Axial_rsfMRI__Eyes_Open_"],
-    num_workers=NUM_CORES
+    num_workers=NUM_CORES,
+    timeout=TIMEOUT,
+    retries=RETRIES,
+    cohort=COHORT
 )
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import sys
+sys.path.append("/root/Project/ADNI/Python")
+
+from pipeline_fMRI_streaming import fmri_convert_and_preprocess_streaming
+
+from logging_utils import setup_logging
+
+setup_logging("output_Axial_rsfMRI__Eyes_Open_pipeline_fMRI_streaming.log")
+
+# Replaces running Axial_rsfMRI__Eyes_Open_dicom_to_nifti_parallel.py and then
+# Axial_rsfMRI__Eyes_Open_preprocessing_fMRI_parallel.py as two jobs: each
+# series is preprocessed as soon as it is converted.
+
+CONVERSION_WORKERS = 8 # concurrent dcm2niix processes (I/O bound)
+THREADS_PER_WORKER = 2 # preprocessing workers = allocated cores // THREADS_PER_WORKER
+CONVERSION_TIMEOUT = 3600 # seconds per series
+TIMEOUT = 43200 # seconds per file
+RETRIES = 1
+
+# Cohort (R/ADNIMERGE/construct_cohort.R); its series are read in place from the full DICOM tree
+COHORT = "/root/Project/ADNI/result/ptid_date_list.csv"
+
+# fMRI (Axial rsfMRI (Eyes Open))
+fmri_convert_and_preprocess_streaming(
+    dicom_dir="/root/data/ADNI/fMRI/dicom",
+    nifti_dir="/root/data/ADNI/Axial_rsfMRI__Eyes_Open_/nifti",
+    measurement_type_sequences=["Axial_rsfMRI__Eyes_Open_"],
+    ref_template="/usr/lib/fsl/5.0/data/standard/MNI152_T1_2mm_brain.nii.gz",
+    conversion_workers=CONVERSION_WORKERS,
+    threads_per_worker=THREADS_PER_WORKER,
+    conversion_timeout=CONVERSION_TIMEOUT,
+    conversion_retries=RETRIES,
+    timeout=TIMEOUT,
+    retries=RETRIES,
+    cohort=COHORT
+)
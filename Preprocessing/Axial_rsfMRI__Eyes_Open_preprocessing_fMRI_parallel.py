@@ -10,12 +10,20 @@ from logging_utils import setup_logging
 
 setup_logging("output_Axial_rsfMRI__Eyes_Open_preprocessing_fMRI_parallel.log")
 
-NUM_CORES = 10
+THREADS_PER_WORKER = 2 # workers = allocated cores // THREADS_PER_WORKER
+TIMEOUT = 43200 # seconds per file
+RETRIES = 1
+
+# Cohort (R/ADNIMERGE/construct_cohort.R)
+COHORT = "/root/Project/ADNI/result/ptid_date_list.csv"
 
 # fMRI (Axial rsfMRI (Eyes Open))
 fmri_preprocess_all_subjects_parallel(
     base_dir="/root/data/ADNI/Axial_rsfMRI__Eyes_Open_/nifti/",
     measurement_type="Axial_rsfMRI__Eyes_Open_",
     ref_template="/usr/lib/fsl/5.0/data/standard/MNI152_T1_2mm_brain.nii.gz",
-    num_workers=NUM_CORES
+    threads_per_worker=THREADS_PER_WORKER,
+    timeout=TIMEOUT,
+    retries=RETRIES,
+    cohort=COHORT
 )
@@ -0,0 +1,53 @@
+
+# -*- coding: utf-8 -*-
+
+# Re-apply a saved registration (see transform_utils "Transform store") to new images.
+#
+# python3 apply_saved_transforms.py <output_dir> --input gm_new.nii.gz --output gm_new_mni.nii.gz
+# python3 apply_saved_transforms.py <output_dir> --inverse --interp nearestNeighbor --input ROI_MNI_V4.nii --output aal_native.nii.gz
+
+import argparse
+
+from logging_utils import log_print
+from transform_utils import load_transform_index, reapply_transforms, transform_index_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Warp images with transforms saved by the preprocessing pipelines, without registering again.")
+    parser.add_argument("output_dir", help="Preprocessed output directory of one file (holding transforms/transforms.json)")
+    parser.add_argument("--name", default="mni", help="Saved transform entry (default: mni)")
+    parser.add_argument("--input", nargs="+", default=[], help="Images to warp")
+    parser.add_argument("--output", nargs="+", default=[], help="Output paths, one per input")
+    parser.add_argument("--interp", nargs="+", default=["linear"], help="Interpolator (ANTs names), one for all inputs or one per input")
+    parser.add_argument("--inverse", action="store_true", help="Template -> subject space instead of subject -> template")
+    parser.add_argument("--threads", type=int, default=1, help="Images warped concurrently")
+    parser.add_argument("--list", action="store_true", help="List the saved entries and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, entry in load_transform_index(args.output_dir).items():
+            log_print(f"{name}: {entry['tool']} {entry['moving']} -> {entry['fixed']} (saved {entry['saved']})")
+        return
+
+    if not args.input or len(args.input) != len(args.output):
+        parser.error("--input and --output need the same (nonzero) number of paths")
+    if len(args.interp) not in (1, len(args.input)):
+        parser.error("--interp takes one interpolator or one per input")
+
+    interpolators = args.interp * len(args.input) if len(args.interp) == 1 else args.interp
+
+    log_print(f"Applying '{args.name}' from {transform_index_path(args.output_dir)} ({'inverse' if args.inverse else 'forward'}) to {len(args.input)} images")
+
+    reapply_transforms(
+        args.output_dir,
+        args.name,
+        list(zip(args.input, interpolators)),
+        args.output,
+        inverse=args.inverse,
+        num_threads=args.threads
+    )
+
+    for out_path in args.output:
+        log_print(f"Saved: {out_path}")
+
+if __name__ == "__main__":
+    main()
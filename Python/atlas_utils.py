@@ -0,0 +1,282 @@
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import sparse
+from nilearn.image import resample_to_img
+
+from nifti_utils import iter_volumes
+
+AAL_ATLAS_PATH = "/root/Project/ADNI/atlas/aal_for_SPM12/ROI_MNI_V4.nii"
+AAL_LABEL_PATH = "/root/Project/ADNI/atlas/aal_for_SPM12/ROI_MNI_V4.txt"
+
+def load_aal_labels(label_path=AAL_LABEL_PATH):
+    """ROI index -> ROI name from ROI_MNI_V4.txt (lines of: code, name, index)."""
+    roi_labels_dict = {}
+    with open(label_path) as f:
+        for line in f:
+            parts = line.strip().split('\t')
+            if len(parts) == 3:
+                _, name, idx = parts
+                roi_labels_dict[int(idx)] = name.strip()
+
+    return roi_labels_dict
+
+def load_atlas_on_grid(atlas_path, target_img):
+    """
+    Atlas label volume (int) on the grid of target_img.
+
+    The atlas is resampled with nearest-neighbour interpolation only when its
+    grid differs from the target, as NiftiLabelsMasker does.
+    """
+    atlas_img = nib.load(atlas_path)
+    target_img = nib.load(target_img) if isinstance(target_img, str) else target_img
+
+    if atlas_img.shape[:3] != target_img.shape[:3] or not np.allclose(atlas_img.affine, target_img.affine):
+        atlas_img = resample_to_img(atlas_img, target_img, interpolation="nearest", force_resample=True, copy_header=True)
+
+    return np.rint(np.asanyarray(atlas_img.dataobj)).astype(np.int32)
+
+def _atlas_groups(atlas):
+    """
+    (labels, voxel_roi, counts) of a label volume or an atlas index (see build_atlas_index).
+
+    labels are the sorted nonzero labels, voxel_roi the position of each
+    voxel's label in labels (same shape as the atlas, len(labels) for
+    background) and counts the voxels of each label. A label volume takes
+    one np.unique; an atlas index only a scatter of its grouped voxel lists.
+    """
+    if isinstance(atlas, dict):
+        labels, counts = atlas["label_values"], atlas["counts"]
+
+        # Positions in voxel_order of every ROI's voxels, ROI after ROI
+        group_offsets = atlas["starts"] - (np.cumsum(counts) - counts)
+        positions = np.repeat(group_offsets, counts) + np.arange(counts.sum())
+
+        voxel_roi = np.full(atlas["labels"].size, len(labels), dtype=np.intp)
+        voxel_roi[atlas["voxel_order"][positions]] = np.repeat(np.arange(len(labels)), counts)
+        return labels, voxel_roi.reshape(atlas["labels"].shape), counts
+
+    atlas = np.asarray(atlas)
+    values, inverse = np.unique(atlas, return_inverse=True)
+    is_roi = values != 0
+    position = np.where(is_roi, np.cumsum(is_roi) - 1, int(is_roi.sum()))
+    counts = np.bincount(inverse.ravel(), minlength=len(values))[is_roi]
+    return values[is_roi], position[inverse].reshape(atlas.shape), counts
+
+def _roi_names(atlas, labels, roi_labels_dict):
+    if roi_labels_dict is None and isinstance(atlas, dict):
+        return list(atlas["names"])
+    roi_labels_dict = roi_labels_dict or {}
+    return [roi_labels_dict.get(int(label), f"ROI_{int(label)}") for label in labels]
+
+def masked_roi_timeseries(masked, atlas, roi_labels_dict=None):
+    """
+    Mean time series of each atlas ROI from a masked run (see masked_utils).
+
+    Matches NiftiLabelsMasker(labels_img=atlas) applied to the run expanded
+    back to NIfTI: each ROI mean is the sum over its in-mask voxels divided
+    by the ROI's total voxel count (out-of-mask voxels count as zeros).
+
+    Args:
+    - masked (dict): Masked run.
+    - atlas (np.ndarray or dict): Integer labels on the mask's grid, or an
+      atlas index of that grid (see build_atlas_index, reference_utils.get_atlas_index).
+    - roi_labels_dict (dict): ROI index -> name (default: the index's names).
+
+    Returns a DataFrame (T x ROIs) with ROI names as columns, in label order.
+    """
+    labels, voxel_roi, counts = _atlas_groups(atlas)
+
+    mask_roi = voxel_roi[masked["mask"]]
+    in_roi = mask_roi < len(labels)
+    weights = sparse.csr_matrix(
+        (1.0 / counts[mask_roi[in_roi]], (np.flatnonzero(in_roi), mask_roi[in_roi])),
+        shape=(masked["data"].shape[1], len(labels))
+    )
+    roi_data = np.asarray((weights.T @ masked["data"].T).T)
+
+    return pd.DataFrame(roi_data, columns=_roi_names(atlas, labels, roi_labels_dict))
+
+def roi_timeseries_from_nifti(nifti_path, atlas, roi_labels_dict=None, mask=None, labels=None):
+    """
+    Mean time series of each atlas ROI, streamed from a 4D NIfTI on the atlas grid.
+
+    Meant for native-space extraction: the atlas is warped to the run's grid
+    (e.g. with the inverse registration), so the run itself is never
+    resampled. Each ROI mean is taken over its voxels inside mask (all
+    voxels without one); one volume is in memory at a time.
+
+    Args:
+    - nifti_path (str): 4D run.
+    - atlas (np.ndarray or dict): Integer labels on the run's grid, or an atlas index of that grid.
+    - roi_labels_dict (dict): ROI index -> name, for the column names.
+    - mask (np.ndarray): Optional brain mask (bool) on the run's grid.
+    - labels (array): ROI labels to report (default: those present); ROIs
+      with no voxel on the grid get NaN columns.
+
+    Returns a DataFrame (T x ROIs) with ROI names as columns, in label order.
+    """
+    atlas_labels, voxel_roi, _ = _atlas_groups(atlas)
+    labels = atlas_labels if labels is None else np.asarray(sorted(set(labels) - {0}))
+
+    # Column of each atlas label among the reported labels (len(labels) if not reported)
+    column = np.searchsorted(labels, atlas_labels)
+    reported = column < len(labels)
+    reported[reported] = labels[column[reported]] == atlas_labels[reported]
+    column = np.append(np.where(reported, column, len(labels)), len(labels))
+
+    voxel_column = column[voxel_roi]
+    selected = voxel_column < len(labels)
+    if mask is not None:
+        selected &= mask
+    voxel_column = voxel_column[selected]
+    counts = np.bincount(voxel_column, minlength=len(labels)).astype(np.float64)
+
+    rows = []
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for vol in iter_volumes(nifti_path):
+            rows.append(np.bincount(voxel_column, weights=vol[selected], minlength=len(labels)) / counts)
+
+    roi_labels_dict = roi_labels_dict if roi_labels_dict is not None else dict(zip(atlas_labels.tolist(), _roi_names(atlas, atlas_labels, None)))
+    columns = [roi_labels_dict.get(int(label), f"ROI_{int(label)}") for label in labels]
+    return pd.DataFrame(np.array(rows), columns=columns)
+
+def roi_statistics(atlas, maps, voxel_volume, roi_labels_dict=None):
+    """
+    Per-ROI statistics of several maps on the atlas grid, label-indexed.
+
+    The atlas is indexed once (or an atlas index is passed in), then every
+    statistic of every map is a bincount over that index, instead of one
+    full-volume boolean mask per ROI and map.
+
+    Args:
+    - atlas (np.ndarray or dict): Integer labels (0 = background), or an atlas index of the grid.
+    - maps (dict): Map name -> 3D array on the atlas grid (e.g. an intensity
+      image and the GM/WM/CSF PVE maps).
+    - voxel_volume (float): Voxel volume in mm^3.
+    - roi_labels_dict (dict): ROI index -> name (see load_aal_labels; default: the index's names).
+
+    Returns a tidy DataFrame, one row per ROI and map: roi_index, roi_name,
+    map, voxel_count, volume_mm3, sum, mean, std and weighted_volume_mm3
+    (sum x voxel volume, i.e. the tissue volume for a PVE map).
+    """
+    labels, voxel_roi, counts = _atlas_groups(atlas)
+    roi_names = _roi_names(atlas, labels, roi_labels_dict)
+    counts = counts.astype(np.float64)
+    voxel_roi = voxel_roi.ravel()
+
+    tables = []
+    for map_name, data in maps.items():
+        values = np.asarray(data, dtype=np.float64).ravel()
+        if values.size != voxel_roi.size:
+            raise ValueError(f"{map_name}: shape {np.shape(data)} does not match the atlas grid")
+
+        # Background voxels fall in the extra last bin
+        sums = np.bincount(voxel_roi, weights=values, minlength=len(labels) + 1)[:-1]
+        means = sums / counts
+        # Centered second pass (no E[x^2] - E[x]^2 cancellation)
+        deviations = values - np.append(means, 0.0)[voxel_roi]
+        variances = np.bincount(voxel_roi, weights=deviations ** 2, minlength=len(labels) + 1)[:-1] / counts
+
+        tables.append(pd.DataFrame({
+            "roi_index": labels.astype(int),
+            "roi_name": roi_names,
+            "map": map_name,
+            "voxel_count": counts.astype(int),
+            "volume_mm3": counts * voxel_volume,
+            "sum": sums,
+            "mean": means,
+            "std": np.sqrt(variances),
+            "weighted_volume_mm3": sums * voxel_volume
+        }))
+
+    return pd.concat(tables, ignore_index=True)
+
+# ==========================================
+# Atlas index
+# ==========================================
+# An atlas index is a dict built once per atlas (see build_atlas_index):
+# - labels: int16 label volume
+# - affine: voxel-to-world (mm) affine
+# - label_values: sorted nonzero labels
+# - voxel_order / starts: flat voxel indices grouped by label; the voxels of
+#   label_values[i] are voxel_order[starts[i]:starts[i] + counts[i]]
+# - counts: voxels per label
+# - centroids_vox / centroids_mm: (L x 3) centroid of each label
+# - names: ROI names, aligned with label_values
+# masked_roi_timeseries, roi_timeseries_from_nifti and roi_statistics take
+# an index in place of a label volume (no np.unique per call); build it on
+# the data's grid, e.g. with reference_utils.get_atlas_index(target_img=...).
+
+def build_atlas_index(atlas_img, roi_labels_dict=None):
+    """
+    Atlas index (see above) of a label image (path or nibabel image).
+
+    The label volume is read once, stored as int16, and grouped by label
+    with a single argsort, so per-ROI voxel lists, counts and centroids need
+    no per-ROI pass over the volume.
+    """
+    atlas_img = nib.load(atlas_img) if isinstance(atlas_img, str) else atlas_img
+    labels = np.rint(np.asanyarray(atlas_img.dataobj)).astype(np.int16)
+
+    flat = labels.ravel(order="C")
+    voxel_order = np.argsort(flat, kind="stable")
+    label_values, first, counts = np.unique(flat[voxel_order], return_index=True, return_counts=True)
+
+    # Centroids from the grouped voxel coordinates (one reduceat over all groups)
+    coords = np.column_stack(np.unravel_index(voxel_order, labels.shape))
+    centroids_vox = np.add.reduceat(coords, first, axis=0) / counts[:, None]
+
+    keep = label_values != 0
+    label_values, first, counts, centroids_vox = label_values[keep], first[keep], counts[keep], centroids_vox[keep]
+    centroids_mm = nib.affines.apply_affine(atlas_img.affine, centroids_vox)
+
+    roi_labels_dict = roi_labels_dict or {}
+    return {
+        "labels": labels,
+        "affine": atlas_img.affine,
+        "label_values": label_values,
+        "voxel_order": voxel_order,
+        "starts": first,
+        "counts": counts,
+        "centroids_vox": centroids_vox,
+        "centroids_mm": centroids_mm,
+        "names": [roi_labels_dict.get(int(label), f"ROI_{int(label)}") for label in label_values]
+    }
+
+def roi_voxels(atlas_index, label):
+    """Flat (C order) voxel indices of one label; np.unravel_index gives (x, y, z)."""
+    i = np.searchsorted(atlas_index["label_values"], label)
+    if i == len(atlas_index["label_values"]) or atlas_index["label_values"][i] != label:
+        return np.zeros(0, dtype=np.int64)
+    start = atlas_index["starts"][i]
+    return atlas_index["voxel_order"][start:start + atlas_index["counts"][i]]
+
+def lookup_voxels(atlas_index, coords):
+    """
+    Labels at voxel coordinates (N x 3 ints, or a single (x, y, z)).
+
+    Coordinates outside the grid get label -1.
+    """
+    coords = np.atleast_2d(np.asarray(coords)).astype(np.int64)
+    shape = np.array(atlas_index["labels"].shape)
+
+    inside = np.all((coords >= 0) & (coords < shape), axis=1)
+    result = np.full(len(coords), -1, dtype=np.int16)
+    result[inside] = atlas_index["labels"][tuple(coords[inside].T)]
+    return result
+
+def lookup_mm(atlas_index, coords_mm):
+    """Labels at world (e.g. MNI mm) coordinates (N x 3), nearest voxel; -1 outside the grid."""
+    coords_mm = np.atleast_2d(np.asarray(coords_mm, dtype=np.float64))
+    voxels = nib.affines.apply_affine(np.linalg.inv(atlas_index["affine"]), coords_mm)
+    return lookup_voxels(atlas_index, np.rint(voxels))
+
+def label_names(atlas_index, labels, background="background"):
+    """ROI names of label values (background for 0, None for unknown or outside)."""
+    names = dict(zip(atlas_index["label_values"].tolist(), atlas_index["names"]))
+    names[0] = background
+    return [names.get(int(label)) for label in np.atleast_1d(labels)]
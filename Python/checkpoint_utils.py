@@ -0,0 +1,119 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import datetime
+
+CHECKPOINT_DIRNAME = ".checkpoints"
+
+def file_sha256(path, chunk_size=1 << 20):
+    """SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_fingerprint(path):
+    """Size, mtime and content hash of a file."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_sha256(path)}
+
+def fingerprint_matches(path, fingerprint):
+    """
+    Check a file against a stored fingerprint.
+
+    The content hash is only recomputed when size or mtime changed, so
+    checking an untouched file costs a single stat call.
+    """
+    if not os.path.exists(path):
+        return False
+
+    stat = os.stat(path)
+    if stat.st_size != fingerprint["size"]:
+        return False
+    if stat.st_mtime_ns == fingerprint["mtime_ns"]:
+        return True
+
+    return file_sha256(path) == fingerprint["sha256"]
+
+def fsl_version():
+    """FSL version string from $FSLDIR/etc/fslversion (or None)."""
+    fsldir = os.environ.get("FSLDIR", "")
+    version_file = os.path.join(fsldir, "etc", "fslversion")
+
+    if fsldir and os.path.exists(version_file):
+        with open(version_file) as f:
+            return f.read().strip()
+
+    return None
+
+def _checkpoint_path(output_dir, step_name):
+    return os.path.join(output_dir, CHECKPOINT_DIRNAME, f"{step_name}.json")
+
+def _relative(output_dir, path):
+    return os.path.relpath(path, output_dir)
+
+def step_is_done(output_dir, step_name, inputs, outputs, params=None, tool_version=None):
+    """
+    Return True if a completion marker for this step exists and is still valid.
+
+    Args:
+    - output_dir (str): preprocessed/<file_id>/ folder holding the markers.
+    - step_name (str): Unique name of the step (e.g. "step1_n4").
+    - inputs (list): Files the step reads.
+    - outputs (list): Files the step writes.
+    - params (dict): Parameters that change the step's result.
+    - tool_version (dict or str): Versions of the tools used by the step.
+
+    A step is invalidated when its marker is missing, its parameters or tool
+    version changed, an input changed, or an output is missing or modified.
+    Because each step's outputs are the next step's inputs, recomputing one
+    step invalidates every step downstream of it.
+    """
+    marker_path = _checkpoint_path(output_dir, step_name)
+
+    if not os.path.exists(marker_path):
+        return False
+
+    try:
+        with open(marker_path) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if marker.get("params") != (params or {}) or marker.get("tool_version") != tool_version:
+        return False
+
+    recorded_inputs = marker.get("inputs", {})
+    recorded_outputs = marker.get("outputs", {})
+
+    for group, recorded in ((inputs, recorded_inputs), (outputs, recorded_outputs)):
+        if sorted(_relative(output_dir, p) for p in group) != sorted(recorded):
+            return False
+        for path in group:
+            if not fingerprint_matches(path, recorded[_relative(output_dir, path)]):
+                return False
+
+    return True
+
+def mark_step_done(output_dir, step_name, inputs, outputs, params=None, tool_version=None):
+    """Write the completion marker of a step (see step_is_done)."""
+    marker = {
+        "step": step_name,
+        "params": params or {},
+        "tool_version": tool_version,
+        "inputs": {_relative(output_dir, p): file_fingerprint(p) for p in inputs},
+        "outputs": {_relative(output_dir, p): file_fingerprint(p) for p in outputs},
+        "completed_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+    marker_path = _checkpoint_path(output_dir, step_name)
+    os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+
+    tmp_path = marker_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(marker, f, indent=2)
+    os.replace(tmp_path, marker_path)
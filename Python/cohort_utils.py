@@ -0,0 +1,112 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import pandas as pd
+
+from logging_utils import log_print
+
+# ==========================================
+# Cohort manifest
+# ==========================================
+# A cohort manifest is a CSV with one row per wanted scan: a PTID column and
+# a scan date column (e.g. fmri_date / DATE written by
+# R/ADNIMERGE/construct_cohort.R, YYYY-MM-DD) and/or an image ID column
+# (image_id, e.g. I10910954). A row selects the series / files of that
+# subject whose scan date folder starts with the date and whose image ID
+# matches (each only if given), so the original DICOM / NIfTI trees can be
+# processed in place instead of copying the cohort out first.
+
+PTID_COLUMNS = ("PTID", "subject_id")
+IMAGE_ID_COLUMNS = ("image_id", "imageid", "image_uid")
+
+def parse_file_id(file_id):
+    """
+    Scan date and image ID of a NIfTI file ID.
+
+    e.g. "2024-08-08_12_03_24.0_I10910954" -> ("2024-08-08", "I10910954")
+    """
+    parts = file_id.split("_")
+    image_id = parts[-1] if parts[-1].startswith("I") else None
+    return parts[0], image_id
+
+def _find_column(columns, candidates):
+    lower = {c.lower(): c for c in columns}
+    for candidate in candidates:
+        if candidate.lower() in lower:
+            return lower[candidate.lower()]
+    return None
+
+def load_cohort_manifest(cohort):
+    """
+    Read a cohort manifest (path or DataFrame) into {PTID: [(date, image_id), ...]}.
+
+    date is "YYYY-MM-DD" (or None) and image_id a string (or None). The date
+    column is the first column whose name contains "date".
+    """
+    df = pd.read_csv(cohort, dtype=str) if isinstance(cohort, str) else cohort.astype(str).where(cohort.notna(), None)
+
+    ptid_column = _find_column(df.columns, PTID_COLUMNS)
+    date_column = next((c for c in df.columns if "date" in c.lower()), None)
+    image_column = _find_column(df.columns, IMAGE_ID_COLUMNS)
+
+    if ptid_column is None or (date_column is None and image_column is None):
+        raise ValueError(f"Cohort manifest needs a PTID column and a date and/or image ID column, got {list(df.columns)}")
+
+    manifest = {}
+    for row in df.to_dict("records"):
+        date = row.get(date_column) if date_column else None
+        image_id = row.get(image_column) if image_column else None
+        date = str(pd.Timestamp(date).date()) if isinstance(date, str) and date.strip() else None
+        image_id = image_id.strip() if isinstance(image_id, str) and image_id.strip() else None
+        manifest.setdefault(row[ptid_column].strip(), []).append((date, image_id))
+
+    return manifest
+
+def cohort_subjects(manifest):
+    """Sorted PTIDs of a cohort manifest."""
+    return sorted(manifest)
+
+def cohort_row_matches(row, file_id):
+    """True if a (date, image_id) manifest row selects a scan with this file ID (<scan_date>_<image_id>)."""
+    date, image_id = row
+    scan_date, file_image_id = parse_file_id(file_id)
+    return (date is None or scan_date == date) and (image_id is None or file_image_id == image_id)
+
+def filter_by_cohort(items, manifest, key, label="items"):
+    """
+    Keep the items selected by a cohort manifest.
+
+    Args:
+    - items (list): Anything identifying a scan, e.g. DICOM series tuples or (subject_id, nifti_path).
+    - manifest (dict): From load_cohort_manifest.
+    - key (callable): item -> (subject_id, file_id).
+    - label (str): Name of the items in the log message.
+
+    Manifest rows that select nothing (not downloaded / not converted yet)
+    are logged.
+    """
+    selected = []
+    matched_rows = set()
+
+    for item in items:
+        subject_id, file_id = key(item)
+        for row in manifest.get(subject_id, []):
+            if cohort_row_matches(row, file_id):
+                selected.append(item)
+                matched_rows.add((subject_id, row))
+                break
+
+    n_rows = sum(len(rows) for rows in manifest.values())
+    log_print(f"Cohort: {len(selected)} of {len(items)} {label} selected, {n_rows - len(matched_rows)} of {n_rows} manifest rows without a match")
+    return selected
+
+def dicom_series_key(series):
+    """(subject_id, file_id) of a (subject_id, seq, scan_date, dicom_folder) DICOM series."""
+    subject_id, _, scan_date, dicom_folder = series
+    return subject_id, f"{scan_date}_{dicom_folder}"
+
+def nifti_file_key(nifti_file):
+    """(subject_id, file_id) of a (subject_id, nifti_path) NIfTI file."""
+    subject_id, nifti_path = nifti_file
+    return subject_id, os.path.basename(nifti_path).replace(".nii.gz", "")
@@ -0,0 +1,164 @@
+
+# -*- coding: utf-8 -*-
+
+# nohup env PYTHONDONTWRITEBYTECODE=1 python3 connectivity_cohort.py > output_connectivity_cohort.log 2>&1 < /dev/null &
+
+import os
+import numpy as np
+import pandas as pd
+
+from logging_utils import setup_logging, log_print
+from connectivity_utils import CONNECTIVITY_KINDS, connectivity_batch, sliding_window_batch, window_starts, save_connectivity
+
+# Cohort fMRI ROI store written by roi_extraction_parallel.py
+FMRI_STORE_DIRNAME = "fmri_roi_timeseries"
+RUN_KEYS = ["PTID", "scan_date", "image_id", "space"]
+
+def stack_roi_timeseries(roi_df):
+    """
+    Split the cohort fMRI ROI table (see roi_extraction_parallel) into runs.
+
+    Returns (runs, roi_names): runs is a list of (keys dict, T x R float32
+    array), in store order; roi_names are the ROI columns.
+    """
+    roi_names = [c for c in roi_df.columns if c not in RUN_KEYS + ["timepoint"]]
+
+    runs = []
+    for keys, run_df in roi_df.groupby(RUN_KEYS, sort=False, dropna=False):
+        timeseries = run_df.sort_values("timepoint")[roi_names].to_numpy(dtype=np.float32)
+        runs.append((dict(zip(RUN_KEYS, keys)), timeseries))
+
+    return runs, roi_names
+
+def batches_by_length(runs, batch_size):
+    """Lists of run positions with equal numbers of timepoints, at most batch_size each."""
+    by_length = {}
+    for i, (_, timeseries) in enumerate(runs):
+        by_length.setdefault(timeseries.shape[0], []).append(i)
+
+    for indices in by_length.values():
+        for start in range(0, len(indices), batch_size):
+            yield indices[start:start + batch_size]
+
+def load_store_runs(store_dir, space="MNI"):
+    """Runs of the fMRI ROI store (see stack_roi_timeseries), optionally of one space only."""
+    roi_df = pd.read_parquet(os.path.join(store_dir, FMRI_STORE_DIRNAME))
+    if space is not None:
+        roi_df = roi_df[roi_df["space"] == space]
+
+    runs, roi_names = stack_roi_timeseries(roi_df)
+
+    # ROIs missing from a run (NaN columns) are treated as constant: NaN edges
+    runs = [(keys, np.nan_to_num(timeseries, nan=0.0)) for keys, timeseries in runs]
+    return runs, roi_names
+
+def cohort_connectivity(runs, kinds=CONNECTIVITY_KINDS, batch_size=64):
+    """
+    Connectivity features of every run, computed in batches of equal length.
+
+    Runs with the same number of timepoints are stacked (up to batch_size at
+    a time) and computed together. Returns {kind: (S x E) float32}, rows in
+    the order of runs.
+    """
+    features = {}
+
+    for batch in batches_by_length(runs, batch_size):
+        batch_features = connectivity_batch(np.stack([runs[i][1] for i in batch]), kinds)
+
+        for kind, values in batch_features.items():
+            if kind not in features:
+                features[kind] = np.full((len(runs), values.shape[1]), np.nan, dtype=np.float32)
+            features[kind][batch] = values
+
+    return features
+
+def cohort_dynamic_connectivity(runs, window, stride=1, fisher=False, batch_size=8):
+    """
+    Sliding-window connectivity of every run (see connectivity_utils.sliding_window_batch).
+
+    Returns ((S x W x E) float32, n_windows): W is the largest number of
+    windows of any run; shorter runs are padded with NaN after their
+    n_windows[s] windows.
+    """
+    n_windows = np.array([len(window_starts(timeseries.shape[0], window, stride)) for _, timeseries in runs])
+    n_rois = runs[0][1].shape[1]
+    dynamic = np.full((len(runs), n_windows.max(), n_rois * (n_rois - 1) // 2), np.nan, dtype=np.float32)
+
+    # Smaller batches than the static case: the cross-product sums are (batch x T x E) float64
+    for batch in batches_by_length(runs, batch_size):
+        values = sliding_window_batch(np.stack([runs[i][1] for i in batch]), window, stride, fisher)
+        dynamic[batch, :values.shape[1]] = values
+
+    return dynamic, n_windows
+
+def build_connectivity_features(store_dir, out_path, kinds=CONNECTIVITY_KINDS, space="MNI", batch_size=64):
+    """
+    Build the cohort connectivity array from the fMRI ROI store.
+
+    Args:
+    - store_dir (str): Root of the cohort ROI store (see roi_extraction_parallel).
+    - out_path (str): Output .npz (one row per run, one column per edge; see connectivity_utils).
+    - kinds (tuple): Any of "pearson", "partial", "fisher_z".
+    - space (str): Only runs in this space ("MNI" or "native"); None for all.
+    - batch_size (int): Runs computed together.
+    """
+    runs, roi_names = load_store_runs(store_dir, space)
+    if not runs:
+        log_print(f"No {space or ''} ROI time series in {store_dir}")
+        return
+
+    log_print(f"Connectivity: {len(runs)} runs, {len(roi_names)} ROIs, {', '.join(kinds)}")
+
+    features = cohort_connectivity(runs, kinds, batch_size)
+    save_connectivity(out_path, features, roi_names, **{key: [keys[key] for keys, _ in runs] for key in RUN_KEYS})
+
+    log_print(f"Saved: {out_path} ({len(runs)} x {next(iter(features.values())).shape[1]} edges)")
+
+def build_dynamic_connectivity_features(store_dir, out_path, window, stride=1, fisher=False, space="MNI", batch_size=8):
+    """
+    Build the cohort sliding-window connectivity array from the fMRI ROI store.
+
+    Args:
+    - store_dir (str): Root of the cohort ROI store (see roi_extraction_parallel).
+    - out_path (str): Output .npz: "dynamic" (runs x windows x edges), n_windows, window_starts, window, stride.
+    - window (int): Window length in timepoints (e.g. 30 TRs).
+    - stride (int): Step between window starts in timepoints.
+    - fisher (bool): Store Fisher z instead of r.
+    - space (str): Only runs in this space ("MNI" or "native"); None for all.
+    - batch_size (int): Runs computed together.
+    """
+    runs, roi_names = load_store_runs(store_dir, space)
+    if not runs:
+        log_print(f"No {space or ''} ROI time series in {store_dir}")
+        return
+
+    log_print(f"Dynamic connectivity: {len(runs)} runs, {len(roi_names)} ROIs, window {window}, stride {stride}")
+
+    dynamic, n_windows = cohort_dynamic_connectivity(runs, window, stride, fisher, batch_size)
+    extra = {
+        "n_windows": n_windows,
+        "window_starts": np.arange(dynamic.shape[1]) * stride,
+        "window": np.array(window),
+        "stride": np.array(stride),
+        "fisher": np.array(fisher)
+    }
+    save_connectivity(out_path, {"dynamic": dynamic}, roi_names, extra=extra, **{key: [keys[key] for keys, _ in runs] for key in RUN_KEYS})
+
+    log_print(f"Saved: {out_path} ({dynamic.shape[0]} x {dynamic.shape[1]} windows x {dynamic.shape[2]} edges)")
+
+if __name__ == "__main__":
+
+    setup_logging("output_connectivity_cohort.log")
+
+    build_connectivity_features(
+        store_dir="/root/data/ADNI/example/roi_store",
+        out_path=os.path.join("/root/data/ADNI/example/roi_store", "connectivity_AAL.npz")
+    )
+
+    # Dynamic FC: 30-TR windows, one every 5 TRs
+    build_dynamic_connectivity_features(
+        store_dir="/root/data/ADNI/example/roi_store",
+        out_path=os.path.join("/root/data/ADNI/example/roi_store", "dynamic_connectivity_AAL_w30_s5.npz"),
+        window=30,
+        stride=5
+    )
@@ -0,0 +1,193 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+# ==========================================
+# Batched functional connectivity
+# ==========================================
+# ROI time series are stacked into one (S x T x R) float array (subjects x
+# timepoints x ROIs) and every subject's matrix is computed at once with
+# batched matrix products, instead of one np.corrcoef per subject.
+#
+# Matrices are symmetric with a fixed diagonal, so only the upper triangle
+# (k=1, np.triu_indices order) is kept: R*(R-1)/2 = 6670 edges for the 116
+# AAL ROIs. A ROI with zero variance (e.g. not covered in native space)
+# gets NaN edges.
+
+CONNECTIVITY_KINDS = ("pearson", "partial", "fisher_z")
+
+def upper_triangle_indices(n_rois):
+    """Row and column indices of the upper triangle (without the diagonal)."""
+    return np.triu_indices(n_rois, k=1)
+
+def to_upper_triangle(matrices):
+    """(... x R x R) matrices -> (... x E) upper triangles."""
+    rows, cols = upper_triangle_indices(matrices.shape[-1])
+    return matrices[..., rows, cols]
+
+def from_upper_triangle(edges, n_rois, diagonal=1.0):
+    """(... x E) upper triangles -> symmetric (... x R x R) matrices."""
+    rows, cols = upper_triangle_indices(n_rois)
+    matrices = np.full(edges.shape[:-1] + (n_rois, n_rois), diagonal, dtype=edges.dtype)
+    matrices[..., rows, cols] = edges
+    matrices[..., cols, rows] = edges
+    return matrices
+
+def n_rois_from_edges(n_edges):
+    """Number of ROIs R of an upper triangle with E = R*(R-1)/2 edges."""
+    return int(round((1 + np.sqrt(1 + 8 * n_edges)) / 2))
+
+def pearson_batch(timeseries):
+    """
+    Pearson correlation matrices of a batch of ROI time series.
+
+    Args:
+    - timeseries (ndarray): (S x T x R), subjects x timepoints x ROIs.
+
+    Returns (S x R x R) float64 matrices (NaN rows/columns for constant ROIs).
+    """
+    x = np.asarray(timeseries, dtype=np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+
+    norms = np.sqrt(np.einsum("str,str->sr", x, x))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x = x / norms[:, None, :]
+
+    corr = np.matmul(x.transpose(0, 2, 1), x)
+    np.clip(corr, -1.0, 1.0, out=corr)
+
+    diag = np.arange(corr.shape[-1])
+    corr[:, diag, diag] = np.where(norms > 0, 1.0, np.nan)
+    return corr
+
+def partial_from_pearson(corr):
+    """
+    Partial correlation matrices from a batch of correlation matrices (S x R x R).
+
+    From the (pseudo-)inverse of each matrix: p_ij = -P_ij / sqrt(P_ii * P_jj).
+    Constant ROIs are left out of the inversion and get NaN edges.
+    """
+    valid = ~np.isnan(np.diagonal(corr, axis1=1, axis2=2))
+    filled = np.where(valid[:, :, None] & valid[:, None, :], corr, 0.0)
+    diag = np.arange(corr.shape[-1])
+    filled[:, diag, diag] = 1.0
+
+    precision = np.linalg.pinv(filled, hermitian=True)
+    scale = np.sqrt(np.abs(np.diagonal(precision, axis1=1, axis2=2)))
+
+    partial = -precision / (scale[:, :, None] * scale[:, None, :])
+    np.clip(partial, -1.0, 1.0, out=partial)
+    partial[:, diag, diag] = 1.0
+    partial[~(valid[:, :, None] & valid[:, None, :])] = np.nan
+    return partial
+
+def fisher_z(corr, eps=1e-7):
+    """Fisher z-transform (arctanh), with |r| clipped below 1 so the diagonal stays finite."""
+    return np.arctanh(np.clip(corr, -1.0 + eps, 1.0 - eps))
+
+def connectivity_batch(timeseries, kinds=CONNECTIVITY_KINDS, dtype=np.float32):
+    """
+    Upper-triangle connectivity features of a batch of subjects.
+
+    Args:
+    - timeseries (ndarray): (S x T x R) ROI time series, equal T for the batch.
+    - kinds (tuple): Any of "pearson", "partial", "fisher_z" (z of the Pearson r).
+    - dtype: Output dtype.
+
+    Returns {kind: (S x E) array}.
+    """
+    corr = pearson_batch(timeseries)
+    features = {}
+
+    if "pearson" in kinds:
+        features["pearson"] = to_upper_triangle(corr).astype(dtype)
+    if "fisher_z" in kinds:
+        features["fisher_z"] = fisher_z(to_upper_triangle(corr)).astype(dtype)
+    if "partial" in kinds:
+        features["partial"] = to_upper_triangle(partial_from_pearson(corr)).astype(dtype)
+
+    return features
+
+# ==========================================
+# Sliding-window (dynamic) connectivity
+# ==========================================
+# Windowed correlations from running sums: with cumulative sums over time of
+# x, x^2 and the per-edge cross products x_i * x_j, the sums over any window
+# [t, t + w) are one subtraction each, so every window costs O(E) instead of
+# a full O(w * R^2) correlation. Each run is z-scored over its whole length
+# first, which keeps the sums well conditioned.
+
+def window_starts(n_timepoints, window, stride=1):
+    """First timepoint of each window (windows that fit entirely in the run)."""
+    if window < 2 or window > n_timepoints:
+        raise ValueError(f"Window length must be between 2 and the run length ({n_timepoints}), got {window}")
+    return np.arange(0, n_timepoints - window + 1, stride)
+
+def sliding_window_batch(timeseries, window, stride=1, fisher=False, dtype=np.float32):
+    """
+    Sliding-window Pearson correlations of a batch of ROI time series.
+
+    Args:
+    - timeseries (ndarray): (S x T x R) ROI time series, equal T for the batch.
+    - window (int): Window length in timepoints.
+    - stride (int): Step between window starts in timepoints.
+    - fisher (bool): Return Fisher z instead of r.
+    - dtype: Output dtype.
+
+    Returns (S x W x E) upper-triangle edges, W = len(window_starts(T, window, stride)).
+    """
+    x = np.asarray(timeseries, dtype=np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+    std = x.std(axis=1, keepdims=True)
+    x = np.divide(x, std, out=np.zeros_like(x), where=std > 0)
+
+    starts = window_starts(x.shape[1], window, stride)
+    rows, cols = upper_triangle_indices(x.shape[2])
+
+    def window_sums(values):
+        # (S x T x K) -> (S x W x K) sums over each window
+        cumsum = np.zeros((values.shape[0], values.shape[1] + 1, values.shape[2]))
+        np.cumsum(values, axis=1, out=cumsum[:, 1:])
+        return cumsum[:, starts + window] - cumsum[:, starts]
+
+    sum_x = window_sums(x)
+    var = window_sums(x * x) - sum_x ** 2 / window
+    cov = window_sums(x[:, :, rows] * x[:, :, cols]) - sum_x[:, :, rows] * sum_x[:, :, cols] / window
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.sqrt(var[:, :, rows] * var[:, :, cols])
+    # Windows where a ROI is (numerically) constant
+    corr[(var[:, :, rows] <= 1e-10 * window) | (var[:, :, cols] <= 1e-10 * window)] = np.nan
+    np.clip(corr, -1.0, 1.0, out=corr)
+
+    return (fisher_z(corr) if fisher else corr).astype(dtype)
+
+def save_connectivity(path, features, roi_names, extra=None, **keys):
+    """
+    Save cohort connectivity features as .npz.
+
+    Args:
+    - path (str): Output .npz path.
+    - features (dict): {kind: (S x ...) array}, e.g. from connectivity_batch or sliding_window_batch.
+    - roi_names (list): ROI names, in column order of the time series.
+    - extra (dict): Other arrays saved as is (e.g. window settings).
+    - keys: Per-subject key arrays (e.g. PTID, scan_date, image_id), length S.
+
+    Edges are described by edge_rows / edge_cols (ROI positions of each edge).
+    """
+    rows, cols = upper_triangle_indices(len(roi_names))
+    arrays = {kind: values for kind, values in features.items()}
+    arrays.update({name: np.asarray(values).astype(str) for name, values in keys.items()})
+    arrays.update(extra or {})
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, roi_names=np.asarray(roi_names).astype(str), edge_rows=rows, edge_cols=cols, key_names=np.asarray(list(keys)).astype(str), **arrays)
+    os.replace(tmp_path, path)
+
+def load_connectivity(path):
+    """Load features saved with save_connectivity as a dict of arrays."""
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
@@ -0,0 +1,280 @@
+
+# -*- coding: utf-8 -*-
+
+# nohup env PYTHONDONTWRITEBYTECODE=1 python3 dicom_prescan.py > output_dicom_prescan.log 2>&1 < /dev/null &
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pydicom
+
+from logging_utils import setup_logging, log_print
+from manifest_utils import series_fingerprint
+from dicom_to_nifti_parallel import list_dicom_series, convert_dicom_to_nifti_parallel
+
+# ==========================================
+# Header-only DICOM prescan
+# ==========================================
+# Reads the headers (stop_before_pixels, only the tags below) of the first
+# and last file of every series folder and writes one row per series to an
+# index CSV, so that series can be selected before anything is converted.
+# Only two fallbacks read more: a mosaic without its Siemens tag (pixels of
+# its first file) and a one-file-per-slice series without
+# NumberOfTemporalPositions (slice positions of all its files).
+# The index is incremental: a series whose folder listing is unchanged
+# (see manifest_utils.series_fingerprint) keeps its row without reading it.
+
+SERIES_KEYS = ["subject_id", "seq", "scan_date", "dicom_folder"]
+
+HEADER_TAGS = [
+    "SeriesInstanceUID", "StudyInstanceUID", "SeriesDescription", "ProtocolName",
+    "AcquisitionDate", "SeriesDate", "StudyDate", "AcquisitionTime",
+    "RepetitionTime", "ImageType", "NumberOfTemporalPositions", "NumberOfFrames",
+    "Manufacturer", "ManufacturerModelName",
+    (0x0019, 0x0010),  # Siemens: private creator of the (0019,10xx) block
+    (0x0019, 0x100A)   # Siemens: number of images in a mosaic (if the creator is "SIEMENS CSA HEADER")
+]
+
+POSITION_TAGS = ["ImagePositionPatient", "SliceLocation"]
+
+def _read_header(path):
+    return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS, force=True)
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _mosaic_images(header):
+    """Slices of a Siemens mosaic from its CSA private tag, None if not there."""
+    creator = header.get((0x0019, 0x0010))
+    element = header.get((0x0019, 0x100A))
+    if creator is None or element is None or str(creator.value).strip() != "SIEMENS CSA HEADER":
+        return None
+
+    value = element.value
+    if isinstance(value, bytes):
+        # Implicit VR: read as UN, the raw little-endian US
+        return int.from_bytes(value[:2], "little") if len(value) >= 2 else None
+    return _int_or_none(value)
+
+def _mosaic_tiles(path):
+    """Slices of a Siemens mosaic counted as its tiles, up to the last non-empty one."""
+    dataset = pydicom.dcmread(path, force=True)
+    matrix = [_int_or_none(v) or 0 for v in dataset.get("AcquisitionMatrix") or []]
+    if len(matrix) != 4:
+        return None
+
+    # AcquisitionMatrix: frequency rows, frequency columns, phase rows, phase columns
+    tile_rows, tile_columns = max(matrix[0], matrix[2]), max(matrix[1], matrix[3])
+    if not tile_rows or not tile_columns:
+        return None
+
+    pixels = dataset.pixel_array
+    grid_rows, grid_columns = pixels.shape[0] // tile_rows, pixels.shape[1] // tile_columns
+    tiles = pixels[:grid_rows * tile_rows, :grid_columns * tile_columns].reshape(grid_rows, tile_rows, grid_columns, tile_columns)
+    filled = tiles.any(axis=(1, 3)).ravel()
+    # Tiles after the last slice are zero padding
+    return int(filled.nonzero()[0][-1]) + 1 if filled.any() else None
+
+def _count_slice_positions(files):
+    """Distinct slice positions (ImagePositionPatient, else SliceLocation) over the files, None if any has neither."""
+    positions = set()
+    for path in files:
+        header = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=POSITION_TAGS, force=True)
+        if header.get("ImagePositionPatient") is not None:
+            positions.add(tuple(round(float(v), 2) for v in header.ImagePositionPatient))
+        elif header.get("SliceLocation") is not None:
+            positions.add(round(float(header.SliceLocation), 2))
+        else:
+            return None
+    return len(positions)
+
+def series_geometry(header, files):
+    """
+    (slices, timepoints) of a series from its first header and its files.
+
+    - Siemens mosaic: one file per volume, slices from the mosaic tag (or the
+      tiles of the first mosaic if the tag is missing).
+    - Enhanced (multi-frame) DICOM: frames split by NumberOfTemporalPositions.
+    - One file per slice: slices are the file count over NumberOfTemporalPositions,
+      or (without it) the distinct slice positions over all files.
+
+    ImagesInAcquisition is not used: GE and Philips put the total number of
+    images (slices x timepoints) there, not the slices.
+    """
+    image_type = [str(v).upper() for v in header.get("ImageType", [])]
+    temporal = _int_or_none(header.get("NumberOfTemporalPositions"))
+    frames = _int_or_none(header.get("NumberOfFrames"))
+
+    if "MOSAIC" in image_type:
+        return _mosaic_images(header) or _mosaic_tiles(files[0]), len(files)
+
+    if frames and frames > 1:
+        timepoints = temporal or 1
+        return frames // timepoints, timepoints
+
+    if temporal:
+        return len(files) // temporal, temporal
+
+    slices = _count_slice_positions(files)
+    if slices:
+        return slices, len(files) // slices
+
+    return None, None
+
+def prescan_series(series, dicom_dir):
+    """Index row of one series folder: header fields of its first file, checked against its last."""
+    dicom_path = os.path.join(dicom_dir, *series)
+    fingerprint = series_fingerprint(dicom_path)
+    row = dict(zip(SERIES_KEYS, series), file_count=fingerprint["file_count"], listing_sha256=fingerprint["listing_sha256"])
+
+    files = sorted(entry.path for entry in os.scandir(dicom_path) if entry.is_file())
+    if not files:
+        return dict(row, error="no files")
+
+    try:
+        first = _read_header(files[0])
+        last = _read_header(files[-1]) if len(files) > 1 else first
+        slices, timepoints = series_geometry(first, files)
+    except Exception as e:
+        return dict(row, error=f"{type(e).__name__}: {e}")
+    tr = first.get("RepetitionTime")
+
+    row.update({
+        "series_uid": first.get("SeriesInstanceUID"),
+        "study_uid": first.get("StudyInstanceUID"),
+        "series_description": first.get("SeriesDescription"),
+        "protocol_name": first.get("ProtocolName"),
+        "acquisition_date": first.get("AcquisitionDate") or first.get("SeriesDate") or first.get("StudyDate"),
+        "acquisition_time": first.get("AcquisitionTime"),
+        # RepetitionTime is in ms
+        "tr": float(tr) / 1000.0 if tr not in (None, "") else None,
+        "slices": slices,
+        "timepoints": timepoints,
+        "manufacturer": first.get("Manufacturer"),
+        "model": first.get("ManufacturerModelName"),
+        # A folder mixing two series (different UIDs) is flagged, not split
+        "uid_consistent": first.get("SeriesInstanceUID") == last.get("SeriesInstanceUID"),
+        "error": None
+    })
+    return {key: (str(value) if isinstance(value, pydicom.uid.UID) else value) for key, value in row.items()}
+
+def prescan_dicom_tree(dicom_dir, measurement_type_sequences, index_path, num_threads=16):
+    """
+    Build (or update) the series index CSV of a DICOM tree.
+
+    Args:
+    - dicom_dir (str): DICOM root (<dicom_dir>/<PTID>/<seq>/<date>/<folder>/).
+    - measurement_type_sequences (list): Sequence folders to scan.
+    - index_path (str): Index CSV, one row per series.
+    - num_threads (int): Series read concurrently (header reads are I/O bound).
+
+    Returns the index as a DataFrame.
+    """
+    previous = {}
+    if os.path.exists(index_path):
+        for row in pd.read_csv(index_path, dtype=dict.fromkeys(SERIES_KEYS + ["acquisition_date", "acquisition_time"], str)).to_dict("records"):
+            previous[tuple(row[key] for key in SERIES_KEYS)] = row
+
+    series_list = list_dicom_series(dicom_dir, measurement_type_sequences)
+
+    rows = {}
+    to_scan = []
+    for series in series_list:
+        row = previous.get(series)
+        if row is not None and pd.isna(row.get("error")) and row["listing_sha256"] == series_fingerprint(os.path.join(dicom_dir, *series))["listing_sha256"]:
+            rows[series] = row
+        else:
+            to_scan.append(series)
+
+    log_print(f"Prescan: {len(to_scan)} new or changed series, {len(rows)} unchanged")
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for series, row in zip(to_scan, executor.map(lambda s: prescan_series(s, dicom_dir), to_scan)):
+            rows[series] = row
+
+    index = pd.DataFrame([rows[series] for series in series_list])
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = f"{index_path}.tmp"
+    index.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+
+    errors = int(index["error"].notna().sum()) if "error" in index else 0
+    log_print(f"Series index saved: {index_path} ({len(index)} series, {errors} unreadable)")
+    return index
+
+def select_series(index, protocol=None, dedupe=True, baseline_only=False, min_timepoints=None, tr=None, tr_tolerance=0.05):
+    """
+    Select series to convert from the prescan index.
+
+    Args:
+    - index (DataFrame): Prescan index (prescan_dicom_tree).
+    - protocol (str): Regular expression matched (case-insensitive) against the
+      sequence folder, SeriesDescription and ProtocolName; any match keeps the series.
+    - dedupe (bool): Keep one folder per SeriesInstanceUID (the one with most files),
+      e.g. the same scan filed under two description folders.
+    - baseline_only (bool): Per subject, only the earliest acquisition date;
+      of several series on that date, the one with most timepoints.
+    - min_timepoints (int): Drop shorter series (e.g. aborted runs).
+    - tr (float): Keep series with this TR (seconds, within tr_tolerance).
+
+    Unreadable series are dropped. Returns the selected rows.
+    """
+    selected = index[index["error"].isna()] if "error" in index else index
+
+    if protocol is not None:
+        pattern = re.compile(protocol, re.IGNORECASE)
+        fields = selected[["seq", "series_description", "protocol_name"]].fillna("").astype(str)
+        selected = selected[fields.apply(lambda row: any(pattern.search(value) for value in row), axis=1)]
+
+    if min_timepoints is not None:
+        selected = selected[selected["timepoints"].fillna(0) >= min_timepoints]
+
+    if tr is not None:
+        selected = selected[(selected["tr"] - tr).abs() <= tr_tolerance]
+
+    if dedupe:
+        selected = selected.sort_values("file_count", ascending=False, kind="stable")
+        with_uid = selected[selected["series_uid"].notna()].drop_duplicates("series_uid")
+        selected = pd.concat([with_uid, selected[selected["series_uid"].isna()]])
+
+    if baseline_only:
+        dates = selected["acquisition_date"].fillna(selected["scan_date"].str[:10].str.replace("-", ""))
+        selected = selected.assign(_date=dates.astype(str))
+        selected = selected[selected["_date"] == selected.groupby("subject_id")["_date"].transform("min")]
+        selected = selected.sort_values(["timepoints", "file_count"], ascending=False, kind="stable").drop_duplicates("subject_id")
+        selected = selected.drop(columns="_date")
+
+    return selected.sort_values(SERIES_KEYS).reset_index(drop=True)
+
+def series_from_index(index):
+    """(subject_id, seq, scan_date, dicom_folder) tuples of index rows, for convert_dicom_to_nifti_parallel."""
+    return [tuple(row) for row in index[SERIES_KEYS].astype(str).itertuples(index=False)]
+
+if __name__ == "__main__":
+
+    setup_logging("output_dicom_prescan.log")
+
+    NUM_CORES = 20
+
+    # fMRI: index every rsfMRI series, then convert only the deduplicated baseline scans
+    index = prescan_dicom_tree(
+        dicom_dir="/root/data/ADNI/example/fMRI/dicom",
+        measurement_type_sequences=["Axial_HB_rsfMRI__Eyes_Open___MSV22_"],
+        index_path="/root/data/ADNI/example/fMRI/dicom_series_index.csv"
+    )
+
+    selected = select_series(index, protocol=r"rsfMRI|fcMRI|resting", baseline_only=True, min_timepoints=100)
+    log_print(f"Selected {len(selected)} of {len(index)} series")
+
+    convert_dicom_to_nifti_parallel(
+        dicom_dir="/root/data/ADNI/example/fMRI/dicom",
+        nifti_dir="/root/data/ADNI/example/fMRI/nifti",
+        measurement_type_sequences=["Axial_HB_rsfMRI__Eyes_Open___MSV22_"],
+        num_workers=NUM_CORES,
+        series=series_from_index(selected)
+    )
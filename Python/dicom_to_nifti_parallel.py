@@ -4,59 +4,314 @@
 # nohup env PYTHONDONTWRITEBYTECODE=1 python3 dicom_to_nifti_parallel.py > output_dicom_to_nifti_parallel.log 2>&1 < /dev/null &
 
 import os
-import multiprocessing
-from subprocess import call
+import time
+import signal
+import asyncio
+from subprocess import check_call
 
 from logging_utils import setup_logging, log_print
+from scheduling_utils import order_by_cost, run_tasks, terminate_on_sigterm, write_failure_report
+from cohort_utils import load_cohort_manifest, cohort_subjects, filter_by_cohort, dicom_series_key
+from manifest_utils import MANIFEST_FILENAME, series_fingerprint, output_fingerprints, load_manifest, append_manifest, series_is_converted
 
-setup_logging("output_dicom_to_nifti_parallel.log")
+def list_dicom_series(dicom_dir, measurement_type_sequences, subject_list=None):
+    """List (subject_id, seq, scan_date, dicom_folder) for every DICOM series folder."""
+    if subject_list is None:
+        subject_list = sorted([s for s in os.listdir(dicom_dir) if os.path.isdir(os.path.join(dicom_dir, s))])
+
+    series_list = []
+    for subject_id in subject_list:
+        subject_path = os.path.join(dicom_dir, subject_id)
+
+        for seq in measurement_type_sequences:
+            seq_path = os.path.join(subject_path, seq)
+
+            if not os.path.isdir(seq_path):
+                continue
+
+            date_folders = [d for d in sorted(os.listdir(seq_path)) if os.path.isdir(os.path.join(seq_path, d))]
+
+            for scan_date in date_folders:
+                scan_date_path = os.path.join(seq_path, scan_date)
+
+                dicom_folders = [d for d in sorted(os.listdir(scan_date_path)) if os.path.isdir(os.path.join(scan_date_path, d))]
+
+                for dicom_folder in dicom_folders:
+                    series_list.append((subject_id, seq, scan_date, dicom_folder))
+
+    return series_list
+
+def dcm2niix_command(out_dir, filename, dicom_path):
+    """dcm2niix call writing <out_dir>/<filename>.nii.gz (and its .json sidecar)."""
+    # -w 1: overwrite the outputs of an earlier conversion of a changed series
+    return ["dcm2niix", "-z", "y", "-w", "1", "-o", out_dir, "-f", filename, dicom_path]
+
+def convert_single_series(subject_id, seq, scan_date, dicom_folder, dicom_dir, nifti_dir, fingerprint=None):
+    """
+    DICOM -> NIfTI for a single series folder.
+
+    Returns the series' manifest entry (fingerprint of the DICOM folder taken
+    before converting, and the files dcm2niix wrote).
+    """
+    dicom_path = os.path.join(dicom_dir, subject_id, seq, scan_date, dicom_folder)
+    if fingerprint is None:
+        fingerprint = series_fingerprint(dicom_path)
+    start = time.monotonic()
+
+    nii_subject_path = os.path.join(nifti_dir, subject_id, seq)
+    os.makedirs(nii_subject_path, exist_ok=True)
+
+    nii_filename = f"{scan_date}_{dicom_folder}.nii.gz"
+    nii_output_path = os.path.join(nii_subject_path, nii_filename)
+
+    log_print(f"Converting: {dicom_path} to {nii_output_path}")
+
+    # check_call(["dcm2niix", "-o", nii_subject_path, "-f", f"{scan_date}_{dicom_folder}", dicom_path])
+    check_call(dcm2niix_command(nii_subject_path, f"{scan_date}_{dicom_folder}", dicom_path))
+
+    return {
+        "series": os.path.join(subject_id, seq, scan_date, dicom_folder),
+        "status": "ok",
+        "fingerprint": fingerprint,
+        "outputs": output_fingerprints(nifti_dir, os.path.join(nii_subject_path, f"{scan_date}_{dicom_folder}")),
+        "seconds": round(time.monotonic() - start, 1)
+    }
 
 def convert_single_subject(subject_id, dicom_dir, nifti_dir, measurement_type_sequences):
     """DICOM -> NIfTI"""
-    subject_path = os.path.join(dicom_dir, subject_id)
-
     log_print(f"Processing subject {subject_id}")
 
-    for seq in measurement_type_sequences:
-        seq_path = os.path.join(subject_path, seq)
+    for series in list_dicom_series(dicom_dir, measurement_type_sequences, subject_list=[subject_id]):
+        convert_single_series(*series, dicom_dir, nifti_dir)
+
+def plan_conversion(series_list, dicom_dir, nifti_dir, manifest_path, force=False, adopt_existing=True):
+    """
+    Split series into those to convert and those already up to date (see manifest_utils).
+
+    Args:
+    - series_list (list): (subject_id, seq, scan_date, dicom_folder) tuples.
+    - force (bool): Convert every series regardless of the manifest.
+    - adopt_existing (bool): A series with no manifest entry whose outputs already exist
+      (converted before the manifest existed) is recorded as converted instead of redone.
 
-        if not os.path.isdir(seq_path):
+    Returns (to_convert, up_to_date), to_convert as (series, fingerprint) pairs.
+    """
+    manifest = load_manifest(manifest_path)
+
+    to_convert = []
+    up_to_date = []
+    for series in series_list:
+        subject_id, seq, scan_date, dicom_folder = series
+        fingerprint = series_fingerprint(os.path.join(dicom_dir, *series))
+        entry = manifest.get(os.path.join(*series))
+
+        if not force and series_is_converted(entry, fingerprint, nifti_dir):
+            up_to_date.append(series)
             continue
 
-        date_folders = [d for d in sorted(os.listdir(seq_path)) if os.path.isdir(os.path.join(seq_path, d))]
+        if not force and entry is None and adopt_existing:
+            outputs = output_fingerprints(nifti_dir, os.path.join(nifti_dir, subject_id, seq, f"{scan_date}_{dicom_folder}"))
+            if any(path.endswith(".nii.gz") for path in outputs):
+                append_manifest(manifest_path, {"series": os.path.join(*series), "status": "ok", "fingerprint": fingerprint, "outputs": outputs, "adopted": True})
+                up_to_date.append(series)
+                continue
 
-        for scan_date in date_folders:
-            scan_date_path = os.path.join(seq_path, scan_date)
+        to_convert.append((series, fingerprint))
 
-            dicom_folders = [d for d in sorted(os.listdir(scan_date_path)) if os.path.isdir(os.path.join(scan_date_path, d))]
+    return to_convert, up_to_date
 
-            for dicom_folder in dicom_folders:
-                dicom_path = os.path.join(scan_date_path, dicom_folder)
+def select_dicom_series(dicom_dir, measurement_type_sequences, series=None, cohort=None):
+    """Series to consider: the given ones or every series folder, restricted to a cohort manifest if given."""
+    if cohort is not None:
+        manifest = load_cohort_manifest(cohort)
+        if series is None:
+            series = list_dicom_series(dicom_dir, measurement_type_sequences, subject_list=cohort_subjects(manifest))
+        return filter_by_cohort(series, manifest, dicom_series_key, label="DICOM series")
 
-                nii_subject_path = os.path.join(nifti_dir, subject_id, seq)
-                os.makedirs(nii_subject_path, exist_ok=True)
+    return series if series is not None else list_dicom_series(dicom_dir, measurement_type_sequences)
 
-                nii_filename = f"{scan_date}_{dicom_folder}.nii.gz"
-                nii_output_path = os.path.join(nii_subject_path, nii_filename)
+def conversion_tasks(to_convert, dicom_dir, nifti_dir):
+    """run_tasks tasks of (series, fingerprint) pairs, largest series first."""
+    return order_by_cost([
+        {"name": os.path.join(*series), "args": series + (dicom_dir, nifti_dir), "kwargs": {"fingerprint": fingerprint}, "cost": (fingerprint["file_count"], fingerprint["total_size"])}
+        for series, fingerprint in to_convert
+    ])
 
-                log_print(f"Converting: {dicom_path} to {nii_output_path}")
+def conversion_failure_rows(failures):
+    """Failure report rows (run_tasks format) of failed manifest entries."""
+    return [{"task": f["series"], "status": f["status"], "attempts": f["attempts"], "message": f["message"]} for f in failures]
 
-                # call(["dcm2niix", "-o", nii_subject_path, "-f", f"{scan_date}_{dicom_folder}", dicom_path])
-                call(["dcm2niix", "-z", "y", "-o", nii_subject_path, "-f", f"{scan_date}_{dicom_folder}", dicom_path])
+def convert_dicom_to_nifti_parallel(dicom_dir, nifti_dir, measurement_type_sequences, num_workers, timeout=None, retries=0, failure_report="failures_dicom_to_nifti_parallel.csv", manifest_path=None, force=False, adopt_existing=True, executor="async", series=None, cohort=None):
+    """
+    DICOM -> NIfTI, one series per task, largest series first.
 
-def convert_dicom_to_nifti_parallel(dicom_dir, nifti_dir, measurement_type_sequences, num_workers):
-    """DICOM -> NIfTI"""
-    subject_list = sorted([s for s in os.listdir(dicom_dir) if os.path.isdir(os.path.join(dicom_dir, s))])
+    executor "async" (default) runs up to num_workers dcm2niix processes from
+    one event loop (see "Async series executor"), with per-series logs in
+    <nifti_dir>/conversion_logs/; "process" runs each series in its own
+    Python worker process (run_tasks).
+
+    series restricts the conversion to the given (subject_id, seq,
+    scan_date, dicom_folder) tuples (e.g. selected with dicom_prescan)
+    instead of every series folder of the tree. cohort (a cohort manifest
+    CSV or DataFrame, see cohort_utils) converts only the scans it lists,
+    reading them in place from dicom_dir; only the listed subjects'
+    folders are scanned.
+
+    Only new or changed series are converted: each result is appended to the
+    conversion manifest (default <nifti_dir>/conversion_manifest.jsonl) as
+    soon as its task finishes, and reruns skip series whose DICOM folder and
+    outputs match their last successful entry.
+    """
+    manifest_path = manifest_path or os.path.join(nifti_dir, MANIFEST_FILENAME)
+
+    series = select_dicom_series(dicom_dir, measurement_type_sequences, series, cohort)
+    to_convert, up_to_date = plan_conversion(series, dicom_dir, nifti_dir, manifest_path, force, adopt_existing)
+    tasks = conversion_tasks(to_convert, dicom_dir, nifti_dir)
 
-    log_print(f"Starting parallel conversion with {num_workers} workers...")
+    log_print(f"{len(up_to_date)} series up to date in {manifest_path}")
 
-    with multiprocessing.Pool(processes=num_workers) as pool:
-        pool.starmap(convert_single_subject, [(subject, dicom_dir, nifti_dir, measurement_type_sequences) for subject in subject_list])
+    if executor == "async":
+        log_print(f"Starting async conversion of {len(tasks)} new or changed series, {num_workers} at a time...")
+
+        # On SIGTERM (as on Ctrl-C) asyncio.run cancels the conversions, which kill their dcm2niix
+        with terminate_on_sigterm():
+            failures = asyncio.run(convert_series_async(
+                [(task["args"][:4], task["kwargs"]["fingerprint"]) for task in tasks],
+                dicom_dir, nifti_dir, manifest_path, num_workers, timeout=timeout, retries=retries
+            ))
+
+        if failure_report is not None:
+            write_failure_report(failure_report, conversion_failure_rows(failures))
+        if failures:
+            log_print(f"{len(failures)} of {len(tasks)} series failed" + (f", see {failure_report}" if failure_report else ""))
+
+        log_print("All Converting Completed!")
+        return
+
+    def record(task, status, result):
+        if status == "ok":
+            append_manifest(manifest_path, result)
+        else:
+            append_manifest(manifest_path, {"series": task["name"], "status": status, "fingerprint": task["kwargs"]["fingerprint"], "message": result.strip().splitlines()[-1] if result.strip() else ""})
+
+    log_print(f"Starting parallel conversion of {len(tasks)} new or changed series with {num_workers} workers...")
+
+    run_tasks(convert_single_series, tasks, num_workers, timeout=timeout, retries=retries, failure_report=failure_report, on_result=record)
 
     log_print("All Converting Completed!")
 
+# ==========================================
+# Async series executor
+# ==========================================
+# dcm2niix is I/O bound and runs as its own process anyway, so one event
+# loop can keep many of them in flight: a semaphore bounds the number of
+# concurrent dcm2niix processes, each with its own timeout (its whole
+# process group is killed) and with stdout/stderr captured to a per-series
+# log. Each result is appended to the conversion manifest as soon as it
+# finishes, so an interrupted run keeps everything converted so far.
+
+def _series_log_path(log_dir, series_name):
+    return os.path.join(log_dir, series_name.replace(os.sep, "__") + ".log")
+
+def _kill_dcm2niix(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+async def _run_dcm2niix(command, timeout):
+    """Run one dcm2niix call; returns (returncode or None on timeout, stdout, stderr)."""
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        _kill_dcm2niix(process)
+        stdout, stderr = await process.communicate()
+        return None, stdout, stderr
+    except asyncio.CancelledError:
+        # Ctrl-C or SIGTERM: asyncio.run cancels the conversions, and dcm2niix runs in its own session
+        _kill_dcm2niix(process)
+        await process.communicate()
+        raise
+
+    return process.returncode, stdout, stderr
+
+async def _convert_series_async(series, fingerprint, dicom_dir, nifti_dir, semaphore, timeout, retries, log_dir):
+    """Convert one series under the semaphore, with retries; returns its manifest entry."""
+    subject_id, seq, scan_date, dicom_folder = series
+    series_name = os.path.join(*series)
+    dicom_path = os.path.join(dicom_dir, *series)
+    nii_subject_path = os.path.join(nifti_dir, subject_id, seq)
+    filename = f"{scan_date}_{dicom_folder}"
+    log_path = _series_log_path(log_dir, series_name)
+
+    for attempt in range(1, retries + 2):
+        try:
+            os.makedirs(nii_subject_path, exist_ok=True)
+
+            async with semaphore:
+                log_print(f"Converting: {dicom_path} to {os.path.join(nii_subject_path, filename + '.nii.gz')}")
+                start = time.monotonic()
+                returncode, stdout, stderr = await _run_dcm2niix(dcm2niix_command(nii_subject_path, filename, dicom_path), timeout)
+                seconds = round(time.monotonic() - start, 1)
+
+            with open(log_path, "ab") as f:
+                f.write(f"# attempt {attempt}, exit {returncode}, {seconds} s\n".encode() + stdout + stderr)
+
+            if returncode == 0:
+                return {
+                    "series": series_name,
+                    "status": "ok",
+                    "fingerprint": fingerprint,
+                    "outputs": output_fingerprints(nifti_dir, os.path.join(nii_subject_path, filename)),
+                    "seconds": seconds,
+                    "log": os.path.relpath(log_path, nifti_dir)
+                }
+        except OSError as error:
+            # dcm2niix missing, no file descriptors or memory left, output not writable: fails this series only
+            status, message = "error", f"{type(error).__name__}: {error}"
+        else:
+            status = "timeout" if returncode is None else "error"
+            message = f"No result after {timeout} s" if returncode is None else f"Exit code {returncode}: " + (stderr or stdout).decode(errors="replace").strip()[-500:]
+
+        if attempt <= retries:
+            log_print(f"Task {series_name} failed ({status}), retrying ({attempt}/{retries})")
+
+    log_print(f"Task {series_name} failed ({status}) after {attempt} attempt(s):\n{message}")
+    return {"series": series_name, "status": status, "fingerprint": fingerprint, "message": message, "attempts": attempt, "log": os.path.relpath(log_path, nifti_dir)}
+
+async def convert_series_async(to_convert, dicom_dir, nifti_dir, manifest_path, max_concurrent, timeout=None, retries=0, log_dir=None, on_entry=None):
+    """
+    Convert (series, fingerprint) pairs with at most max_concurrent dcm2niix processes.
+
+    Every entry is appended to the manifest as it completes (and passed to
+    on_entry, if given). Returns the list of failed entries.
+    """
+    log_dir = log_dir or os.path.join(nifti_dir, "conversion_logs")
+    os.makedirs(log_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    pending = [
+        asyncio.ensure_future(_convert_series_async(series, fingerprint, dicom_dir, nifti_dir, semaphore, timeout, retries, log_dir))
+        for series, fingerprint in to_convert
+    ]
+
+    failures = []
+    for finished in asyncio.as_completed(pending):
+        entry = await finished
+        append_manifest(manifest_path, entry)
+        if entry["status"] != "ok":
+            failures.append(entry)
+        if on_entry is not None:
+            on_entry(entry)
+
+    return failures
+
 if __name__ == "__main__":
 
+    setup_logging("output_dicom_to_nifti_parallel.log")
+
     NUM_CORES = 20
 
     # MRI
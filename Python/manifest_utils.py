@@ -0,0 +1,106 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import hashlib
+import datetime
+
+# ==========================================
+# Conversion manifest
+# ==========================================
+# conversion_manifest.jsonl (in the NIfTI root) is an append-only log with
+# one JSON line per conversion attempt:
+#   {"series": "<PTID>/<seq>/<date>/<folder>", "status": "ok" | "error" | "timeout" | ...,
+#    "fingerprint": {...}, "outputs": {<path relative to the NIfTI root>: {"size", "mtime_ns"}},
+#    "message": ..., "recorded_at": ...}
+# The last line of a series wins. A series is up to date when its last
+# entry is "ok", its DICOM folder still has the same fingerprint and all of
+# its outputs still exist unchanged. Lines are only ever appended (by the
+# parent process), so an interrupted run loses at most its last line.
+
+MANIFEST_FILENAME = "conversion_manifest.jsonl"
+
+def series_fingerprint(dicom_path):
+    """
+    Fingerprint of a DICOM series folder from one directory listing.
+
+    File count, total size, newest mtime and a hash of the sorted
+    (name, size, mtime) listing, so added, removed, replaced or touched
+    files all change it without reading any file content.
+    """
+    listing = []
+    for entry in os.scandir(dicom_path):
+        if entry.is_file():
+            stat = entry.stat()
+            listing.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    listing.sort()
+
+    return {
+        "file_count": len(listing),
+        "total_size": sum(size for _, size, _ in listing),
+        "max_mtime_ns": max((mtime for _, _, mtime in listing), default=0),
+        "listing_sha256": hashlib.sha256(json.dumps(listing).encode()).hexdigest()
+    }
+
+def output_fingerprints(root_dir, prefix):
+    """Size and mtime of every file written for an output prefix (dcm2niix -f), relative to root_dir."""
+    paths = glob.glob(f"{glob.escape(prefix)}.*") + glob.glob(f"{glob.escape(prefix)}_*")
+
+    outputs = {}
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            outputs[os.path.relpath(path, root_dir)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    return outputs
+
+def outputs_unchanged(root_dir, outputs):
+    """True if every recorded output exists with its recorded size and mtime."""
+    for rel_path, recorded in outputs.items():
+        path = os.path.join(root_dir, rel_path)
+        if not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != recorded["size"] or stat.st_mtime_ns != recorded["mtime_ns"]:
+            return False
+
+    return True
+
+def load_manifest(manifest_path):
+    """Last manifest entry of every series, as {series: entry} (empty if there is no manifest)."""
+    entries = {}
+    if not os.path.exists(manifest_path):
+        return entries
+
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partial last line of an interrupted run
+                continue
+            entries[entry["series"]] = entry
+
+    return entries
+
+def append_manifest(manifest_path, entry):
+    """Append one entry (a line) to the manifest and flush it to disk."""
+    entry = dict(entry, recorded_at=datetime.datetime.now().isoformat(timespec="seconds"))
+
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def series_is_converted(entry, fingerprint, root_dir):
+    """True if a manifest entry is a successful conversion of this fingerprint whose outputs are intact."""
+    return (
+        entry is not None
+        and entry.get("status") == "ok"
+        and entry.get("fingerprint") == fingerprint
+        and bool(entry.get("outputs"))
+        and outputs_unchanged(root_dir, entry["outputs"])
+    )
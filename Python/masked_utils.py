@@ -0,0 +1,92 @@
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter1d
+from nilearn import signal
+
+from nifti_utils import iter_volumes
+
+# ==========================================
+# In-mask (time x voxel) fMRI representation
+# ==========================================
+# A "masked" run is a dict:
+# - data: float32 array (T x N), one column per in-mask voxel (C order of the mask)
+# - mask: bool array (X x Y x Z)
+# - affine: 4x4 voxel-to-world affine of the mask grid
+# - tr: repetition time in seconds
+# Only in-mask voxels are kept, so it is several times smaller than the
+# 91x109x91 MNI volume in RAM; masked_to_nifti expands it back. On disk it
+# is not smaller than a .nii.gz (whose zeros outside the mask compress to
+# almost nothing): it is an opt-in format (output_format="masked") that
+# saves the time of writing / reading gzip and of re-masking.
+
+def smooth_volume(vol, affine, fwhm):
+    """Gaussian smoothing of a 3D volume in place (same kernel as nilearn.image.smooth_img)."""
+    vox_size = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    sigma = fwhm / (np.sqrt(8 * np.log(2)) * vox_size)
+
+    for axis, s in enumerate(sigma):
+        if s > 0.0:
+            gaussian_filter1d(vol, s, output=vol, axis=axis)
+
+    return vol
+
+def masked_from_nifti(nifti_path, mask_path, fwhm=None):
+    """
+    Build a masked run from a 4D NIfTI, one volume at a time.
+
+    With fwhm, each volume is smoothed over the full grid before masking,
+    which gives the same in-mask values as smooth_img followed by masking.
+    """
+    img = nib.load(nifti_path)
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+    n_vols = img.shape[3]
+
+    data = np.empty((n_vols, int(mask.sum())), dtype=np.float32)
+    for t, vol in enumerate(iter_volumes(nifti_path)):
+        if fwhm is not None:
+            smooth_volume(vol, img.affine, fwhm)
+        data[t] = vol[mask]
+
+    return {"data": data, "mask": mask, "affine": img.affine, "tr": float(img.header.get_zooms()[3])}
+
+def clean_masked(masked, **clean_kwargs):
+    """
+    Detrend / filter / standardize / regress confounds on a masked run.
+
+    Keyword arguments are passed to nilearn.signal.clean (t_r is taken from
+    the run); the result equals clean_img(..., mask_img=mask) restricted to
+    the mask.
+    """
+    data = signal.clean(masked["data"], t_r=masked["tr"], **clean_kwargs)
+    return dict(masked, data=data.astype(np.float32, copy=False))
+
+def save_masked(path, masked, compress=False):
+    """
+    Save a masked run as .npz (data, mask, affine, tr).
+
+    Uncompressed by default: float32 signal barely compresses, so
+    compression only costs time.
+    """
+    savez = np.savez_compressed if compress else np.savez
+    savez(path, data=masked["data"], mask=masked["mask"], affine=masked["affine"], tr=masked["tr"])
+
+def load_masked(path):
+    """Load a masked run saved with save_masked."""
+    with np.load(path) as f:
+        return {"data": f["data"], "mask": f["mask"], "affine": f["affine"], "tr": float(f["tr"])}
+
+def masked_to_nifti(masked):
+    """Expand a masked run back to a 4D float32 NIfTI (zeros outside the mask)."""
+    mask = masked["mask"]
+    n_vols = masked["data"].shape[0]
+
+    data = np.zeros(mask.shape + (n_vols,), dtype=np.float32)
+    data[mask] = masked["data"].T
+
+    img = nib.Nifti1Image(data, masked["affine"])
+    img.header.set_zooms(img.header.get_zooms()[:3] + (masked["tr"],))
+    img.header.set_xyzt_units("mm", "sec")
+    return img
@@ -0,0 +1,117 @@
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import nibabel as nib
+from nibabel.openers import Opener
+
+def _scaling(header):
+    slope, inter = header.get_slope_inter()
+    slope = 1.0 if slope is None else slope
+    inter = 0.0 if inter is None else inter
+    return slope, inter
+
+def source_header(img):
+    """
+    Copy of a loaded image's header with its on-disk scaling restored.
+
+    nibabel moves scl_slope/scl_inter from a loaded header into the array
+    proxy; writing with this header keeps the input's dtype and scaling.
+    """
+    header = img.header.copy()
+    header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    return header
+
+def iter_volumes(nifti_path, dtype=np.float32):
+    """
+    Yield the 3D volumes of a 4D NIfTI one at a time, as writable `dtype` arrays.
+
+    The (gzip) stream is read sequentially, so memory stays at one volume
+    and a .nii.gz is decompressed once no matter how many volumes it has.
+    """
+    proxy = nib.load(nifti_path).dataobj
+    shape = proxy.shape
+    vol_shape = shape[:3]
+    n_vols = shape[3] if len(shape) > 3 else 1
+
+    on_disk_dtype = proxy.dtype
+    slope, inter = float(proxy.slope), float(proxy.inter)
+    vol_bytes = int(np.prod(vol_shape)) * on_disk_dtype.itemsize
+
+    with Opener(nifti_path) as f:
+        f.seek(int(proxy.offset))
+
+        for _ in range(n_vols):
+            raw = np.frombuffer(f.read(vol_bytes), dtype=on_disk_dtype).reshape(vol_shape, order="F")
+            vol = raw.astype(dtype)
+            if slope != 1.0 or inter != 0.0:
+                vol *= slope
+                vol += inter
+            yield vol
+
+def write_volumes(nifti_path, header, volumes):
+    """
+    Write 3D volumes one at a time into a 4D NIfTI.
+
+    Args:
+    - nifti_path (str): Output .nii or .nii.gz path.
+    - header (nib.Nifti1Header): Output header; its shape (including the
+      number of volumes), data dtype, scaling, affine and zooms are used as is.
+    - volumes (iterable): 3D arrays, in order.
+    """
+    header = header.copy()
+    del header.extensions[:]
+    header.set_data_offset(0)  # recomputed by write_to
+
+    shape = header.get_data_shape()
+    n_vols = shape[3] if len(shape) > 3 else 1
+    out_dtype = header.get_data_dtype()
+    slope, inter = _scaling(header)
+    is_int = np.issubdtype(out_dtype, np.integer)
+
+    written = 0
+    with Opener(nifti_path, "wb") as f:
+        header.write_to(f)
+        f.write(b"\x00" * (int(header.get_data_offset()) - f.tell()))
+
+        for vol in volumes:
+            if slope != 1.0 or inter != 0.0:
+                vol = (vol - inter) / slope
+            if is_int:
+                vol = np.rint(vol)
+            f.write(np.asarray(vol).astype(out_dtype).tobytes(order="F"))
+            written += 1
+
+    if written != n_vols:
+        raise ValueError(f"{nifti_path}: header declares {n_vols} volumes but {written} were written")
+
+def mean_volume(nifti_path):
+    """Temporal mean of a 4D NIfTI, computed one volume at a time (float64 accumulator)."""
+    total = None
+    count = 0
+
+    for vol in iter_volumes(nifti_path):
+        if total is None:
+            total = np.zeros(vol.shape, dtype=np.float64)
+        total += vol
+        count += 1
+
+    return total / count
+
+def apply_mask_4d(nifti_path, mask_path, out_path):
+    """
+    Multiply every volume of a 4D NIfTI by a 3D mask, streaming volume by volume.
+
+    Volumes are read as float32 and masked in place; the output keeps the
+    input's header, so its on-disk dtype is not promoted. Peak memory is
+    about one volume plus the mask.
+    """
+    header = source_header(nib.load(nifti_path))
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+
+    def masked_volumes():
+        for vol in iter_volumes(nifti_path):
+            np.multiply(vol, mask, out=vol)
+            yield vol
+
+    write_volumes(out_path, header, masked_volumes())
@@ -0,0 +1,112 @@
+
+# -*- coding: utf-8 -*-
+
+# nohup env PYTHONDONTWRITEBYTECODE=1 python3 pipeline_fMRI_streaming.py > output_pipeline_fMRI_streaming.log 2>&1 < /dev/null &
+
+import os
+import time
+import asyncio
+import nibabel as nib
+
+from logging_utils import setup_logging, log_print
+from scheduling_utils import start_task_stream, stream_task, finish_task_stream, stop_task_stream, load_memory_calibration, terminate_on_sigterm, write_failure_report
+from resource_utils import plan_resources, available_memory
+from manifest_utils import MANIFEST_FILENAME, load_manifest
+from dicom_to_nifti_parallel import select_dicom_series, plan_conversion, conversion_tasks, conversion_failure_rows, convert_series_async
+from preprocessing_fMRI_parallel import fmri_preprocess_file, fmri_task, fmri_memory_kind, preload_fmri_references
+
+# ==========================================
+# Streaming DICOM -> NIfTI -> preprocessing
+# ==========================================
+# Conversion (dcm2niix, I/O bound) and preprocessing (CPU bound) overlap.
+# Conversion runs from an event loop in this process with the async series
+# executor (at most conversion_workers dcm2niix processes); every
+# successfully converted NIfTI is sent at once to a task stream, a process
+# started before the event loop that runs preprocessing with the run_tasks
+# rules (process per file, threads_per_worker, memory budget, timeouts,
+# retries) and its own worker limit, blocking until a task finishes or a new
+# one arrives. Series that were already converted are queued first; their
+# finished preprocessing steps are skipped through the checkpoints.
+
+def fmri_convert_and_preprocess_streaming(dicom_dir, nifti_dir, measurement_type_sequences, ref_template, conversion_workers=8, num_workers=None, threads_per_worker=None, output_format="nifti", write_voxelwise=False, single_interpolation=False, conversion_timeout=None, conversion_retries=0, timeout=None, retries=0, series=None, cohort=None, manifest_path=None, force=False, memory_budget=None, memory_history="memory_history_preprocessing_fMRI_parallel.csv", conversion_failure_report="failures_dicom_to_nifti_parallel.csv", failure_report="failures_preprocessing_fMRI_parallel.csv"):
+    """
+    Convert and preprocess fMRI series as a producer/consumer pipeline.
+
+    Args:
+    - dicom_dir, nifti_dir, measurement_type_sequences, series, cohort, manifest_path, force:
+      As in convert_dicom_to_nifti_parallel.
+    - ref_template, num_workers, threads_per_worker, output_format, write_voxelwise,
+      single_interpolation, memory_budget, memory_history: As in fmri_preprocess_all_subjects_parallel.
+    - conversion_workers (int): Concurrent dcm2niix processes.
+    - conversion_timeout, conversion_retries: Per series (conversion).
+    - timeout, retries: Per file (preprocessing).
+    """
+    start = time.monotonic()
+    manifest_path = manifest_path or os.path.join(nifti_dir, MANIFEST_FILENAME)
+
+    num_workers, threads_per_worker = plan_resources(num_workers, threads_per_worker)
+    memory_budget = memory_budget or int(0.9 * available_memory())
+    ref_shape = nib.load(ref_template).shape[:3]
+    kwargs = {"output_format": output_format, "write_voxelwise": write_voxelwise, "single_interpolation": single_interpolation}
+    calibration = load_memory_calibration(memory_history, kind=fmri_memory_kind(kwargs))
+
+    series = select_dicom_series(dicom_dir, measurement_type_sequences, series, cohort)
+    to_convert, up_to_date = plan_conversion(series, dicom_dir, nifti_dir, manifest_path, force)
+    conversion_order = [(task["args"][:4], task["kwargs"]["fingerprint"]) for task in conversion_tasks(to_convert, dicom_dir, nifti_dir)]
+
+    # Loaded once here and shared copy-on-write by the stream's forked tasks
+    preload_fmri_references(ref_template, output_format)
+
+    stream = start_task_stream(fmri_preprocess_file, num_workers, timeout, retries, threads_per_worker, memory_budget, memory_history)
+
+    def enqueue(series_name, outputs):
+        subject_id = series_name.split(os.sep)[0]
+        for rel_path in sorted(outputs):
+            if rel_path.endswith(".nii.gz"):
+                task = fmri_task(subject_id, os.path.join(nifti_dir, rel_path), ref_template, ref_shape, calibration, kwargs)
+                task["args"] += (f"task {stream['submitted'] + 1}", threads_per_worker)
+                stream_task(stream, task)
+
+    def on_converted(entry):
+        if entry["status"] == "ok":
+            enqueue(entry["series"], entry["outputs"])
+
+    log_print(f"Pipeline: {len(conversion_order)} series to convert ({conversion_workers} at a time), {len(up_to_date)} already converted; preprocessing with {num_workers} workers x {threads_per_worker} threads")
+    log_print(f"Memory budget: {memory_budget / 1024**3:.1f} GiB (estimate calibration x{calibration:.2f})")
+
+    # On SIGTERM the stream is terminated, which kills the running preprocessing tasks
+    with terminate_on_sigterm():
+        try:
+            manifest = load_manifest(manifest_path)
+            for converted in up_to_date:
+                enqueue(os.path.join(*converted), manifest[os.path.join(*converted)]["outputs"])
+
+            conversion_failures = asyncio.run(convert_series_async(
+                conversion_order, dicom_dir, nifti_dir, manifest_path, conversion_workers,
+                timeout=conversion_timeout, retries=conversion_retries, on_entry=on_converted
+            ))
+            failures = finish_task_stream(stream)
+        finally:
+            stop_task_stream(stream)
+
+    if conversion_failure_report is not None:
+        write_failure_report(conversion_failure_report, conversion_failure_rows(conversion_failures))
+    if failure_report is not None:
+        write_failure_report(failure_report, failures)
+
+    log_print(f"Conversion: {len(conversion_failures)} of {len(conversion_order)} series failed")
+    log_print(f"Preprocessing: {len(failures)} of {stream['submitted']} files failed")
+    log_print(f"Pipeline completed in {(time.monotonic() - start) / 60:.1f} min")
+
+if __name__ == "__main__":
+
+    setup_logging("output_pipeline_fMRI_streaming.log")
+
+    fmri_convert_and_preprocess_streaming(
+        dicom_dir="/root/data/ADNI/example/fMRI/dicom",
+        nifti_dir="/root/data/ADNI/example/fMRI/nifti",
+        measurement_type_sequences=["Axial_HB_rsfMRI__Eyes_Open___MSV22_"],
+        ref_template="/usr/lib/fsl/5.0/data/standard/MNI152_T1_2mm_brain.nii.gz",
+        conversion_workers=8,
+        threads_per_worker=2
+    )
@@ -6,11 +6,12 @@
 import os
 import glob
 import nibabel as nib
-from nipype.interfaces.fsl import BET, FAST, FNIRT, ApplyWarp
+from nipype.interfaces.fsl import BET, FAST, FNIRT
 from nipype.interfaces.ants import N4BiasFieldCorrection
 from nilearn.image import smooth_img
 
 from logging_utils import setup_logging, log_print
+from transform_utils import apply_fsl_warp_batch, save_fsl_warp
 
 setup_logging("output_preprocessing_MRI.log")
 
@@ -186,29 +187,27 @@ def preprocess_subject(subject_path, measurement_type, ref_template, total_subje
         fnirt.inputs.log_file = os.path.join(output_dir, f"FNIRT_log_{file_id}.txt")
         fnirt_result = fnirt.run()
 
+        # Warp and its inverse kept in <output_dir>/transforms (see apply_saved_transforms.py)
+        save_fsl_warp(output_dir, "mni", fnirt_result.outputs.fieldcoeff_file, ref_template, os.path.join(output_dir, f"brain_n4_{file_id}.nii.gz"))
+
         pve_types = {
             "CSF": f"{output_dir}/brain_n4_{file_id}_pve_0.nii.gz",
             "GM":  f"{output_dir}/brain_n4_{file_id}_pve_1.nii.gz",
             "WM":  f"{output_dir}/brain_n4_{file_id}_pve_2.nii.gz"
         }
 
-        for tissue, pve_path in pve_types.items():
-            output_pve_mni = os.path.join(output_dir, f"brain_n4_{file_id}_pve_{tissue}_mni.nii.gz")
-            applywarp = ApplyWarp()
-            applywarp.inputs.in_file = pve_path
-            applywarp.inputs.ref_file = ref_template
-            applywarp.inputs.field_file = fnirt_result.outputs.fieldcoeff_file
-            applywarp.inputs.out_file = output_pve_mni
-            applywarp.inputs.interp = "trilinear"
-            applywarp.run()
-
-        applywarp = ApplyWarp()
-        applywarp.inputs.in_file = os.path.join(output_dir, f"brain_n4_{file_id}_mask.nii.gz")
-        applywarp.inputs.ref_file = ref_template
-        applywarp.inputs.field_file = fnirt_result.outputs.fieldcoeff_file
-        applywarp.inputs.out_file = os.path.join(output_dir, f"brain_n4_{file_id}_mask_mni.nii.gz")
-        applywarp.inputs.interp = "nn"
-        applywarp.run()
+        # PVE maps and mask warped concurrently through the same FNIRT warp
+        warp_images = [
+            (pve_path, os.path.join(output_dir, f"brain_n4_{file_id}_pve_{tissue}_mni.nii.gz"), "trilinear")
+            for tissue, pve_path in pve_types.items()
+        ]
+        warp_images.append((
+            os.path.join(output_dir, f"brain_n4_{file_id}_mask.nii.gz"),
+            os.path.join(output_dir, f"brain_n4_{file_id}_mask_mni.nii.gz"),
+            "nn"
+        ))
+
+        apply_fsl_warp_batch(ref_template, fnirt_result.outputs.fieldcoeff_file, warp_images, num_workers=len(warp_images))
 
         # Step 5: Smoothing (Gaussian Smoothing)
         log_print(f"Step 5/5: Applying Gaussian Smoothing - {file_id}")
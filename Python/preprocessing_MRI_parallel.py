@@ -5,128 +5,316 @@
 
 import os
 import glob
-import multiprocessing
+import tempfile
+import numpy as np
 import nibabel as nib
 from nipype.interfaces.fsl import BET, FAST
 from nipype.interfaces.ants import N4BiasFieldCorrection
 from nilearn.image import smooth_img
 
 import ants
+import nipype
+import nilearn
 
 from logging_utils import setup_logging, log_print
-
-setup_logging("output_preprocessing_MRI_parallel.log")
-
-def mri_preprocess_subject(subject_id, base_dir, measurement_type, ref_template, total_subjects, subject_index):
-    """Preprocess all NIfTI files for a given subject."""
-    subject_path = os.path.join(base_dir, subject_id)
-    measurement_path = os.path.join(subject_path, measurement_type)
-
-    if not os.path.exists(measurement_path):
-        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No {measurement_type} folder")
+from cohort_utils import load_cohort_manifest, cohort_subjects, filter_by_cohort, nifti_file_key
+from scheduling_utils import list_nifti_files, estimate_nifti_cost, order_by_cost, run_tasks
+from resource_utils import plan_resources, step_threads, thread_limits
+from masked_utils import smooth_volume
+from reference_utils import get_template, get_template_data, preload_references
+from transform_utils import apply_transforms_batch, registration_prefix, save_transforms, transform_files
+from checkpoint_utils import step_is_done, mark_step_done, fsl_version
+
+# Artifacts of the in-memory chain (mri_preprocess_file_in_memory) and the
+# ones written by default
+IN_MEMORY_ARTIFACTS = ("n4", "brain", "brain_mask", "pve", "brain_mni", "mask_mni", "pve_mni", "smoothed")
+IN_MEMORY_KEEP = ("brain_mni", "mask_mni", "pve_mni", "smoothed")
+
+def mri_preprocess_file_in_memory(subject_id, input_nifti, ref_template, progress="", threads=1, keep=IN_MEMORY_KEEP):
+    """
+    Preprocess a single NIfTI file with the steps chained in memory.
+
+    N4 runs in-process (ants.n4_bias_field_correction) and every image is
+    passed on as an ANTsImage; only BET and FAST, which need files, get
+    uncompressed scratch copies in a temporary directory. The artifacts
+    listed in keep (see IN_MEMORY_ARTIFACTS) are written compressed at the
+    end, under the same names as mri_preprocess_file; the whole chain has a
+    single checkpoint.
+    """
+    unknown = set(keep) - set(IN_MEMORY_ARTIFACTS)
+    if unknown:
+        raise ValueError(f"Unknown artifacts to keep: {sorted(unknown)}")
+
+    file_id = os.path.basename(input_nifti).replace(".nii.gz", "")
+    output_dir = os.path.join(os.path.dirname(input_nifti), "preprocessed", file_id)
+    os.makedirs(output_dir, exist_ok=True)
+
+    log_print(f"Processing {subject_id} ({progress}): {file_id} (in memory)")
+
+    tissues = {"CSF": 0, "GM": 1, "WM": 2}
+    artifact_paths = {
+        "n4": {"n4": os.path.join(output_dir, f"n4_{file_id}.nii.gz")},
+        "brain": {"brain": os.path.join(output_dir, f"brain_n4_{file_id}.nii.gz")},
+        "brain_mask": {"brain_mask": os.path.join(output_dir, f"brain_n4_{file_id}_mask.nii.gz")},
+        "pve": {f"pve_{tissue}": os.path.join(output_dir, f"brain_n4_{file_id}_pve_{index}.nii.gz") for tissue, index in tissues.items()},
+        "brain_mni": {"brain_mni": os.path.join(output_dir, f"brain_mni_{file_id}.nii.gz")},
+        "mask_mni": {"mask_mni": os.path.join(output_dir, f"brain_n4_{file_id}_mask_mni.nii.gz")},
+        "pve_mni": {f"pve_{tissue}_mni": os.path.join(output_dir, f"brain_n4_{file_id}_pve_{tissue}_mni.nii.gz") for tissue in tissues},
+        "smoothed": {"smoothed": os.path.join(output_dir, f"brain_smoothed_{file_id}.nii.gz")}
+    }
+    kept_paths = {name: path for artifact in keep for name, path in artifact_paths[artifact].items()}
+
+    chain_inputs = [input_nifti, ref_template]
+    chain_outputs = list(kept_paths.values())
+    chain_params = {"keep": sorted(keep), "number_classes": 3, "type_of_transform": "Affine", "fwhm": 2}
+    chain_version = {"antspy": ants.__version__, "nipype": nipype.__version__, "fsl": fsl_version()}
+
+    if step_is_done(output_dir, "in_memory_chain", chain_inputs, chain_outputs + transform_files(output_dir, "mni"), params=chain_params, tool_version=chain_version):
+        log_print(f"Steps 1-5/5: In-memory chain - {file_id} (checkpoint found, skipped)")
+        log_print(f"Completed processing: {file_id}\n")
         return
 
-    nifti_files = sorted(glob.glob(os.path.join(measurement_path, "*.nii.gz")))
+    images = {}
 
-    if len(nifti_files) == 0:
-        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No NIfTI file found")
-        return
+    with tempfile.TemporaryDirectory(prefix=f"mri_{file_id}_") as scratch_dir:
+        n4_scratch = os.path.join(scratch_dir, "n4.nii")
+        brain_scratch = os.path.join(scratch_dir, "brain_n4.nii")
 
-    for file_index, input_nifti in enumerate(nifti_files, start=1):
-        file_id = os.path.basename(input_nifti).replace(".nii.gz", "")
-        output_dir = os.path.join(measurement_path, "preprocessed", file_id)
-        os.makedirs(output_dir, exist_ok=True)
+        # Step 1: Bias Field Correction (N4ITK - ANTs, in-process)
+        log_print(f"Step 1/5: Bias Field Correction (N4ITK) - {file_id}")
+        # ANTsPy reads its ITK thread count from the task's environment (set by run_tasks)
+        images["n4"] = ants.n4_bias_field_correction(ants.image_read(input_nifti))
+        ants.image_write(images["n4"], n4_scratch)
 
-        log_print(f"Processing {subject_id} ({subject_index}/{total_subjects}) - File {file_index}/{len(nifti_files)}: {file_id}")
+        # Step 2: Skull Stripping (BET - Brain Extraction)
+        log_print(f"Step 2/5: Skull Stripping (BET) - {file_id}")
+        bet = BET(in_file=n4_scratch, out_file=brain_scratch, mask=True, output_type="NIFTI")
+        with thread_limits(step_threads("bet", threads)):
+            bet.run()
+        images["brain"] = ants.image_read(brain_scratch)
+        images["brain_mask"] = ants.image_read(os.path.join(scratch_dir, "brain_n4_mask.nii"))
 
-        # Step 1: Bias Field Correction (N4ITK - ANTs)
+        # Step 3: Tissue Segmentation (FAST - FSL)
+        log_print(f"Step 3/5: Tissue Segmentation (FAST) - {file_id}")
+        fast = FAST(in_files=brain_scratch, out_basename=os.path.join(scratch_dir, "brain_n4"), number_classes=3, output_type="NIFTI")
+        with thread_limits(step_threads("fast", threads)):
+            fast.run()
+        for tissue, index in tissues.items():
+            images[f"pve_{tissue}"] = ants.image_read(os.path.join(scratch_dir, f"brain_n4_pve_{index}.nii"))
+
+    # Step 4: Spatial Normalization (ANTs)
+    log_print(f"Step 4/5: Spatial Normalization (ANTs - Affine) - {file_id}")
+    fixed_ref_template = get_template(ref_template)
+
+    reg = ants.registration(
+        fixed=fixed_ref_template,
+        moving=images["brain"],
+        type_of_transform="Affine",
+        outprefix=registration_prefix(output_dir, "mni")
+    )
+    images["brain_mni"] = reg["warpedmovout"]
+    save_transforms(output_dir, "mni", reg, fixed=ref_template, moving=kept_paths.get("brain", images["brain"]))
+
+    warped = apply_transforms_batch(
+        fixed_ref_template,
+        [(images[f"pve_{tissue}"], "linear") for tissue in tissues] + [(images["brain_mask"], "nearestNeighbor")],
+        transformlist=reg["fwdtransforms"],
+        num_threads=step_threads("apply_transforms", threads)
+    )
+    for tissue, warped_pve in zip(tissues, warped):
+        images[f"pve_{tissue}_mni"] = warped_pve
+    images["mask_mni"] = warped[-1]
+
+    # Step 5: Smoothing (Gaussian Smoothing, same kernel as nilearn.image.smooth_img)
+    log_print(f"Step 5/5: Applying Gaussian Smoothing - {file_id}")
+    template_affine = get_template_data(ref_template)[1].affine
+    with thread_limits(step_threads("nilearn", threads)):
+        smoothed = smooth_volume(images["brain_mni"].numpy().astype(np.float32), template_affine, fwhm=2)
+    images["smoothed"] = images["brain_mni"].new_image_like(smoothed)
+
+    # Kept artifacts, written once
+    for name, path in kept_paths.items():
+        ants.image_write(images[name], path)
+
+    mark_step_done(output_dir, "in_memory_chain", chain_inputs, chain_outputs + transform_files(output_dir, "mni"), params=chain_params, tool_version=chain_version)
+    log_print(f"Completed processing: {file_id}\n")
+
+def mri_preprocess_file(subject_id, input_nifti, ref_template, progress="", threads=1, in_memory=False, keep=IN_MEMORY_KEEP):
+    """
+    Preprocess a single NIfTI file using up to `threads` threads per step.
+
+    With in_memory, the steps are chained in memory and only the artifacts in
+    keep are written (see mri_preprocess_file_in_memory).
+    """
+    if in_memory:
+        return mri_preprocess_file_in_memory(subject_id, input_nifti, ref_template, progress=progress, threads=threads, keep=keep)
+
+    file_id = os.path.basename(input_nifti).replace(".nii.gz", "")
+    output_dir = os.path.join(os.path.dirname(input_nifti), "preprocessed", file_id)
+    os.makedirs(output_dir, exist_ok=True)
+
+    log_print(f"Processing {subject_id} ({progress}): {file_id}")
+
+    n4_path = os.path.join(output_dir, f"n4_{file_id}.nii.gz")
+    brain_path = os.path.join(output_dir, f"brain_n4_{file_id}.nii.gz")
+    brain_mask_path = os.path.join(output_dir, f"brain_n4_{file_id}_mask.nii.gz")
+    brain_mni_path = os.path.join(output_dir, f"brain_mni_{file_id}.nii.gz")
+    output_mask_mni = os.path.join(output_dir, f"brain_n4_{file_id}_mask_mni.nii.gz")
+    smoothed_path = os.path.join(output_dir, f"brain_smoothed_{file_id}.nii.gz")
+
+    pve_types = {
+        "CSF": f"{output_dir}/brain_n4_{file_id}_pve_0.nii.gz",
+        "GM":  f"{output_dir}/brain_n4_{file_id}_pve_1.nii.gz",
+        "WM":  f"{output_dir}/brain_n4_{file_id}_pve_2.nii.gz"
+    }
+    pve_mni_paths = {tissue: os.path.join(output_dir, f"brain_n4_{file_id}_pve_{tissue}_mni.nii.gz") for tissue in pve_types}
+
+    nipype_fsl_version = {"nipype": nipype.__version__, "fsl": fsl_version()}
+    # N4 is the ANTs command line tool (through nipype), step 4 is ANTsPy
+    nipype_ants_version = {"nipype": nipype.__version__, "ants": N4BiasFieldCorrection().version}
+    ants_version = {"antspy": ants.__version__}
+
+    # Step 1: Bias Field Correction (N4ITK - ANTs)
+    if step_is_done(output_dir, "step1_n4", [input_nifti], [n4_path], tool_version=nipype_ants_version):
+        log_print(f"Step 1/5: Bias Field Correction (N4ITK) - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 1/5: Bias Field Correction (N4ITK) - {file_id}")
         n4 = N4BiasFieldCorrection(
             input_image=input_nifti,
-            output_image=os.path.join(output_dir, f"n4_{file_id}.nii.gz")
+            output_image=n4_path,
+            num_threads=step_threads("n4", threads)
         )
         n4.run()
+        mark_step_done(output_dir, "step1_n4", [input_nifti], [n4_path], tool_version=nipype_ants_version)
 
-        # Step 2: Skull Stripping (BET - Brain Extraction)
+    # Step 2: Skull Stripping (BET - Brain Extraction)
+    if step_is_done(output_dir, "step2_bet", [n4_path], [brain_path, brain_mask_path], params={"mask": True}, tool_version=nipype_fsl_version):
+        log_print(f"Step 2/5: Skull Stripping (BET) - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 2/5: Skull Stripping (BET) - {file_id}")
-        bet = BET(in_file=os.path.join(output_dir, f"n4_{file_id}.nii.gz"), out_file=os.path.join(output_dir, f"brain_n4_{file_id}.nii.gz"), mask=True)
-        bet.run()
-
-        # Step 3: Tissue Segmentation (FAST - FSL)
+        bet = BET(in_file=n4_path, out_file=brain_path, mask=True)
+        with thread_limits(step_threads("bet", threads)):
+            bet.run()
+        mark_step_done(output_dir, "step2_bet", [n4_path], [brain_path, brain_mask_path], params={"mask": True}, tool_version=nipype_fsl_version)
+
+    # Step 3: Tissue Segmentation (FAST - FSL)
+    if step_is_done(output_dir, "step3_fast", [brain_path], list(pve_types.values()), params={"number_classes": 3}, tool_version=nipype_fsl_version):
+        log_print(f"Step 3/5: Tissue Segmentation (FAST) - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 3/5: Tissue Segmentation (FAST) - {file_id}")
-        fast = FAST(in_files=os.path.join(output_dir, f"brain_n4_{file_id}.nii.gz"), number_classes=3)
-        fast.run()
-
-        # Step 4: Spatial Normalization (ANTs)
+        fast = FAST(in_files=brain_path, number_classes=3)
+        with thread_limits(step_threads("fast", threads)):
+            fast.run()
+        mark_step_done(output_dir, "step3_fast", [brain_path], list(pve_types.values()), params={"number_classes": 3}, tool_version=nipype_fsl_version)
+
+    # Step 4: Spatial Normalization (ANTs)
+    step4_inputs = [ref_template, brain_path, brain_mask_path] + list(pve_types.values())
+    step4_outputs = [brain_mni_path, output_mask_mni] + list(pve_mni_paths.values())
+    step4_params = {"type_of_transform": "Affine"}
+
+    if step_is_done(output_dir, "step4_ants", step4_inputs, step4_outputs + transform_files(output_dir, "mni"), params=step4_params, tool_version=ants_version):
+        log_print(f"Step 4/5: Spatial Normalization (ANTs - Affine) - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 4/5: Spatial Normalization (ANTs - Affine) - {file_id}")
 
-        fixed_ref_template = ants.image_read(ref_template)
+        # ANTsPy reads its ITK thread count from the task's environment (set by run_tasks)
+        fixed_ref_template = get_template(ref_template)
 
         reg = ants.registration(
             fixed=fixed_ref_template,
-            moving=ants.image_read(os.path.join(output_dir, f"brain_n4_{file_id}.nii.gz")),
-            type_of_transform="Affine"
+            moving=ants.image_read(brain_path),
+            type_of_transform="Affine",
+            outprefix=registration_prefix(output_dir, "mni")
         )
 
-        brain_mni_path = os.path.join(output_dir, f"brain_mni_{file_id}.nii.gz")
         reg["warpedmovout"].to_filename(brain_mni_path)
+        save_transforms(output_dir, "mni", reg, fixed=ref_template, moving=brain_path)
 
-        pve_types = {
-            "CSF": f"{output_dir}/brain_n4_{file_id}_pve_0.nii.gz",
-            "GM":  f"{output_dir}/brain_n4_{file_id}_pve_1.nii.gz",
-            "WM":  f"{output_dir}/brain_n4_{file_id}_pve_2.nii.gz"
-        }
-
-        for tissue, pve_path in pve_types.items():
-            warped_pve = ants.apply_transforms(
-                fixed=fixed_ref_template,
-                moving=ants.image_read(pve_path),
-                transformlist=reg["fwdtransforms"],
-                interpolator="linear",
-                imagetype=0
-            )
-
-            output_pve_mni = os.path.join(output_dir, f"brain_n4_{file_id}_pve_{tissue}_mni.nii.gz")
-            warped_pve.to_filename(output_pve_mni)
-
-        mask_img = ants.image_read(os.path.join(output_dir, f"brain_n4_{file_id}_mask.nii.gz"))
-        warped_mask = ants.apply_transforms(
-            fixed=fixed_ref_template,
-            moving=mask_img,
+        # PVE maps and mask warped together through the same transform
+        apply_transforms_batch(
+            fixed_ref_template,
+            [(pve_path, "linear") for pve_path in pve_types.values()] + [(brain_mask_path, "nearestNeighbor")],
             transformlist=reg["fwdtransforms"],
-            interpolator="nearestNeighbor",
-            imagetype=0
+            out_paths=[pve_mni_paths[tissue] for tissue in pve_types] + [output_mask_mni],
+            num_threads=step_threads("apply_transforms", threads)
         )
+        mark_step_done(output_dir, "step4_ants", step4_inputs, step4_outputs + transform_files(output_dir, "mni"), params=step4_params, tool_version=ants_version)
 
-        output_mask_mni = os.path.join(output_dir, f"brain_n4_{file_id}_mask_mni.nii.gz")
-        warped_mask.to_filename(output_mask_mni)
-
-        # Step 5: Smoothing (Gaussian Smoothing)
+    # Step 5: Smoothing (Gaussian Smoothing)
+    if step_is_done(output_dir, "step5_smooth", [brain_mni_path], [smoothed_path], params={"fwhm": 2}, tool_version={"nilearn": nilearn.__version__}):
+        log_print(f"Step 5/5: Applying Gaussian Smoothing - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 5/5: Applying Gaussian Smoothing - {file_id}")
-        smoothed_img = smooth_img(os.path.join(output_dir, f"brain_mni_{file_id}.nii.gz"), fwhm=2)
-        nib.save(smoothed_img, os.path.join(output_dir, f"brain_smoothed_{file_id}.nii.gz"))
+        with thread_limits(step_threads("nilearn", threads)):
+            smoothed_img = smooth_img(brain_mni_path, fwhm=2)
+        nib.save(smoothed_img, smoothed_path)
+        mark_step_done(output_dir, "step5_smooth", [brain_mni_path], [smoothed_path], params={"fwhm": 2}, tool_version={"nilearn": nilearn.__version__})
 
-        log_print(f"Completed processing: {file_id}\n")
+    log_print(f"Completed processing: {file_id}\n")
+
+def mri_preprocess_subject(subject_id, base_dir, measurement_type, ref_template, total_subjects, subject_index):
+    """Preprocess all NIfTI files for a given subject."""
+    subject_path = os.path.join(base_dir, subject_id)
+    measurement_path = os.path.join(subject_path, measurement_type)
 
-def mri_preprocess_all_subjects_parallel(base_dir, measurement_type, ref_template, num_workers):
-    """Preprocess all subjects in parallel using multiprocessing."""
-    subject_list = sorted([s for s in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, s))])
-    total_subjects = len(subject_list)
+    if not os.path.exists(measurement_path):
+        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No {measurement_type} folder")
+        return
 
-    log_print(f"Starting parallel MRI Preprocessing for {total_subjects} subjects using {num_workers} workers...\n")
+    nifti_files = sorted(glob.glob(os.path.join(measurement_path, "*.nii.gz")))
 
-    with multiprocessing.Pool(processes=num_workers) as pool:
-        pool.starmap(mri_preprocess_subject, [(subject, base_dir, measurement_type, ref_template, total_subjects, i+1) for i, subject in enumerate(subject_list)])
+    if len(nifti_files) == 0:
+        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No NIfTI file found")
+        return
+
+    for file_index, input_nifti in enumerate(nifti_files, start=1):
+        mri_preprocess_file(subject_id, input_nifti, ref_template, progress=f"{subject_index}/{total_subjects} - File {file_index}/{len(nifti_files)}")
+
+def mri_preprocess_all_subjects_parallel(base_dir, measurement_type, ref_template, num_workers=None, threads_per_worker=None, in_memory=False, keep=IN_MEMORY_KEEP, timeout=None, retries=0, failure_report="failures_preprocessing_MRI_parallel.csv", cohort=None):
+    """
+    Preprocess all NIfTI files of all subjects in parallel, one file per task, most expensive first.
+
+    The node's cores are split between num_workers concurrent files and
+    threads_per_worker threads per file (see resource_utils.plan_resources).
+    With in_memory, each file runs the in-memory chain and writes only the
+    artifacts in keep. With cohort (a cohort manifest, see cohort_utils),
+    only the files it lists are preprocessed.
+    """
+    num_workers, threads_per_worker = plan_resources(num_workers, threads_per_worker)
+    if cohort is not None:
+        # Only the scans listed in the cohort manifest, in place in base_dir
+        manifest = load_cohort_manifest(cohort)
+        nifti_files = filter_by_cohort(list_nifti_files(base_dir, measurement_type, subject_list=cohort_subjects(manifest)), manifest, nifti_file_key, label="NIfTI files")
+    else:
+        nifti_files = list_nifti_files(base_dir, measurement_type)
+    total_subjects = len(set(subject_id for subject_id, _ in nifti_files))
+
+    tasks = order_by_cost([
+        {"name": os.path.join(subject_id, os.path.basename(nifti_path)), "args": (subject_id, nifti_path, ref_template), "cost": estimate_nifti_cost(nifti_path)}
+        for subject_id, nifti_path in nifti_files
+    ])
+    for task_index, task in enumerate(tasks, start=1):
+        task["args"] += (f"task {task_index}/{len(tasks)}", threads_per_worker)
+        task["kwargs"] = {"in_memory": in_memory, "keep": keep}
+
+    log_print(f"Starting parallel MRI Preprocessing for {len(tasks)} files of {total_subjects} subjects using {num_workers} workers x {threads_per_worker} threads...\n")
+
+    # Loaded once here and shared copy-on-write by the forked tasks
+    preload_references(ref_template)
+
+    run_tasks(mri_preprocess_file, tasks, num_workers, timeout=timeout, retries=retries, failure_report=failure_report, threads_per_worker=threads_per_worker)
 
     log_print("All MRI Preprocessing Completed!")
 
 if __name__ == "__main__":
 
-    NUM_CORES = 10
+    setup_logging("output_preprocessing_MRI_parallel.log")
+
+    THREADS_PER_WORKER = 4 # N4 and ANTs registration scale with threads; BET/FAST run single-threaded
 
     mri_preprocess_all_subjects_parallel(
         base_dir="/root/data/ADNI/example/MRI/nifti/",
         measurement_type="Accelerated_Sagittal_MPRAGE__MSV22_",
         ref_template="/usr/lib/fsl/5.0/data/standard/MNI152_T1_2mm_brain.nii.gz",
-        num_workers=NUM_CORES
+        threads_per_worker=THREADS_PER_WORKER
     )
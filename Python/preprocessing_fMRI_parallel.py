@@ -5,119 +5,263 @@
 
 import os
 import glob
-import multiprocessing
 import pandas as pd
 import numpy as np
 import nibabel as nib
 from nipype.interfaces.fsl import BET, MCFLIRT, SliceTimer
-from nilearn.image import smooth_img, mean_img, clean_img
+from nilearn.image import smooth_img, clean_img
+from nilearn import signal
 
 import ants
+import nipype
+import nilearn
 
 from logging_utils import setup_logging, log_print
-
-setup_logging("output_preprocessing_fMRI_parallel.log")
-
-def fmri_preprocess_subject(subject_id, base_dir, measurement_type, ref_template, total_subjects, subject_index):
-    """Preprocess all NIfTI files for a given subject."""
-    subject_path = os.path.join(base_dir, subject_id)
-    measurement_path = os.path.join(subject_path, measurement_type)
-
-    if not os.path.exists(measurement_path):
-        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No {measurement_type} folder")
-        return
-
-    nifti_files = sorted(glob.glob(os.path.join(measurement_path, "*.nii.gz")))
-
-    if len(nifti_files) == 0:
-        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No NIfTI file found")
-        return
-
-    for file_index, input_nifti in enumerate(nifti_files, start=1):
-        file_id = os.path.basename(input_nifti).replace(".nii.gz", "")
-        output_dir = os.path.join(measurement_path, "preprocessed", file_id)
-        os.makedirs(output_dir, exist_ok=True)
-
-        log_print(f"Processing {subject_id} ({subject_index}/{total_subjects}) - File {file_index}/{len(nifti_files)}: {file_id}")
-
-        # Step 1: Slice Timing Correction
+from cohort_utils import load_cohort_manifest, cohort_subjects, filter_by_cohort, nifti_file_key
+from scheduling_utils import list_nifti_files, estimate_nifti_cost, estimate_fmri_memory, load_memory_calibration, order_by_cost, run_tasks
+from resource_utils import plan_resources, available_memory, step_threads, thread_limits
+from nifti_utils import mean_volume, apply_mask_4d
+from transform_utils import warp_4d_chunked, warp_4d_single_interpolation, registration_prefix, save_transforms, transform_files, reapply_transforms
+from masked_utils import masked_from_nifti, clean_masked, save_masked, load_masked, masked_to_nifti
+from atlas_utils import AAL_ATLAS_PATH, AAL_LABEL_PATH, masked_roi_timeseries, roi_timeseries_from_nifti
+from reference_utils import get_template, get_aal_labels, get_atlas_index, preload_references
+from checkpoint_utils import step_is_done, mark_step_done, fsl_version
+
+def fmri_fused_tail(brain_mni_path, mni_mask_path, confounds_path, atlas_path, atlas_label_path, fwhm, clean_params, roi_ts_path, filtered_path=None):
+    """
+    Smoothing, band-pass filtering and ROI reduction in one in-memory pass.
+
+    The MNI run is streamed and smoothed volume by volume into its in-mask
+    representation, cleaned, and reduced to atlas ROI time series (written
+    as a TSV, one column per ROI). The voxelwise band-pass filtered image is
+    only written when filtered_path is given.
+    """
+    masked = masked_from_nifti(brain_mni_path, mni_mask_path, fwhm=fwhm)
+    filtered = clean_masked(masked, confounds=confounds_path, **clean_params)
+
+    # Atlas index on the template grid, preloaded in the parent (see preload_fmri_references)
+    roi_df = masked_roi_timeseries(filtered, get_atlas_index(atlas_path, atlas_label_path, mni_mask_path))
+    roi_df.to_csv(roi_ts_path, sep="\t", index=False)
+
+    if filtered_path is not None:
+        nib.save(masked_to_nifti(filtered), filtered_path)
+
+def fmri_native_roi_tail(motion_out, mask_path, atlas_native_path, confounds_path, atlas_path, atlas_label_path, clean_params, roi_ts_path):
+    """
+    ROI time series extracted in native EPI space, then cleaned.
+
+    The motion corrected run is streamed and reduced to the mean of each
+    atlas ROI within the brain mask, using the atlas warped to the run's
+    grid; detrending, band-pass filtering, confound regression and
+    standardization are applied to the ROI time series (written as a TSV).
+    Every AAL ROI gets a column, NaN if it has no voxel in the field of view.
+    """
+    atlas_native = np.rint(np.asanyarray(nib.load(atlas_native_path).dataobj)).astype(np.int32)
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+    labels = np.unique(np.asanyarray(nib.load(atlas_path).dataobj).astype(np.int32))
+
+    roi_df = roi_timeseries_from_nifti(motion_out, atlas_native, get_aal_labels(atlas_label_path), mask=mask, labels=labels)
+
+    tr = float(nib.load(motion_out).header.get_zooms()[3])
+    observed = roi_df.columns[roi_df.notna().all()]
+    roi_df[observed] = signal.clean(roi_df[observed].to_numpy(), t_r=tr, confounds=confounds_path, **clean_params)
+    roi_df.to_csv(roi_ts_path, sep="\t", index=False)
+
+def fmri_preprocess_file(subject_id, input_nifti, ref_template, progress="", threads=1, output_format="nifti", write_voxelwise=False, single_interpolation=False, atlas_path=AAL_ATLAS_PATH, atlas_label_path=AAL_LABEL_PATH):
+    """
+    Preprocess a single NIfTI file using up to `threads` threads per step.
+
+    output_format="nifti" writes the smoothed and band-pass filtered runs as
+    4D NIfTI; "masked" keeps only in-mask voxels (see masked_utils) and writes
+    brain_smoothed_<file_id>_masked.npz / bandpass_filtered_<file_id>_masked.npz;
+    "fused" runs steps 5-6 and the atlas ROI extraction in one pass
+    (fmri_fused_tail) and writes roi_AAL_timeseries_<file_id>.tsv, plus
+    bandpass_filtered_<file_id>.nii.gz if write_voxelwise; "native" never
+    resamples the run: the AAL atlas is warped to the native EPI grid with
+    the inverse registration (nearest neighbour) and ROI time series are
+    extracted there (fmri_native_roi_tail), written as
+    roi_AAL_timeseries_native_<file_id>.tsv.
+
+    With single_interpolation, MCFLIRT's per-volume matrices are composed
+    with the ANTs affine and the slice-time corrected run is resampled once,
+    straight into MNI space (transform_utils.warp_4d_single_interpolation);
+    brain_<file_id>.nii.gz is not written.
+    """
+    if output_format not in ("nifti", "masked", "fused", "native"):
+        raise ValueError(f"Unknown output_format: {output_format}")
+
+    file_id = os.path.basename(input_nifti).replace(".nii.gz", "")
+    output_dir = os.path.join(os.path.dirname(input_nifti), "preprocessed", file_id)
+    os.makedirs(output_dir, exist_ok=True)
+
+    log_print(f"Processing {subject_id} ({progress}): {file_id}")
+
+    stc_path = os.path.join(output_dir, f"slice_time_corrected_{file_id}.nii.gz")
+    motion_out = os.path.join(output_dir, f"motion_corrected_{file_id}.nii.gz")
+    motion_par_path = os.path.join(output_dir, f"motion_corrected_{file_id}.nii.gz.par")
+    motion_mat_dir = os.path.join(output_dir, f"motion_corrected_{file_id}.nii.gz.mat")
+    confounds_path = os.path.join(output_dir, f"motion_corrected_{file_id}_confounds.tsv")
+    mean_img_path = os.path.join(output_dir, f"mean_{file_id}.nii.gz")
+    brain_mean_path = os.path.join(output_dir, f"brain_mean_{file_id}.nii.gz")
+    mask_path = os.path.join(output_dir, f"brain_mean_{file_id}_mask.nii.gz")
+    brain_4d_path = os.path.join(output_dir, f"brain_{file_id}.nii.gz")
+    mean_mni_path = os.path.join(output_dir, f"mean_mni_{file_id}.nii.gz")
+    brain_mni_path = os.path.join(output_dir, f"brain_mni_{file_id}.nii.gz")
+    mni_mask_path = os.path.join(output_dir, f"brain_mean_{file_id}_mask_mni.nii.gz")
+    smoothed_path = os.path.join(output_dir, f"brain_smoothed_{file_id}.nii.gz")
+    filtered_path = os.path.join(output_dir, f"bandpass_filtered_{file_id}.nii.gz")
+    atlas_native_path = os.path.join(output_dir, f"aal_native_{file_id}.nii.gz")
+
+    # Native-space ROI extraction and single interpolation do not need the masked native 4D run
+    write_brain_4d = not single_interpolation and output_format != "native"
+
+    nipype_fsl_version = {"nipype": nipype.__version__, "fsl": fsl_version()}
+    nilearn_version = {"nilearn": nilearn.__version__}
+
+    # Step 1: Slice Timing Correction
+    if step_is_done(output_dir, "step1_slicetimer", [input_nifti], [stc_path], params={"interleaved": True}, tool_version=nipype_fsl_version):
+        log_print(f"Step 1/6: Slice Timing Correction - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 1/6: Slice Timing Correction - {file_id}")
         slicetimer = SliceTimer(
             in_file=input_nifti,
-            out_file=os.path.join(output_dir, f"slice_time_corrected_{file_id}.nii.gz"),
+            out_file=stc_path,
             interleaved=True
         )
-        slicetimer.run()
+        with thread_limits(step_threads("slicetimer", threads)):
+            slicetimer.run()
+        mark_step_done(output_dir, "step1_slicetimer", [input_nifti], [stc_path], params={"interleaved": True}, tool_version=nipype_fsl_version)
+
+    # Step 2: Motion Correction
+    step2_params = {"mean_vol": True, "save_plots": True}
+    if single_interpolation:
+        step2_params["save_mats"] = True
 
-        # Step 2: Motion Correction
+    def motion_mats():
+        return sorted(glob.glob(os.path.join(motion_mat_dir, "MAT_*")))
+
+    if step_is_done(output_dir, "step2_mcflirt", [stc_path], [motion_out, motion_par_path, confounds_path] + motion_mats(), params=step2_params, tool_version=nipype_fsl_version):
+        log_print(f"Step 2/6: Motion Correction (MCFLIRT) - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 2/6: Motion Correction (MCFLIRT) - {file_id}")
-        motion_out = os.path.join(output_dir, f"motion_corrected_{file_id}.nii.gz")
         mcflirt = MCFLIRT(
-            in_file=os.path.join(output_dir, f"slice_time_corrected_{file_id}.nii.gz"),
+            in_file=stc_path,
             out_file=motion_out,
             mean_vol=True,
-            save_plots=True
+            save_plots=True,
+            save_mats=single_interpolation
         )
-        mcflirt.run()
+        with thread_limits(step_threads("mcflirt", threads)):
+            mcflirt.run()
 
-        motion = np.loadtxt(os.path.join(output_dir, f"motion_corrected_{file_id}.nii.gz.par"))
+        motion = np.loadtxt(motion_par_path)
 
         motion_deriv = np.vstack([np.zeros((1, 6)), np.diff(motion, axis=0)]) # diff (1st row = 0)
         confounds = np.hstack([motion, motion_deriv])
         columns = ["X", "Y", "Z", "RotX", "RotY", "RotZ", "dX", "dY", "dZ", "dRotX", "dRotY", "dRotZ"]
 
         confounds_df = pd.DataFrame(confounds, columns=columns)
-        confounds_df.to_csv(os.path.join(output_dir, f"motion_corrected_{file_id}_confounds.tsv"), sep="\t", index=False)
-
-        # Step 3: Skull Stripping (BET with 4D support)
+        confounds_df.to_csv(confounds_path, sep="\t", index=False)
+        mark_step_done(output_dir, "step2_mcflirt", [stc_path], [motion_out, motion_par_path, confounds_path] + motion_mats(), params=step2_params, tool_version=nipype_fsl_version)
+
+    # Step 3: Skull Stripping (BET with 4D support)
+    step3_outputs = [mean_img_path, brain_mean_path, mask_path] + ([brain_4d_path] if write_brain_4d else [])
+    step3_params = {"mask": True}
+    if not write_brain_4d:
+        step3_params["brain_4d"] = False
+
+    if step_is_done(output_dir, "step3_bet", [motion_out], step3_outputs, params=step3_params, tool_version=nipype_fsl_version):
+        log_print(f"Step 3/6: Skull Stripping (BET with 4D support) - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 3/6: Skull Stripping (BET with 4D support) - {file_id}")
-        
-        mean_img_3d = mean_img(motion_out, copy_header=True)
-        mean_img_path = os.path.join(output_dir, f"mean_{file_id}.nii.gz")
+
+        fmri_img = nib.load(motion_out)
+        mean_img_3d = nib.Nifti1Image(mean_volume(motion_out).astype(np.float32), affine=fmri_img.affine, header=fmri_img.header)
         mean_img_3d.to_filename(mean_img_path)
 
         bet = BET(
             in_file=mean_img_path,
-            out_file=os.path.join(output_dir, f"brain_mean_{file_id}.nii.gz"),
+            out_file=brain_mean_path,
             mask=True
         )
-        bet.run()
+        with thread_limits(step_threads("bet", threads)):
+            bet.run()
+
+        if write_brain_4d:
+            # Streamed over volumes in float32, masked in place, saved in the input dtype
+            apply_mask_4d(motion_out, mask_path, brain_4d_path)
+        mark_step_done(output_dir, "step3_bet", [motion_out], step3_outputs, params=step3_params, tool_version=nipype_fsl_version)
+
+    if output_format == "native":
+        clean_params = {"detrend": True, "standardize": True, "low_pass": 0.1, "high_pass": 0.01}
+        roi_ts_path = os.path.join(output_dir, f"roi_AAL_timeseries_native_{file_id}.tsv")
+
+        # Step 4: Registration (ANTs) and atlas to native space
+        step4_inputs = [ref_template, mean_img_path, atlas_path]
+        step4_outputs = [mean_mni_path, atlas_native_path]
+        step4_params = {"type_of_transform": "Affine", "atlas_interpolator": "nearestNeighbor"}
+
+        if step_is_done(output_dir, "step4_native_atlas", step4_inputs, step4_outputs + transform_files(output_dir, "mni"), params=step4_params, tool_version={"antspy": ants.__version__}):
+            log_print(f"Step 4/5: Registration + AAL to native space (ANTs - Affine) - {file_id} (checkpoint found, skipped)")
+        else:
+            log_print(f"Step 4/5: Registration + AAL to native space (ANTs - Affine) - {file_id}")
+
+            # ANTsPy reads its ITK thread count from the task's environment (set by run_tasks)
+            reg = ants.registration(
+                fixed=get_template(ref_template),
+                moving=ants.image_read(mean_img_path),
+                type_of_transform="Affine",
+                outprefix=registration_prefix(output_dir, "mni")
+            )
+
+            reg["warpedmovout"].to_filename(mean_mni_path)
+            save_transforms(output_dir, "mni", reg, fixed=ref_template, moving=mean_img_path)
+
+            # One 3D label volume warped with the inverse transform, instead of every timepoint
+            reapply_transforms(output_dir, "mni", [(atlas_path, "nearestNeighbor")], [atlas_native_path], inverse=True)
+            mark_step_done(output_dir, "step4_native_atlas", step4_inputs, step4_outputs + transform_files(output_dir, "mni"), params=step4_params, tool_version={"antspy": ants.__version__})
+
+        # Step 5: ROI extraction in native space and Band-pass Filtering
+        step5_inputs = [motion_out, mask_path, atlas_native_path, confounds_path, atlas_label_path]
+
+        if step_is_done(output_dir, "step5_native_roi", step5_inputs, [roi_ts_path], params=clean_params, tool_version=nilearn_version):
+            log_print(f"Step 5/5: Native-space ROI extraction + Band-pass Filtering - {file_id} (checkpoint found, skipped)")
+        else:
+            log_print(f"Step 5/5: Native-space ROI extraction + Band-pass Filtering - {file_id}")
+            with thread_limits(step_threads("nilearn", threads)):
+                fmri_native_roi_tail(motion_out, mask_path, atlas_native_path, confounds_path, atlas_path, atlas_label_path, clean_params, roi_ts_path)
+            mark_step_done(output_dir, "step5_native_roi", step5_inputs, [roi_ts_path], params=clean_params, tool_version=nilearn_version)
 
-        mask_path = os.path.join(output_dir, f"brain_mean_{file_id}_mask.nii.gz")
-        mask_data = nib.load(mask_path).get_fdata()
-
-        fmri_img = nib.load(motion_out)
-        fmri_data = fmri_img.get_fdata()
-        masked_data = fmri_data * mask_data[..., np.newaxis]
-
-        masked_img = nib.Nifti1Image(masked_data, affine=fmri_img.affine, header=fmri_img.header)
-        brain_4d_path = os.path.join(output_dir, f"brain_{file_id}.nii.gz")
-        nib.save(masked_img, brain_4d_path)
+        log_print(f"Completed processing: {file_id}\n")
+        return
 
-        # Step 4: Spatial Normalization (ANTs)
+    # Step 4: Spatial Normalization (ANTs)
+    if single_interpolation:
+        step4_inputs = [ref_template, mean_img_path, stc_path, mask_path] + motion_mats()
+    else:
+        step4_inputs = [ref_template, mean_img_path, brain_4d_path, mask_path]
+    step4_outputs = [mean_mni_path, brain_mni_path, mni_mask_path]
+    step4_params = {"type_of_transform": "Affine"}
+    if single_interpolation:
+        step4_params["single_interpolation"] = True
+
+    if step_is_done(output_dir, "step4_ants", step4_inputs, step4_outputs + transform_files(output_dir, "mni"), params=step4_params, tool_version={"antspy": ants.__version__}):
+        log_print(f"Step 4/6: Spatial Normalization (ANTs - Affine) - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 4/6: Spatial Normalization (ANTs - Affine) - {file_id}")
 
-        fixed_ref_template = ants.image_read(ref_template)
+        # ANTsPy reads its ITK thread count from the task's environment (set by run_tasks)
+        fixed_ref_template = get_template(ref_template)
 
         reg = ants.registration(
             fixed=fixed_ref_template,
             moving=ants.image_read(mean_img_path),
-            type_of_transform="Affine"
+            type_of_transform="Affine",
+            outprefix=registration_prefix(output_dir, "mni")
         )
 
-        mean_mni_path = os.path.join(output_dir, f"mean_mni_{file_id}.nii.gz")
         reg["warpedmovout"].to_filename(mean_mni_path)
-
-        warped_fmri = ants.apply_transforms(
-            fixed=fixed_ref_template,
-            moving=ants.image_read(brain_4d_path),
-            transformlist=reg["fwdtransforms"],
-            interpolator="linear",
-            imagetype=3
-        )
-
-        brain_mni_path = os.path.join(output_dir, f"brain_mni_{file_id}.nii.gz")
-        warped_fmri.to_filename(brain_mni_path)
+        save_transforms(output_dir, "mni", reg, fixed=ref_template, moving=mean_img_path)
 
         warped_mask = ants.apply_transforms(
             fixed=fixed_ref_template,
@@ -127,57 +271,233 @@ def fmri_preprocess_subject(subject_id, base_dir, measurement_type, ref_template
             imagetype=0
         )
 
-        mni_mask_path = os.path.join(output_dir, f"brain_mean_{file_id}_mask_mni.nii.gz")
         warped_mask.to_filename(mni_mask_path)
 
+        if single_interpolation:
+            # Motion correction and normalization in one resample, masked in MNI space
+            warp_4d_single_interpolation(
+                ref_template,
+                stc_path,
+                ants_affine_path=reg["fwdtransforms"][0],
+                fsl_mat_paths=motion_mats(),
+                out_path=brain_mni_path,
+                mask_path=mni_mask_path
+            )
+        else:
+            # Warped in blocks of timepoints instead of one 4D apply_transforms(imagetype=3) call
+            warp_4d_chunked(
+                ref_template,
+                brain_4d_path,
+                mean_img_path,
+                transformlist=reg["fwdtransforms"],
+                out_path=brain_mni_path,
+                num_threads=step_threads("apply_transforms", threads)
+            )
+        mark_step_done(output_dir, "step4_ants", step4_inputs, step4_outputs + transform_files(output_dir, "mni"), params=step4_params, tool_version={"antspy": ants.__version__})
+
+    if output_format == "fused":
+        roi_ts_path = os.path.join(output_dir, f"roi_AAL_timeseries_{file_id}.tsv")
+        fused_inputs = [brain_mni_path, mni_mask_path, confounds_path, atlas_path, atlas_label_path]
+        fused_outputs = [roi_ts_path] + ([filtered_path] if write_voxelwise else [])
+        clean_params = {"detrend": True, "standardize": True, "low_pass": 0.1, "high_pass": 0.01}
+
+        # Steps 5-6: Smoothing, Band-pass Filtering and ROI extraction
+        if step_is_done(output_dir, "step56_fused", fused_inputs, fused_outputs, params=dict(clean_params, fwhm=4), tool_version=nilearn_version):
+            log_print(f"Step 5-6/6: Smoothing + Band-pass Filtering + ROI extraction - {file_id} (checkpoint found, skipped)")
+        else:
+            log_print(f"Step 5-6/6: Smoothing + Band-pass Filtering + ROI extraction - {file_id}")
+            with thread_limits(step_threads("nilearn", threads)):
+                fmri_fused_tail(
+                    brain_mni_path, mni_mask_path, confounds_path,
+                    atlas_path, atlas_label_path,
+                    fwhm=4, clean_params=clean_params,
+                    roi_ts_path=roi_ts_path,
+                    filtered_path=filtered_path if write_voxelwise else None
+                )
+            mark_step_done(output_dir, "step56_fused", fused_inputs, fused_outputs, params=dict(clean_params, fwhm=4), tool_version=nilearn_version)
+
+        log_print(f"Completed processing: {file_id}\n")
+        return
+
+    if output_format == "masked":
+        # Steps 5-6 on the in-mask (time x voxel) representation, see masked_utils
+        smoothed_masked_path = os.path.join(output_dir, f"brain_smoothed_{file_id}_masked.npz")
+        filtered_masked_path = os.path.join(output_dir, f"bandpass_filtered_{file_id}_masked.npz")
+
         # Step 5: Smoothing
-        log_print(f"Step 5/6: Applying Gaussian Smoothing - {file_id}")
-        smoothed_img = smooth_img(os.path.join(output_dir, f"brain_mni_{file_id}.nii.gz"), fwhm=4)
-        nib.save(smoothed_img, os.path.join(output_dir, f"brain_smoothed_{file_id}.nii.gz"))
+        if step_is_done(output_dir, "step5_smooth_masked", [brain_mni_path, mni_mask_path], [smoothed_masked_path], params={"fwhm": 4}, tool_version=nilearn_version):
+            log_print(f"Step 5/6: Applying Gaussian Smoothing (in-mask) - {file_id} (checkpoint found, skipped)")
+        else:
+            log_print(f"Step 5/6: Applying Gaussian Smoothing (in-mask) - {file_id}")
+            with thread_limits(step_threads("nilearn", threads)):
+                smoothed_masked = masked_from_nifti(brain_mni_path, mni_mask_path, fwhm=4)
+            save_masked(smoothed_masked_path, smoothed_masked)
+            mark_step_done(output_dir, "step5_smooth_masked", [brain_mni_path, mni_mask_path], [smoothed_masked_path], params={"fwhm": 4}, tool_version=nilearn_version)
 
         # Step 6: Band-pass Filtering
+        step6_inputs = [smoothed_masked_path, confounds_path]
+        step6_params = {"detrend": True, "standardize": True, "low_pass": 0.1, "high_pass": 0.01}
+
+        if step_is_done(output_dir, "step6_bandpass_masked", step6_inputs, [filtered_masked_path], params=step6_params, tool_version=nilearn_version):
+            log_print(f"Step 6/6: Applying Band-pass Filtering (in-mask) - {file_id} (checkpoint found, skipped)")
+        else:
+            log_print(f"Step 6/6: Applying Band-pass Filtering (in-mask) - {file_id}")
+            with thread_limits(step_threads("nilearn", threads)):
+                filtered_masked = clean_masked(load_masked(smoothed_masked_path), confounds=confounds_path, **step6_params)
+            save_masked(filtered_masked_path, filtered_masked)
+            mark_step_done(output_dir, "step6_bandpass_masked", step6_inputs, [filtered_masked_path], params=step6_params, tool_version=nilearn_version)
+
+        log_print(f"Completed processing: {file_id}\n")
+        return
+
+    # Step 5: Smoothing
+    if step_is_done(output_dir, "step5_smooth", [brain_mni_path], [smoothed_path], params={"fwhm": 4}, tool_version=nilearn_version):
+        log_print(f"Step 5/6: Applying Gaussian Smoothing - {file_id} (checkpoint found, skipped)")
+    else:
+        log_print(f"Step 5/6: Applying Gaussian Smoothing - {file_id}")
+        with thread_limits(step_threads("nilearn", threads)):
+            smoothed_img = smooth_img(brain_mni_path, fwhm=4)
+        nib.save(smoothed_img, smoothed_path)
+        mark_step_done(output_dir, "step5_smooth", [brain_mni_path], [smoothed_path], params={"fwhm": 4}, tool_version=nilearn_version)
+
+    # Step 6: Band-pass Filtering
+    step6_inputs = [smoothed_path, mni_mask_path, confounds_path]
+    step6_params = {"detrend": True, "standardize": True, "low_pass": 0.1, "high_pass": 0.01}
+
+    if step_is_done(output_dir, "step6_bandpass", step6_inputs, [filtered_path], params=step6_params, tool_version=nilearn_version):
+        log_print(f"Step 6/6: Applying Band-pass Filtering - {file_id} (checkpoint found, skipped)")
+    else:
         log_print(f"Step 6/6: Applying Band-pass Filtering - {file_id}")
 
-        smoothed_fmri_img = nib.load(os.path.join(output_dir, f"brain_smoothed_{file_id}.nii.gz"))
+        smoothed_fmri_img = nib.load(smoothed_path)
         tr = smoothed_fmri_img.header.get_zooms()[3]
 
-        filtered_img = clean_img(
-            smoothed_fmri_img, 
-            detrend=True,
-            standardize=True,
-            low_pass=0.1, high_pass=0.01,
-            t_r=tr,
-            mask_img=mni_mask_path,
-            # confounds=os.path.join(output_dir, f"motion_corrected_{file_id}.nii.gz.par")
-            confounds=os.path.join(output_dir, f"motion_corrected_{file_id}_confounds.tsv")
-        )
+        with thread_limits(step_threads("nilearn", threads)):
+            filtered_img = clean_img(
+                smoothed_fmri_img, 
+                detrend=True,
+                standardize=True,
+                low_pass=0.1, high_pass=0.01,
+                t_r=tr,
+                mask_img=mni_mask_path,
+                # confounds=motion_par_path
+                confounds=confounds_path
+            )
 
         filtered_img.set_qform(smoothed_fmri_img.affine)
         filtered_img.header.set_zooms(smoothed_fmri_img.header.get_zooms())
 
-        nib.save(filtered_img, os.path.join(output_dir, f"bandpass_filtered_{file_id}.nii.gz"))
-        
-        log_print(f"Completed processing: {file_id}\n")
+        nib.save(filtered_img, filtered_path)
+        mark_step_done(output_dir, "step6_bandpass", step6_inputs, [filtered_path], params=step6_params, tool_version=nilearn_version)
+
+    log_print(f"Completed processing: {file_id}\n")
 
-def fmri_preprocess_all_subjects_parallel(base_dir, measurement_type, ref_template, num_workers):
-    """Preprocess all subjects in parallel using multiprocessing."""
-    subject_list = sorted([s for s in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, s))])
-    total_subjects = len(subject_list)
+def fmri_preprocess_subject(subject_id, base_dir, measurement_type, ref_template, total_subjects, subject_index):
+    """Preprocess all NIfTI files for a given subject."""
+    subject_path = os.path.join(base_dir, subject_id)
+    measurement_path = os.path.join(subject_path, measurement_type)
+
+    if not os.path.exists(measurement_path):
+        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No {measurement_type} folder")
+        return
 
-    log_print(f"Starting parallel fMRI Preprocessing for {total_subjects} subjects using {num_workers} workers...\n")
+    nifti_files = sorted(glob.glob(os.path.join(measurement_path, "*.nii.gz")))
+
+    if len(nifti_files) == 0:
+        log_print(f"Skipping {subject_id} ({subject_index}/{total_subjects}): No NIfTI file found")
+        return
 
-    with multiprocessing.Pool(processes=num_workers) as pool:
-        pool.starmap(fmri_preprocess_subject, [(subject, base_dir, measurement_type, ref_template, total_subjects, i+1) for i, subject in enumerate(subject_list)])
+    for file_index, input_nifti in enumerate(nifti_files, start=1):
+        fmri_preprocess_file(subject_id, input_nifti, ref_template, progress=f"{subject_index}/{total_subjects} - File {file_index}/{len(nifti_files)}")
+
+def fmri_memory_kind(kwargs):
+    """Memory history key of fmri_preprocess_file runs with these options (the peak depends on the output format)."""
+    if kwargs["output_format"] == "fused" and kwargs["write_voxelwise"]:
+        return "fused_voxelwise"
+    return kwargs["output_format"]
+
+def fmri_task(subject_id, nifti_path, ref_template, ref_shape, calibration, kwargs):
+    """
+    run_tasks task preprocessing one file (its progress label and thread
+    count still to be appended to args), with cost and memory estimates.
+    calibration is load_memory_calibration() for fmri_memory_kind(kwargs).
+    """
+    memory_estimate = estimate_fmri_memory(nifti_path, ref_shape=ref_shape, output_format=kwargs["output_format"], write_voxelwise=kwargs["write_voxelwise"])
+    return {
+        "name": os.path.join(subject_id, os.path.basename(nifti_path)),
+        "args": (subject_id, nifti_path, ref_template),
+        "kwargs": dict(kwargs),
+        "cost": estimate_nifti_cost(nifti_path),
+        "memory_estimate": memory_estimate,
+        "memory_kind": fmri_memory_kind(kwargs),
+        "memory": int(memory_estimate * calibration)
+    }
+
+def preload_fmri_references(ref_template, output_format):
+    """Load the reference data an output format needs in the parent process (see reference_utils)."""
+    if output_format == "fused":
+        preload_references(ref_template, atlas_path=AAL_ATLAS_PATH, atlas_label_path=AAL_LABEL_PATH)
+    elif output_format == "native":
+        preload_references(ref_template, atlas_label_path=AAL_LABEL_PATH)
+    else:
+        preload_references(ref_template)
+
+def fmri_preprocess_all_subjects_parallel(base_dir, measurement_type, ref_template, num_workers=None, threads_per_worker=None, output_format="nifti", write_voxelwise=False, single_interpolation=False, timeout=None, retries=0, failure_report="failures_preprocessing_fMRI_parallel.csv", memory_budget=None, memory_history="memory_history_preprocessing_fMRI_parallel.csv", cohort=None):
+    """
+    Preprocess all NIfTI files of all subjects in parallel, one file per task, most expensive first.
+
+    The node's cores are split between num_workers concurrent files and
+    threads_per_worker threads per file (see resource_utils.plan_resources).
+    A file only starts when its estimated peak memory fits in memory_budget
+    (default: 90% of available memory); measured peaks are appended to
+    memory_history and used to calibrate the estimates of later runs with
+    the same output format.
+    With cohort (a cohort manifest, see cohort_utils), only the files it
+    lists are preprocessed.
+    """
+    num_workers, threads_per_worker = plan_resources(num_workers, threads_per_worker)
+    memory_budget = memory_budget or int(0.9 * available_memory())
+    ref_shape = nib.load(ref_template).shape[:3]
+    if cohort is not None:
+        # Only the scans listed in the cohort manifest, in place in base_dir
+        manifest = load_cohort_manifest(cohort)
+        nifti_files = filter_by_cohort(list_nifti_files(base_dir, measurement_type, subject_list=cohort_subjects(manifest)), manifest, nifti_file_key, label="NIfTI files")
+    else:
+        nifti_files = list_nifti_files(base_dir, measurement_type)
+    total_subjects = len(set(subject_id for subject_id, _ in nifti_files))
+
+    kwargs = {"output_format": output_format, "write_voxelwise": write_voxelwise, "single_interpolation": single_interpolation}
+    calibration = load_memory_calibration(memory_history, kind=fmri_memory_kind(kwargs))
+
+    tasks = order_by_cost([fmri_task(subject_id, nifti_path, ref_template, ref_shape, calibration, kwargs) for subject_id, nifti_path in nifti_files])
+    for task_index, task in enumerate(tasks, start=1):
+        task["args"] += (f"task {task_index}/{len(tasks)}", threads_per_worker)
+
+    log_print(f"Starting parallel fMRI Preprocessing for {len(tasks)} files of {total_subjects} subjects using {num_workers} workers x {threads_per_worker} threads...\n")
+
+    log_print(f"Memory budget: {memory_budget / 1024**3:.1f} GiB (estimate calibration x{calibration:.2f})")
+
+    # Loaded once here and shared copy-on-write by the forked tasks
+    preload_fmri_references(ref_template, output_format)
+
+    run_tasks(
+        fmri_preprocess_file, tasks, num_workers,
+        timeout=timeout, retries=retries, failure_report=failure_report,
+        threads_per_worker=threads_per_worker,
+        memory_budget=memory_budget, memory_history=memory_history
+    )
 
     log_print("All fMRI Preprocessing Completed!")
 
 if __name__ == "__main__":
     
-    NUM_CORES = 10
+    setup_logging("output_preprocessing_fMRI_parallel.log")
+
+    THREADS_PER_WORKER = 2 # SliceTimer/MCFLIRT/BET are single-threaded; ANTs and nilearn steps use the budget
 
     fmri_preprocess_all_subjects_parallel(
         base_dir="/root/data/ADNI/example/fMRI/nifti/",
         measurement_type="Axial_HB_rsfMRI__Eyes_Open___MSV22_",
         ref_template="/usr/lib/fsl/5.0/data/standard/MNI152_T1_2mm_brain.nii.gz",
-        num_workers=NUM_CORES
+        threads_per_worker=THREADS_PER_WORKER
     )
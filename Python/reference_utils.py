@@ -0,0 +1,137 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import numpy as np
+import nibabel as nib
+
+from atlas_utils import load_aal_labels, load_atlas_on_grid, build_atlas_index
+
+# ==========================================
+# Reference data cache (template, atlas, labels)
+# ==========================================
+# Reference data is loaded once per process and kept in _CACHE. Arrays are
+# also stored as .npy files in REFERENCE_CACHE_DIR and memory-mapped, so
+# concurrent workers share them through the page cache instead of each
+# decompressing and resampling the originals. Calling preload_references()
+# in the parent before run_tasks forks makes the arrays copy-on-write
+# shared by every task.
+#
+# Keys include each source file's path, size and mtime, so an updated
+# template or atlas is picked up (and its stale .npy is never read).
+
+REFERENCE_CACHE_DIR = os.environ.get("ADNI_REFERENCE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ADNI", "reference"))
+
+_CACHE = {}
+
+def _file_key(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def _grid_key(img):
+    return (tuple(img.shape[:3]), np.round(img.affine, 6).tobytes())
+
+def _cached(key, loader):
+    if key not in _CACHE:
+        _CACHE[key] = loader()
+    return _CACHE[key]
+
+def _cached_array(key, loader, cache_dir=None):
+    """Array computed by loader, stored once as .npy under cache_dir and memory-mapped."""
+    cache_dir = cache_dir or REFERENCE_CACHE_DIR
+
+    def load():
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+        npy_path = os.path.join(cache_dir, f"{key[0]}_{digest}.npy")
+
+        if not os.path.exists(npy_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{npy_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, loader())
+            os.replace(tmp_path, npy_path)
+
+        return np.load(npy_path, mmap_mode="r")
+
+    return _cached(key, load)
+
+def get_template_data(template_path, cache_dir=None):
+    """Template voxel data (float32, read-only memmap) and its nibabel header image."""
+    key = ("template",) + _file_key(template_path)
+    data = _cached_array(key, lambda: np.asanyarray(nib.load(template_path).dataobj, dtype=np.float32), cache_dir)
+    img = _cached(("template_img",) + _file_key(template_path), lambda: nib.load(template_path))
+    return data, img
+
+def get_template(template_path, cache_dir=None):
+    """
+    Template as an ANTsImage, built from the cached data once per process.
+
+    Same voxels and geometry as ants.image_read(template_path). run_tasks
+    forks a fresh process per task, so this is once per task: a copy of the
+    shared, memory-mapped array (milliseconds), not a read and decompression
+    of the NIfTI. It is deliberately not built in the parent: ITK objects
+    created before a fork are not safe to share with the children, and ITK
+    reads its thread count (set per task) when it is first used.
+    """
+    import ants
+
+    def load():
+        data, img = get_template_data(template_path, cache_dir)
+        zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+        ras_to_lps = np.diag([-1.0, -1.0, 1.0])
+
+        return ants.from_numpy(
+            np.array(data),
+            origin=list(ras_to_lps @ img.affine[:3, 3]),
+            spacing=list(zooms),
+            direction=ras_to_lps @ (img.affine[:3, :3] / zooms)
+        )
+
+    return _cached(("template_ants", os.getpid()) + _file_key(template_path), load)
+
+def get_atlas_on_grid(atlas_path, target_img, cache_dir=None):
+    """
+    Atlas labels (int32, read-only memmap) resampled to the grid of target_img.
+
+    Cached per atlas file and target grid (shape and affine), so every run on
+    the template grid shares one resampled atlas.
+    """
+    target_img = nib.load(target_img) if isinstance(target_img, str) else target_img
+    key = ("atlas",) + _file_key(atlas_path) + _grid_key(target_img)
+    return _cached_array(key, lambda: load_atlas_on_grid(atlas_path, target_img), cache_dir)
+
+def get_aal_labels(label_path):
+    """ROI index -> ROI name table (see atlas_utils.load_aal_labels), cached per process."""
+    return _cached(("labels",) + _file_key(label_path), lambda: load_aal_labels(label_path))
+
+def get_atlas_index(atlas_path, label_path=None, target_img=None, cache_dir=None):
+    """
+    Atlas index (see atlas_utils.build_atlas_index) of an atlas file, built once per process.
+
+    With target_img, the index is of the atlas on that grid (see
+    get_atlas_on_grid), as the ROI reductions of atlas_utils need.
+    """
+    key = ("atlas_index",) + _file_key(atlas_path) + (_file_key(label_path) if label_path is not None else ())
+    roi_labels_dict = get_aal_labels(label_path) if label_path is not None else None
+
+    if target_img is None:
+        return _cached(key, lambda: build_atlas_index(atlas_path, roi_labels_dict))
+
+    target_img = nib.load(target_img) if isinstance(target_img, str) else target_img
+    atlas_img = lambda: nib.Nifti1Image(np.asarray(get_atlas_on_grid(atlas_path, target_img, cache_dir)), target_img.affine)
+    return _cached(key + _grid_key(target_img), lambda: build_atlas_index(atlas_img(), roi_labels_dict))
+
+def preload_references(ref_template, atlas_path=None, atlas_label_path=None, cache_dir=None):
+    """
+    Load the reference data in the current (parent) process.
+
+    Call before run_tasks: forked tasks then find the arrays and label
+    tables in _CACHE and share them copy-on-write (the ANTsImage of the
+    template is built per task, see get_template).
+    """
+    get_template_data(ref_template, cache_dir)
+
+    if atlas_label_path is not None:
+        get_aal_labels(atlas_label_path)
+    if atlas_path is not None:
+        get_atlas_index(atlas_path, atlas_label_path, ref_template, cache_dir)
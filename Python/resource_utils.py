@@ -0,0 +1,120 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import contextlib
+
+from logging_utils import log_print
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+THREAD_ENV_VARS = [
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",  # ANTs / ITK (in-process ANTsPy and CLI)
+    "OMP_NUM_THREADS",                       # OpenMP (FSL builds, ITK OpenMP backend)
+    "OPENBLAS_NUM_THREADS",                  # NumPy / SciPy BLAS
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+# Threads per step: None = the worker's whole thread budget, an int = fixed count
+STEP_THREADS = {
+    "n4": None,
+    "registration": None,
+    "apply_transforms": None,
+    "nilearn": None,
+    "slicetimer": 1,
+    "mcflirt": 1,
+    "bet": 1,
+    "fast": 1,
+}
+
+def available_cores():
+    """Cores allocated to this job (Slurm allocation or CPU affinity)."""
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cpus:
+        return int(slurm_cpus)
+
+    return len(os.sched_getaffinity(0))
+
+def available_memory():
+    """
+    Memory budget of this job in bytes.
+
+    Uses the Slurm allocation when one is set (--mem=0 means the whole node),
+    otherwise MemAvailable from /proc/meminfo.
+    """
+    slurm_mem_mb = os.environ.get("SLURM_MEM_PER_NODE")
+    if slurm_mem_mb and int(slurm_mem_mb) > 0:
+        return int(slurm_mem_mb) * 1024 * 1024
+
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+def plan_resources(num_workers=None, threads_per_worker=None, total_cores=None):
+    """
+    Split the node's cores between pool workers and per-step threads.
+
+    Args:
+    - num_workers (int): Number of concurrent tasks. Derived from threads_per_worker if None.
+    - threads_per_worker (int): Thread budget of each task. Derived from num_workers if None.
+    - total_cores (int): Cores to plan for. Defaults to available_cores().
+
+    Returns (num_workers, threads_per_worker) with num_workers * threads_per_worker <= total_cores.
+    """
+    total_cores = total_cores or available_cores()
+
+    if num_workers is None and threads_per_worker is None:
+        threads_per_worker = 1
+    if num_workers is None:
+        threads_per_worker = max(1, min(threads_per_worker, total_cores))
+        num_workers = max(1, total_cores // threads_per_worker)
+    elif threads_per_worker is None:
+        num_workers = max(1, min(num_workers, total_cores))
+        threads_per_worker = max(1, total_cores // num_workers)
+    elif num_workers * threads_per_worker > total_cores:
+        requested = (num_workers, threads_per_worker)
+        num_workers = max(1, min(num_workers, total_cores))
+        threads_per_worker = max(1, min(threads_per_worker, total_cores // num_workers))
+        log_print(f"{requested[0]} workers x {requested[1]} threads exceed {total_cores} cores, using {num_workers} x {threads_per_worker}")
+
+    return num_workers, threads_per_worker
+
+def step_threads(step, threads_per_worker):
+    """Number of threads a step may use within a worker's thread budget."""
+    fixed = STEP_THREADS.get(step)
+    return threads_per_worker if fixed is None else min(fixed, threads_per_worker)
+
+def set_thread_env(num_threads):
+    """Set the thread count of ITK, OpenMP and BLAS for this process and its subprocesses."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+
+    # BLAS is already loaded by NumPy, so the environment alone does not resize its pool
+    if threadpool_limits is not None:
+        threadpool_limits(limits=num_threads)
+
+@contextlib.contextmanager
+def thread_limits(num_threads):
+    """Temporarily limit ITK, OpenMP and BLAS threads (e.g. around a single-threaded FSL call)."""
+    saved_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+
+    blas_limits = threadpool_limits(limits=num_threads) if threadpool_limits is not None else contextlib.nullcontext()
+
+    try:
+        with blas_limits:
+            yield
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
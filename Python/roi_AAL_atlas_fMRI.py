@@ -5,6 +5,9 @@ import numpy as np
 import nibabel as nib
 from nilearn.input_data import NiftiLabelsMasker
 
+from atlas_utils import lookup_voxels, lookup_mm, label_names, roi_voxels
+from reference_utils import get_atlas_on_grid, get_aal_labels, get_atlas_index
+
 aal_atlas_path = "/root/Project/ADNI/atlas/aal_for_SPM12/ROI_MNI_V4.nii"
 
 fmri_path = "/root/Project/ADNI/data/example/fMRI/nifti/135_S_6509/Axial_HB_rsfMRI__Eyes_Open___MSV22_/preprocessed/2024-08-08_12_03_24.0_I10910954/bandpass_filtered_2024-08-08_12_03_24.0_I10910954.nii.gz"
@@ -12,8 +15,11 @@ fmri_path = "/root/Project/ADNI/data/example/fMRI/nifti/135_S_6509/Axial_HB_rsfM
 fmri_img = nib.load(fmri_path)
 tr = fmri_img.header.get_zooms()[3]
 
+# AAL resampled to the fMRI grid once and cached (see reference_utils)
+aal_on_fmri_grid = nib.Nifti1Image(np.asarray(get_atlas_on_grid(aal_atlas_path, fmri_img)), fmri_img.affine)
+
 masker = NiftiLabelsMasker(
-    labels_img=aal_atlas_path,
+    labels_img=aal_on_fmri_grid,
     t_r=tr
 )
 
@@ -36,50 +42,59 @@ print(roi_labels[:5])
 # ROI: Precentral_L (Left Precentral gyrus)
 # id: 2001
 
-# Mapping
-atlas_img = nib.load(aal_atlas_path)
-atlas_data = atlas_img.get_fdata()
-
-roi_labels_dict = {}
-with open(aal_atlas_roi_label_path) as f:
-    for line in f:
-        parts = line.strip().split('\t')
-        if len(parts) == 3:
-            _, name, idx = parts
-            roi_labels_dict[int(idx)] = name.strip()
+# Mapping: atlas index built once (int16 labels, voxels grouped by ROI, centroids; see atlas_utils)
+roi_labels_dict = get_aal_labels(aal_atlas_roi_label_path)
+atlas_index = get_atlas_index(aal_atlas_path, aal_atlas_roi_label_path)
 
 def get_roi_name_from_coordinate(atlas_input, roi_labels_dict, coord):
     """
-    Determine the ROI name for a given voxel coordinate using the atlas.
+    Determine the ROI name for voxel coordinate(s) using the atlas.
 
     Parameters:
-    - atlas_input: Either a nibabel Nifti1Image object or a 3D NumPy array from get_fdata().
+    - atlas_input: An atlas index (atlas_utils.build_atlas_index), a nibabel Nifti1Image object or a 3D NumPy array.
     - roi_labels_dict: Dictionary mapping ROI indices to ROI names.
-    - coord: Tuple (x, y, z) indicating voxel coordinate.
+    - coord: Tuple (x, y, z) indicating voxel coordinate, or an (N x 3) array of coordinates.
 
     Returns:
-    - A string message indicating ROI name or background.
+    - A string message indicating ROI name or background (a list of messages for N x 3 input).
     """
-    x, y, z = coord
-
-    # Handle atlas input
-    if isinstance(atlas_input, nib.Nifti1Image):
-        atlas_data = atlas_input.get_fdata()
+    # Handle atlas input (an index or array is used as is; an image is read once per call)
+    if isinstance(atlas_input, dict):
+        atlas_data = atlas_input["labels"]
+    elif isinstance(atlas_input, nib.Nifti1Image):
+        atlas_data = np.asanyarray(atlas_input.dataobj)
     elif isinstance(atlas_input, np.ndarray):
         atlas_data = atlas_input
     else:
-        raise TypeError("atlas_input must be a nibabel Nifti1Image or a NumPy ndarray.")
-
-    # Extract ROI index at the given coordinate
-    roi_index = int(atlas_data[x, y, z])
-
-    # Determine ROI name
-    if roi_index == 0:
-        return "This voxel does not belong to any ROI (background)."
-    elif roi_index in roi_labels_dict:
-        return f"This voxel belongs to ROI: {roi_labels_dict[roi_index]}"
-    else:
-        return f"ROI index {roi_index} not found in the label dictionary."
-
-get_roi_name_from_coordinate(atlas_data, roi_labels_dict, (40, 50, 40))
-get_roi_name_from_coordinate(atlas_data, roi_labels_dict, (10, 10, 40))
+        raise TypeError("atlas_input must be an atlas index, a nibabel Nifti1Image or a NumPy ndarray.")
+
+    # Extract ROI indices at all coordinates in one lookup
+    roi_indices = lookup_voxels({"labels": atlas_data}, coord)
+
+    messages = []
+    for roi_index in roi_indices.tolist():
+        # Determine ROI name
+        if roi_index == -1:
+            messages.append("This voxel is outside the atlas grid.")
+        elif roi_index == 0:
+            messages.append("This voxel does not belong to any ROI (background).")
+        elif roi_index in roi_labels_dict:
+            messages.append(f"This voxel belongs to ROI: {roi_labels_dict[roi_index]}")
+        else:
+            messages.append(f"ROI index {roi_index} not found in the label dictionary.")
+
+    return messages if np.ndim(coord) == 2 else messages[0]
+
+get_roi_name_from_coordinate(atlas_index, roi_labels_dict, (40, 50, 40))
+get_roi_name_from_coordinate(atlas_index, roi_labels_dict, (10, 10, 40))
+get_roi_name_from_coordinate(atlas_index, roi_labels_dict, np.array([[40, 50, 40], [10, 10, 40]]))
+
+# MNI (mm) coordinates -> ROI names
+label_names(atlas_index, lookup_mm(atlas_index, [[-38.0, -22.0, 56.0], [0.0, 0.0, 0.0]]))
+
+# Seed time series from one ROI's voxel list (index of the AAL on the fMRI grid)
+atlas_index_fmri = get_atlas_index(aal_atlas_path, aal_atlas_roi_label_path, fmri_img)
+pcc_voxels = roi_voxels(atlas_index_fmri, 4021)  # Cingulum_Post_L
+fmri_data = fmri_img.get_fdata(dtype=np.float32)
+pcc_time_series = fmri_data.reshape(-1, fmri_data.shape[3])[pcc_voxels].mean(axis=0)
+print(f"Cingulum_Post_L: {len(pcc_voxels)} voxels, seed time series shape {pcc_time_series.shape}")
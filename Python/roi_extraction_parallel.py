@@ -0,0 +1,213 @@
+
+# -*- coding: utf-8 -*-
+
+# nohup env PYTHONDONTWRITEBYTECODE=1 python3 roi_extraction_parallel.py > output_roi_extraction_parallel.log 2>&1 < /dev/null &
+
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from logging_utils import setup_logging, log_print
+from scheduling_utils import order_by_cost, run_tasks
+from resource_utils import plan_resources
+from atlas_utils import AAL_ATLAS_PATH, AAL_LABEL_PATH, masked_roi_timeseries, roi_statistics
+from masked_utils import masked_from_nifti, load_masked
+from reference_utils import get_aal_labels, get_atlas_index
+from checkpoint_utils import step_is_done, mark_step_done
+from cohort_utils import parse_file_id
+
+# ==========================================
+# Cohort ROI store
+# ==========================================
+# One Parquet part per preprocessed image, all in one directory per modality:
+#   <store_dir>/fmri_roi_timeseries/<PTID>_<image_id>.parquet  (one row per timepoint, one column per AAL ROI)
+#   <store_dir>/mri_roi_stats/<PTID>_<image_id>.parquet        (roi_statistics table)
+# Every row is keyed by PTID, scan_date and image_id. pd.read_parquet(<dir>)
+# (or load_roi_store) reads the whole cohort as one table. A part is only
+# (re)written when its image is new or its inputs changed (checkpoint in the
+# image's preprocessed folder), so newly preprocessed subjects are appended
+# without touching the rest of the cohort.
+
+STORE_DIRNAMES = {"fmri": "fmri_roi_timeseries", "mri": "mri_roi_stats"}
+
+def list_preprocessed(base_dir, measurement_type):
+    """List (subject_id, file_id, output_dir) for every preprocessed/<file_id>/ folder."""
+    subject_list = sorted([s for s in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, s))])
+
+    outputs = []
+    for subject_id in subject_list:
+        preprocessed_path = os.path.join(base_dir, subject_id, measurement_type, "preprocessed")
+        if not os.path.isdir(preprocessed_path):
+            continue
+
+        for file_id in sorted(os.listdir(preprocessed_path)):
+            output_dir = os.path.join(preprocessed_path, file_id)
+            if os.path.isdir(output_dir):
+                outputs.append((subject_id, file_id, output_dir))
+
+    return outputs
+
+def fmri_roi_inputs(output_dir, file_id):
+    """
+    Best available source of a run's AAL ROI time series, as (source, input paths).
+
+    In order: the fused stage's TSV, the band-pass filtered NIfTI (with the
+    MNI brain mask), the masked .npz, then the native-space TSV. None if the
+    run has none of them yet.
+    """
+    candidates = [
+        ("roi_tsv", [f"roi_AAL_timeseries_{file_id}.tsv"]),
+        ("nifti", [f"bandpass_filtered_{file_id}.nii.gz", f"brain_mean_{file_id}_mask_mni.nii.gz"]),
+        ("masked", [f"bandpass_filtered_{file_id}_masked.npz"]),
+        ("native_tsv", [f"roi_AAL_timeseries_native_{file_id}.tsv"])
+    ]
+
+    for source, names in candidates:
+        paths = [os.path.join(output_dir, name) for name in names]
+        if all(os.path.exists(path) for path in paths):
+            return source, paths
+
+    return None
+
+def mri_roi_inputs(output_dir, file_id):
+    """Smoothed MNI brain and MNI PVE maps of an image, as {map name: path} (None if incomplete)."""
+    paths = {"intensity": os.path.join(output_dir, f"brain_smoothed_{file_id}.nii.gz")}
+    paths.update({tissue: os.path.join(output_dir, f"brain_n4_{file_id}_pve_{tissue}_mni.nii.gz") for tissue in ("CSF", "GM", "WM")})
+
+    return paths if all(os.path.exists(path) for path in paths.values()) else None
+
+def _with_keys(df, subject_id, file_id):
+    scan_date, image_id = parse_file_id(file_id)
+    keys = pd.DataFrame({"PTID": subject_id, "scan_date": scan_date, "image_id": image_id}, index=df.index)
+    return pd.concat([keys, df], axis=1)
+
+def _write_part(df, part_path):
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    # Hidden while being written, so readers of the directory never see a partial part
+    tmp_path = os.path.join(os.path.dirname(part_path), f".{os.path.basename(part_path)}.tmp")
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, part_path)
+
+def extract_fmri_roi(subject_id, file_id, output_dir, part_path, atlas_path=AAL_ATLAS_PATH, atlas_label_path=AAL_LABEL_PATH):
+    """Write the AAL ROI time series (T x ROIs) of one fMRI run as a store part."""
+    source, input_paths = fmri_roi_inputs(output_dir, file_id)
+
+    if source in ("roi_tsv", "native_tsv"):
+        roi_df = pd.read_csv(input_paths[0], sep="\t")
+    elif source == "nifti":
+        # Streamed into the in-mask representation; same values as NiftiLabelsMasker
+        filtered_path, mni_mask_path = input_paths
+        masked = masked_from_nifti(filtered_path, mni_mask_path)
+        roi_df = masked_roi_timeseries(masked, get_atlas_index(atlas_path, atlas_label_path, mni_mask_path))
+    else:
+        masked = load_masked(input_paths[0])
+        target = nib.Nifti1Image(np.zeros(masked["mask"].shape, dtype=np.uint8), masked["affine"])
+        roi_df = masked_roi_timeseries(masked, get_atlas_index(atlas_path, atlas_label_path, target))
+
+    roi_df.insert(0, "space", "native" if source == "native_tsv" else "MNI")
+    roi_df.insert(1, "timepoint", np.arange(len(roi_df)))
+    _write_part(_with_keys(roi_df, subject_id, file_id), part_path)
+
+    mark_step_done(output_dir, "roi_store_fmri", input_paths + [atlas_path, atlas_label_path], [part_path], params={"source": source})
+
+def extract_mri_roi(subject_id, file_id, output_dir, part_path, atlas_path=AAL_ATLAS_PATH, atlas_label_path=AAL_LABEL_PATH):
+    """Write the AAL ROI intensity and tissue volume statistics of one MRI image as a store part."""
+    map_paths = mri_roi_inputs(output_dir, file_id)
+
+    intensity_img = nib.load(map_paths["intensity"])
+    maps = {name: nib.load(path).get_fdata(dtype=np.float32) for name, path in map_paths.items()}
+    voxel_volume = float(np.prod(intensity_img.header.get_zooms()[:3]))
+
+    stats_df = roi_statistics(get_atlas_index(atlas_path, atlas_label_path, intensity_img), maps, voxel_volume)
+    _write_part(_with_keys(stats_df, subject_id, file_id), part_path)
+
+    input_paths = list(map_paths.values())
+    mark_step_done(output_dir, "roi_store_mri", input_paths + [atlas_path, atlas_label_path], [part_path])
+
+def load_roi_store(store_dir, modality):
+    """Whole-cohort ROI table of a modality ("fmri" or "mri")."""
+    return pd.read_parquet(os.path.join(store_dir, STORE_DIRNAMES[modality]))
+
+def extract_roi_cohort_parallel(base_dir, measurement_type, store_dir, modality, num_workers=None, atlas_path=AAL_ATLAS_PATH, atlas_label_path=AAL_LABEL_PATH, timeout=None, retries=0, failure_report="failures_roi_extraction_parallel.csv"):
+    """
+    Extract AAL ROI data of every preprocessed image of a cohort into the store.
+
+    Args:
+    - base_dir (str): NIfTI root (<base_dir>/<PTID>/<measurement_type>/preprocessed/<file_id>/).
+    - measurement_type (str): The measurement folder to process.
+    - store_dir (str): Root of the cohort ROI store.
+    - modality (str): "fmri" (ROI time series) or "mri" (ROI intensity / tissue volumes).
+    - num_workers (int): Concurrent images (default: one per allocated core).
+
+    Images whose part is up to date are skipped; the others (new or changed)
+    are extracted one per task and written as their own part.
+    """
+    if modality not in STORE_DIRNAMES:
+        raise ValueError(f"Unknown modality: {modality}")
+
+    num_workers, _ = plan_resources(num_workers, 1)
+    part_dir = os.path.join(store_dir, STORE_DIRNAMES[modality])
+    extract = extract_fmri_roi if modality == "fmri" else extract_mri_roi
+
+    tasks = []
+    skipped_incomplete = 0
+    skipped_done = 0
+
+    for subject_id, file_id, output_dir in list_preprocessed(base_dir, measurement_type):
+        part_path = os.path.join(part_dir, f"{subject_id}_{parse_file_id(file_id)[1] or file_id}.parquet")
+
+        if modality == "fmri":
+            found = fmri_roi_inputs(output_dir, file_id)
+            input_paths, params = (found[1], {"source": found[0]}) if found else (None, None)
+        else:
+            found = mri_roi_inputs(output_dir, file_id)
+            input_paths, params = (list(found.values()), None) if found else (None, None)
+
+        if input_paths is None:
+            skipped_incomplete += 1
+            continue
+
+        if step_is_done(output_dir, f"roi_store_{modality}", input_paths + [atlas_path, atlas_label_path], [part_path], params=params):
+            skipped_done += 1
+            continue
+
+        tasks.append({
+            "name": os.path.join(subject_id, file_id),
+            "args": (subject_id, file_id, output_dir, part_path),
+            "kwargs": {"atlas_path": atlas_path, "atlas_label_path": atlas_label_path},
+            "cost": sum(os.path.getsize(path) for path in input_paths)
+        })
+
+    tasks = order_by_cost(tasks)
+
+    log_print(f"ROI extraction ({modality}): {len(tasks)} new or changed images, {skipped_done} up to date, {skipped_incomplete} without preprocessed outputs")
+
+    # Label table loaded once here and shared by the forked tasks; each task
+    # indexes the atlas on its grid (get_atlas_index), from the resampled
+    # atlas cached on disk by the first task that needs it
+    get_aal_labels(atlas_label_path)
+
+    run_tasks(extract, tasks, num_workers, timeout=timeout, retries=retries, failure_report=failure_report, threads_per_worker=1)
+
+    log_print(f"ROI store updated: {part_dir}")
+
+if __name__ == "__main__":
+
+    setup_logging("output_roi_extraction_parallel.log")
+
+    # fMRI: AAL ROI time series
+    extract_roi_cohort_parallel(
+        base_dir="/root/data/ADNI/example/fMRI/nifti/",
+        measurement_type="Axial_HB_rsfMRI__Eyes_Open___MSV22_",
+        store_dir="/root/data/ADNI/example/roi_store",
+        modality="fmri"
+    )
+
+    # MRI: AAL ROI intensity and tissue volumes
+    extract_roi_cohort_parallel(
+        base_dir="/root/data/ADNI/example/MRI/nifti/",
+        measurement_type="Accelerated_Sagittal_MPRAGE__MSV22_",
+        store_dir="/root/data/ADNI/example/roi_store",
+        modality="mri"
+    )
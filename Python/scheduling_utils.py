@@ -0,0 +1,473 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import glob
+import time
+import signal
+import resource
+import threading
+import traceback
+import contextlib
+import collections
+import multiprocessing
+import multiprocessing.connection
+import numpy as np
+import nibabel as nib
+
+from logging_utils import log_print
+from resource_utils import set_thread_env
+
+def list_nifti_files(base_dir, measurement_type, subject_list=None):
+    """List (subject_id, nifti_path) pairs for every NIfTI file of every subject (or of subject_list)."""
+    if subject_list is None:
+        subject_list = sorted([s for s in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, s))])
+
+    nifti_files = []
+    for subject_id in subject_list:
+        measurement_path = os.path.join(base_dir, subject_id, measurement_type)
+        for nifti_path in sorted(glob.glob(os.path.join(measurement_path, "*.nii.gz"))):
+            nifti_files.append((subject_id, nifti_path))
+
+    return nifti_files
+
+def estimate_nifti_cost(nifti_path):
+    """
+    Relative cost of preprocessing a NIfTI file.
+
+    Returns (timepoints, file size) so that longer runs sort first and file
+    size breaks ties. Only the header is read.
+    """
+    size = os.path.getsize(nifti_path)
+
+    try:
+        shape = nib.load(nifti_path).shape
+    except Exception:
+        return (1, size)
+
+    timepoints = shape[3] if len(shape) > 3 else 1
+    return (timepoints, size)
+
+# Share of the MNI grid inside the (EPI-derived, warped) brain mask
+MNI_BRAIN_FRACTION = 0.3
+
+def estimate_fmri_memory(nifti_path, ref_shape=(91, 109, 91), output_format="nifti", write_voxelwise=False):
+    """
+    Estimated peak RSS (bytes) of preprocessing one fMRI run, from its header only.
+
+    Native space: SliceTimer/MCFLIRT hold the run in its stored dtype plus
+    two float32 copies. Mean, masking and the chunked / single-interpolation
+    warps stream over volumes, so only the MNI tail holds the whole run
+    again, depending on output_format:
+    - "nifti": smooth_img and clean_img, three float64 copies of the MNI run;
+    - "masked" / "fused": the in-mask (time x voxel) float32 run plus the
+      float64 copy signal.clean works on (MNI_BRAIN_FRACTION of the grid),
+      and with write_voxelwise the expanded float32 MNI run;
+    - "native": ROI time series only.
+    Returns the larger of the two plus a fixed interpreter overhead; multiply
+    by load_memory_calibration() to correct it with measured runs.
+    """
+    img = nib.load(nifti_path)
+    shape = img.shape
+    timepoints = shape[3] if len(shape) > 3 else 1
+    itemsize = img.get_data_dtype().itemsize
+    mni_voxels = int(np.prod(ref_shape)) * timepoints
+
+    native_bytes = int(np.prod(shape[:3])) * timepoints * (itemsize + 2 * 4)
+
+    if output_format == "nifti":
+        mni_bytes = mni_voxels * 3 * 8
+    elif output_format in ("masked", "fused"):
+        mni_bytes = int(mni_voxels * MNI_BRAIN_FRACTION) * (4 + 8)
+        if write_voxelwise:
+            mni_bytes += mni_voxels * 4
+    else:
+        mni_bytes = 0
+
+    overhead = 512 * 1024 * 1024
+
+    return max(native_bytes, mni_bytes) + overhead
+
+def load_memory_calibration(memory_history, kind=None, quantile=0.95, recent=200, margin=1.1):
+    """
+    Ratio of measured to estimated peak memory from earlier runs.
+
+    Args:
+    - memory_history (str): CSV written by run_tasks (task, kind, estimate, peak_rss).
+    - kind (str): Only rows of this kind of task (e.g. an output format); None for all rows.
+    - quantile (float): Quantile of the ratios used, so that estimates err on the safe side.
+    - recent (int): Only the last rows of the kind (older runs may predate code changes).
+    - margin (float): Safety factor on top.
+
+    Returns 1.0 without (matching) history.
+    """
+    if memory_history is None or not os.path.exists(memory_history):
+        return 1.0
+
+    with open(memory_history, newline="") as f:
+        ratios = [
+            float(row["peak_rss"]) / float(row["estimate"])
+            for row in csv.DictReader(f)
+            if (kind is None or row.get("kind") == kind) and float(row["estimate"]) > 0
+        ]
+
+    if not ratios:
+        return 1.0
+
+    return float(np.quantile(ratios[-recent:], quantile)) * margin
+
+MEMORY_HISTORY_COLUMNS = ["task", "kind", "estimate", "peak_rss"]
+
+def _record_memory(memory_history, name, kind, estimate, peak_rss):
+    is_new = not os.path.exists(memory_history)
+    if not is_new:
+        with open(memory_history, newline="") as f:
+            if next(csv.reader(f), None) != MEMORY_HISTORY_COLUMNS:
+                # History without the kind column: kept aside, a new one is started
+                os.replace(memory_history, f"{memory_history}.old")
+                is_new = True
+
+    with open(memory_history, "a", newline="") as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(MEMORY_HISTORY_COLUMNS)
+        writer.writerow([name, kind, estimate, peak_rss])
+
+def estimate_dicom_cost(dicom_path):
+    """Relative cost of converting a DICOM series: (file count, total bytes)."""
+    file_count = 0
+    total_size = 0
+
+    for entry in os.scandir(dicom_path):
+        if entry.is_file():
+            file_count += 1
+            total_size += entry.stat().st_size
+
+    return (file_count, total_size)
+
+def order_by_cost(tasks):
+    """Sort tasks most expensive first so that long units do not end up in the tail."""
+    return sorted(tasks, key=lambda task: task["cost"], reverse=True)
+
+def _task_entry(func, args, kwargs, conn, threads_per_worker):
+    """Child process body: run one task and send its outcome back to the parent."""
+    # Own process group, so a timeout also kills dcm2niix/FSL subprocesses
+    os.setsid()
+    # Not the parent's handler (see terminate_on_sigterm)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    if threads_per_worker is not None:
+        set_thread_env(threads_per_worker)
+
+    try:
+        result = func(*args, **kwargs)
+    except BaseException:
+        conn.send(("error", traceback.format_exc()))
+    else:
+        # ru_maxrss is in kilobytes on Linux; FSL/ANTs subprocesses are counted through RUSAGE_CHILDREN
+        peak_rss = 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        conn.send(("ok", (result, peak_rss)))
+    finally:
+        conn.close()
+
+def _start_task(func, task, attempt, timeout, threads_per_worker):
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_task_entry, args=(func, task["args"], task.get("kwargs", {}), send_conn, threads_per_worker), daemon=False)
+    process.start()
+    send_conn.close()
+
+    deadline = time.monotonic() + timeout if timeout else None
+    return {"task": task, "attempt": attempt, "process": process, "conn": recv_conn, "deadline": deadline, "timeout": timeout, "outcome": None}
+
+def _kill_task(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+def _kill_running(scheduler):
+    """Kill the process group of every running task (their own groups are not reached by signals to the parent's)."""
+    for state in scheduler["running"]:
+        _kill_task(state["process"])
+        state["process"].join()
+        state["conn"].close()
+
+    scheduler["running"] = []
+
+@contextlib.contextmanager
+def terminate_on_sigterm():
+    """Raise SystemExit on SIGTERM (scancel, kill) so that cleanup in finally blocks runs; main thread only."""
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        raise SystemExit(128 + signum)
+
+    previous = signal.signal(signal.SIGTERM, handler)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+def _receive_outcome(state):
+    """Read the task's outcome from its pipe once it is available."""
+    if state["outcome"] is None and state["conn"].poll():
+        try:
+            state["outcome"] = state["conn"].recv()
+        except EOFError:
+            state["outcome"] = ("crashed", f"Exit code {state['process'].exitcode}")
+
+def _finish_task(state, timed_out):
+    """Reap a finished (or timed out) task and return (status, message)."""
+    process = state["process"]
+
+    if timed_out:
+        _kill_task(process)
+        process.join()
+        outcome = ("timeout", f"No result after {state['timeout']} s")
+    else:
+        process.join()
+        _receive_outcome(state)
+        outcome = state["outcome"] or ("crashed", f"Exit code {process.exitcode}")
+
+    state["conn"].close()
+    return outcome
+
+def write_failure_report(failure_report, failures):
+    """Write failures (task, status, attempts, message dicts) to a CSV file."""
+    with open(failure_report, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["task", "status", "attempts", "message"])
+        writer.writeheader()
+        writer.writerows(failures)
+
+def _next_admissible(pending, running, memory_budget):
+    """Index of the first pending task whose memory estimate fits next to the running ones."""
+    if memory_budget is None or not running:
+        return 0
+
+    in_use = sum(state["task"].get("memory", 0) for state in running)
+    for index, (task, _) in enumerate(pending):
+        if in_use + task.get("memory", 0) <= memory_budget:
+            return index
+
+    return None
+
+# ==========================================
+# Scheduler state (run_tasks, streaming pipelines)
+# ==========================================
+# run_tasks drives a scheduler dict round by round until its queue is
+# empty. A task stream (start_task_stream) runs the same rounds in a
+# process of its own that also receives new tasks over a pipe while
+# earlier ones run, with the same admission, timeout and retry rules. Each
+# round blocks until a task finishes, times out or a task arrives, and
+# task processes are forked from that single-threaded process, not from
+# the producer (e.g. an asyncio event loop with its child watcher threads).
+
+def new_scheduler(func, num_workers, timeout=None, retries=0, threads_per_worker=None, memory_budget=None, memory_history=None, on_result=None):
+    """Empty scheduler for func (arguments as in run_tasks)."""
+    return {
+        "func": func, "num_workers": num_workers, "timeout": timeout, "retries": retries,
+        "threads_per_worker": threads_per_worker, "memory_budget": memory_budget,
+        "memory_history": memory_history, "on_result": on_result,
+        "pending": collections.deque(), "running": [], "failures": [], "submitted": 0
+    }
+
+def submit_task(scheduler, task):
+    """Queue a task (see run_tasks) behind the tasks already pending."""
+    scheduler["pending"].append((task, 1))
+    scheduler["submitted"] += 1
+
+def scheduler_busy(scheduler):
+    """True while tasks are pending or running."""
+    return bool(scheduler["pending"] or scheduler["running"])
+
+def schedule_round(scheduler, waitables=()):
+    """
+    Start admissible tasks, wait for one to finish (or until the next timeout,
+    or until one of waitables, e.g. a pipe of incoming tasks, is ready), then
+    reap finished tasks.
+    """
+    pending, running = scheduler["pending"], scheduler["running"]
+    func, timeout, retries = scheduler["func"], scheduler["timeout"], scheduler["retries"]
+    memory_history, on_result = scheduler["memory_history"], scheduler["on_result"]
+
+    while pending and len(running) < scheduler["num_workers"]:
+        index = _next_admissible(pending, running, scheduler["memory_budget"])
+        if index is None:
+            break
+        task, attempt = pending[index]
+        del pending[index]
+        running.append(_start_task(func, task, attempt, timeout, scheduler["threads_per_worker"]))
+
+    deadlines = [state["deadline"] for state in running if state["deadline"] is not None]
+    wait_timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+    waitables = [state["process"].sentinel for state in running] + [state["conn"] for state in running if state["outcome"] is None] + list(waitables)
+    if waitables:
+        multiprocessing.connection.wait(waitables, timeout=wait_timeout)
+
+    now = time.monotonic()
+    still_running = []
+
+    for state in running:
+        _receive_outcome(state)
+        timed_out = state["deadline"] is not None and now >= state["deadline"]
+
+        if state["process"].is_alive() and not timed_out:
+            still_running.append(state)
+            continue
+
+        status, message = _finish_task(state, timed_out and state["process"].is_alive())
+        task, attempt = state["task"], state["attempt"]
+        name = task.get("name", str(task["args"]))
+
+        if status == "ok":
+            result, peak_rss = message
+            if memory_history is not None and task.get("memory"):
+                _record_memory(memory_history, name, task.get("memory_kind"), task.get("memory_estimate", task["memory"]), peak_rss)
+            if on_result is not None:
+                on_result(task, status, result)
+            continue
+
+        if attempt <= retries:
+            log_print(f"Task {name} failed ({status}), retrying ({attempt}/{retries})")
+            pending.append((task, attempt + 1))
+        else:
+            log_print(f"Task {name} failed ({status}) after {attempt} attempt(s):\n{message}")
+            scheduler["failures"].append({"task": name, "status": status, "attempts": attempt, "message": message})
+            if on_result is not None:
+                on_result(task, status, message)
+
+    scheduler["running"] = still_running
+
+def run_tasks(func, tasks, num_workers, timeout=None, retries=0, failure_report=None, threads_per_worker=None, memory_budget=None, memory_history=None, on_result=None):
+    """
+    Run func(*task["args"], **task["kwargs"]) for every task, each in its own process.
+
+    Args:
+    - func (callable): Module-level function executed for each task.
+    - tasks (list): Dicts with "args" (tuple) and optionally "kwargs" (dict) and "name" (str).
+    - num_workers (int): Maximum number of tasks running at the same time.
+    - timeout (float): Seconds after which a task and all of its subprocesses are killed.
+    - retries (int): How many times a failed or timed out task is retried.
+    - failure_report (str): CSV file listing the tasks that failed after all retries.
+    - threads_per_worker (int): ITK/OpenMP/BLAS thread budget set in each task's process.
+    - memory_budget (int): Bytes available to all running tasks together.
+    - memory_history (str): CSV to which each task's estimated and measured peak RSS is appended.
+      The uncalibrated estimate is recorded when given in task["memory_estimate"], and
+      task["memory_kind"] (see load_memory_calibration) with it.
+    - on_result (callable): Called in this (parent) process as on_result(task, status, result)
+      when a task succeeds (status "ok", result = func's return value) or fails for the last
+      time (status "error", "timeout" or "crashed", result = the error message).
+
+    With a memory budget, a task (with an estimate in task["memory"]) only
+    starts when it fits next to the tasks already running; smaller tasks
+    further down the queue may start first. A task always starts when
+    nothing else is running, so an oversized estimate cannot stall the run.
+
+    Tasks are started in the given order as soon as a slot frees up. An
+    exception, crash or timeout only fails its own task; the remaining tasks
+    keep running. If this process is interrupted (Ctrl-C, SIGTERM), the
+    running tasks and their subprocesses are killed before it exits.
+    Returns the list of failures written to the report.
+    """
+    scheduler = new_scheduler(func, num_workers, timeout, retries, threads_per_worker, memory_budget, memory_history, on_result)
+    for task in tasks:
+        submit_task(scheduler, task)
+
+    # Tasks run in their own process groups: stop them if this process is interrupted or terminated
+    with terminate_on_sigterm():
+        try:
+            while scheduler_busy(scheduler):
+                schedule_round(scheduler)
+        finally:
+            _kill_running(scheduler)
+
+    failures = scheduler["failures"]
+
+    if failure_report is not None:
+        write_failure_report(failure_report, failures)
+
+    if failures:
+        log_print(f"{len(failures)} of {len(tasks)} tasks failed" + (f", see {failure_report}" if failure_report else ""))
+
+    return failures
+
+def _task_stream_entry(scheduler, task_conn, result_conn, producer_conns):
+    """Task stream process body: run tasks from task_conn until None, then send back the failures."""
+    # The producer's ends of the pipes (inherited), so that its exit closes the stream
+    for conn in producer_conns:
+        conn.close()
+
+    streaming = True
+
+    with terminate_on_sigterm():
+        try:
+            while streaming or scheduler_busy(scheduler):
+                # Queue everything received so far; None (or the producer's end closing) ends the stream
+                while streaming and task_conn.poll():
+                    try:
+                        task = task_conn.recv()
+                    except EOFError:
+                        task = None
+                    if task is None:
+                        streaming = False
+                    else:
+                        submit_task(scheduler, task)
+
+                schedule_round(scheduler, [task_conn] if streaming else [])
+        finally:
+            _kill_running(scheduler)
+
+    result_conn.send(scheduler["failures"])
+
+def start_task_stream(func, num_workers, timeout=None, retries=0, threads_per_worker=None, memory_budget=None, memory_history=None):
+    """
+    Start a process that runs tasks (see run_tasks) as they are submitted with stream_task.
+
+    Start it before anything that must not be forked (an event loop, threads)
+    and after the data that tasks share copy-on-write is loaded. Every task
+    is a child of the stream process; on_result is not available. Close it
+    with finish_task_stream and, in a finally block, stop_task_stream.
+    """
+    task_recv, task_send = multiprocessing.Pipe(duplex=False)
+    result_recv, result_send = multiprocessing.Pipe(duplex=False)
+
+    scheduler = new_scheduler(func, num_workers, timeout, retries, threads_per_worker, memory_budget, memory_history)
+    # Not a daemon: it starts the task processes
+    process = multiprocessing.Process(target=_task_stream_entry, args=(scheduler, task_recv, result_send, (task_send, result_recv)), daemon=False)
+    process.start()
+    task_recv.close()
+    result_send.close()
+
+    return {"process": process, "conn": task_send, "result_conn": result_recv, "submitted": 0}
+
+def stream_task(stream, task):
+    """Queue a task behind the tasks already submitted to a task stream."""
+    stream["conn"].send(task)
+    stream["submitted"] += 1
+
+def finish_task_stream(stream):
+    """End a task stream, wait until all of its tasks are done and return their failures."""
+    stream["conn"].send(None)
+    stream["conn"].close()
+
+    multiprocessing.connection.wait([stream["result_conn"], stream["process"].sentinel])
+    failures = None
+    if stream["result_conn"].poll():
+        try:
+            failures = stream["result_conn"].recv()
+        except EOFError:
+            pass
+    stream["process"].join()
+
+    if failures is None:
+        raise RuntimeError(f"Task stream exited with code {stream['process'].exitcode}")
+    return failures
+
+def stop_task_stream(stream):
+    """Terminate a task stream that is still running; it kills its running tasks before exiting."""
+    if stream["process"].is_alive():
+        stream["process"].terminate()
+    stream["process"].join()
@@ -0,0 +1,450 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import datetime
+import itertools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+from scipy.io import loadmat
+from scipy.ndimage import affine_transform
+
+import ants
+from nipype.interfaces.fsl import ApplyWarp, InvWarp
+
+from nifti_utils import iter_volumes, write_volumes
+from reference_utils import get_template
+
+def _chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def _template_4d_header(template_img, moving_img):
+    """Float32 header on the template grid with the moving run's timepoints and TR."""
+    header = nib.Nifti1Header()
+    header.set_data_shape(template_img.shape[:3] + (moving_img.shape[3],))
+    header.set_data_dtype(np.float32)
+    header.set_qform(template_img.affine, code=1)
+    header.set_sform(template_img.affine, code=1)
+    header.set_zooms(template_img.header.get_zooms()[:3] + (moving_img.header.get_zooms()[3],))
+    header.set_xyzt_units(*moving_img.header.get_xyzt_units())
+    return header
+
+def load_ants_affine(mat_path):
+    """
+    4x4 RAS matrix of an ANTs affine transform file (e.g. *0GenericAffine.mat).
+
+    Like every ITK transform it maps points of the fixed space to points of
+    the moving space: y = A (x - c) + c + t in LPS, converted here to RAS.
+    """
+    mat = loadmat(mat_path)
+    key = next(k for k in mat if k.startswith("AffineTransform") or k.startswith("MatrixOffsetTransformBase"))
+    params = mat[key].ravel()
+    center = mat["fixed"].ravel()
+
+    linear = params[:9].reshape(3, 3)
+    translation = params[9:12]
+
+    lps = np.eye(4)
+    lps[:3, :3] = linear
+    lps[:3, 3] = translation + center - linear @ center
+
+    flip = np.diag([-1.0, -1.0, 1.0, 1.0])
+    return flip @ lps @ flip
+
+def fsl_coordinate_matrix(img):
+    """
+    Voxel index -> FSL scaled-voxel coordinates of an image.
+
+    FSL (FLIRT/MCFLIRT) matrices act on voxel indices scaled by the voxel
+    size, with x flipped when the voxel-to-world affine has a positive
+    determinant (neurological storage order).
+    """
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    swap = np.eye(4)
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        swap[0, 0] = -1.0
+        swap[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return swap @ np.diag(list(zooms) + [1.0])
+
+def warp_4d_single_interpolation(ref_template, moving_4d_path, ants_affine_path, fsl_mat_paths, out_path, mask_path=None):
+    """
+    Resample a raw (or slice-time corrected) run straight into template space.
+
+    For every volume t, the MCFLIRT matrix (volume t -> reference volume, FSL
+    coordinates) and the ANTs affine (template -> reference, world
+    coordinates) are composed into a single template-voxel -> volume-voxel
+    matrix, so each volume is interpolated (trilinear) only once instead of
+    once by MCFLIRT and again by ANTs.
+
+    Args:
+    - ref_template (str): Fixed image defining the output grid.
+    - moving_4d_path (str): Run to resample, on the same grid as the MCFLIRT reference.
+    - ants_affine_path (str): ANTs affine from registering the reference (mean) image to the template.
+    - fsl_mat_paths (list): MCFLIRT per-volume matrices (MAT_0000, MAT_0001, ...).
+    - out_path (str): Output 4D NIfTI (float32).
+    - mask_path (str): Optional brain mask on the template grid applied to every output volume.
+    """
+    template_img = nib.load(ref_template)
+    moving_img = nib.load(moving_4d_path)
+
+    if len(fsl_mat_paths) != moving_img.shape[3]:
+        raise ValueError(f"{len(fsl_mat_paths)} MCFLIRT matrices for {moving_img.shape[3]} volumes")
+
+    coords = fsl_coordinate_matrix(moving_img)
+    # template voxel -> reference voxel
+    template_to_reference = np.linalg.inv(moving_img.affine) @ load_ants_affine(ants_affine_path) @ template_img.affine
+
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0 if mask_path is not None else None
+
+    out_shape = template_img.shape[:3]
+    grid = np.ix_(*(np.arange(n) for n in out_shape))
+
+    def inside_grid(matrix):
+        # As in ITK: points within half a voxel of the moving grid are
+        # interpolated (clamped to the edge voxels), points beyond it are zero
+        inside = np.ones(out_shape, dtype=bool)
+        for axis, n in enumerate(moving_img.shape[:3]):
+            index = matrix[axis, 3] + sum(matrix[axis, k] * grid[k] for k in range(3))
+            inside &= (index >= -0.5) & (index < n - 0.5)
+        return inside
+
+    def resampled_volumes():
+        for vol, mat_path in zip(iter_volumes(moving_4d_path), fsl_mat_paths):
+            volume_to_reference = np.loadtxt(mat_path)
+            matrix = np.linalg.inv(coords) @ np.linalg.inv(volume_to_reference) @ coords @ template_to_reference
+
+            out = affine_transform(vol, matrix[:3, :3], offset=matrix[:3, 3], output_shape=out_shape, order=1, mode="nearest")
+            out *= inside_grid(matrix)
+            if mask is not None:
+                out *= mask
+            yield out
+
+    write_volumes(out_path, _template_4d_header(template_img, moving_img), resampled_volumes())
+
+def _map(func, items, num_threads):
+    if num_threads > 1 and len(items) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            return list(executor.map(func, items))
+    return [func(item) for item in items]
+
+def apply_transforms_batch(ref_template, images, transformlist, out_paths=None, num_threads=1, whichtoinvert=None):
+    """
+    Warp several 3D images through the same transforms in one call.
+
+    The template is taken from the reference cache and, when transformlist
+    has more than one transform, the chain is composed once into a single
+    displacement field on the template grid (exact at the output voxels), so
+    each image costs one resample.
+
+    Args:
+    - ref_template (str or ANTsImage): Fixed image defining the output grid.
+    - images (list): (moving, interpolator) pairs; moving is a path or an
+      ANTsImage, interpolator as in ants.apply_transforms ("linear",
+      "nearestNeighbor", ...).
+    - transformlist (list): Transforms as passed to ants.apply_transforms (e.g. reg["fwdtransforms"]).
+    - out_paths (list): Optional output paths, one per image.
+    - num_threads (int): Images warped concurrently.
+    - whichtoinvert (list): As in ants.apply_transforms.
+
+    Returns the warped ANTsImages, in the order of images.
+    """
+    fixed = get_template(ref_template) if isinstance(ref_template, str) else ref_template
+    moving_images = [ants.image_read(moving) if isinstance(moving, str) else moving for moving, _ in images]
+
+    with tempfile.TemporaryDirectory(prefix="apply_transforms_batch_") as tmp_dir:
+        if len(transformlist) > 1:
+            composite = ants.apply_transforms(fixed=fixed, moving=moving_images[0], transformlist=transformlist, whichtoinvert=whichtoinvert, compose=os.path.join(tmp_dir, ""))
+            transformlist, whichtoinvert = [composite], None
+
+        def warp(index):
+            return ants.apply_transforms(
+                fixed=fixed,
+                moving=moving_images[index],
+                transformlist=transformlist,
+                interpolator=images[index][1],
+                whichtoinvert=whichtoinvert,
+                imagetype=0
+            )
+
+        warped = _map(warp, list(range(len(images))), num_threads)
+
+    if out_paths is not None:
+        for warped_image, out_path in zip(warped, out_paths):
+            warped_image.to_filename(out_path)
+
+    return warped
+
+def apply_fsl_warp_batch(ref_template, field_file, images, num_workers=1):
+    """
+    FSL applywarp of several images through the same FNIRT warp.
+
+    applywarp takes one input per call, so the calls are run as concurrent
+    subprocesses instead of one after another.
+
+    Args:
+    - ref_template (str): Reference image (output grid).
+    - field_file (str): FNIRT warp (e.g. fieldcoeff_file).
+    - images (list): (in_file, out_file, interp) triples; interp as in ApplyWarp ("trilinear", "nn", ...).
+    - num_workers (int): Concurrent applywarp processes.
+    """
+    def warp(image):
+        in_file, out_file, interp = image
+        ApplyWarp(in_file=in_file, ref_file=ref_template, field_file=field_file, out_file=out_file, interp=interp).run()
+        return out_file
+
+    return _map(warp, list(images), num_workers)
+
+def warp_4d_chunked(ref_template, moving_4d_path, moving_reference_path, transformlist, out_path, chunk_size=16, num_threads=1, interpolator="linear"):
+    """
+    Warp a 4D image to the template space in blocks of timepoints.
+
+    Equivalent to ants.apply_transforms(..., imagetype=3), which warps every
+    volume with the same 3D transform, but the run is never held in memory
+    as a whole: volumes are streamed from moving_4d_path, warped chunk_size
+    at a time (optionally spread over num_threads threads) and written into
+    an output whose header already declares all timepoints.
+
+    Args:
+    - ref_template (str): Fixed image defining the output grid.
+    - moving_4d_path (str): 4D image to warp.
+    - moving_reference_path (str): 3D image in the same space as the moving
+      volumes (e.g. the mean image used for registration), giving their
+      origin, spacing and direction.
+    - transformlist (list): Transforms as passed to ants.apply_transforms (e.g. reg["fwdtransforms"]).
+    - out_path (str): Output 4D NIfTI (float32).
+    """
+    fixed = get_template(ref_template)
+    moving_reference = ants.image_read(moving_reference_path)
+
+    template_img = nib.load(ref_template)
+    moving_img = nib.load(moving_4d_path)
+
+    header = _template_4d_header(template_img, moving_img)
+
+    def warp_volume(vol):
+        moving = ants.from_numpy(
+            vol,
+            origin=moving_reference.origin,
+            spacing=moving_reference.spacing,
+            direction=moving_reference.direction
+        )
+        warped = ants.apply_transforms(
+            fixed=fixed,
+            moving=moving,
+            transformlist=transformlist,
+            interpolator=interpolator,
+            imagetype=0
+        )
+        return warped.numpy().astype(np.float32)
+
+    def warped_volumes(executor):
+        for chunk in _chunks(iter_volumes(moving_4d_path), chunk_size):
+            if executor is None:
+                yield from map(warp_volume, chunk)
+            else:
+                yield from executor.map(warp_volume, chunk)
+
+    if num_threads > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            write_volumes(out_path, header, warped_volumes(executor))
+    else:
+        write_volumes(out_path, header, warped_volumes(None))
+
+# ==========================================
+# Transform store
+# ==========================================
+# Registrations are kept next to their outputs, in <output_dir>/transforms/,
+# with an index (transforms.json) of named entries:
+#   {"mni": {"tool": "ants" | "fsl", "fixed": ..., "moving": ...,
+#            "fwdtransforms": [...], "invtransforms": [...], "invert": [...], "saved": ...}}
+# Transform paths are relative to the transforms directory, image paths to
+# output_dir. "fixed" is the grid of forward results, "moving" the grid of
+# inverse results. reapply_transforms pushes new images through a saved entry.
+
+TRANSFORMS_DIRNAME = "transforms"
+TRANSFORM_INDEX = "transforms.json"
+
+# Transform files ants.registration writes after its outprefix
+ANTS_TRANSFORM_SUFFIXES = ("0GenericAffine.mat", "1Warp.nii.gz", "1InverseWarp.nii.gz")
+
+# ANTs interpolator names -> FSL applywarp names
+FSL_INTERPOLATORS = {"linear": "trilinear", "nearestNeighbor": "nn", "bSpline": "spline", "lanczosWindowedSinc": "sinc"}
+
+def transform_index_path(output_dir):
+    return os.path.join(output_dir, TRANSFORMS_DIRNAME, TRANSFORM_INDEX)
+
+def load_transform_index(output_dir):
+    """Saved transform entries of an output directory ({} if none)."""
+    index_path = transform_index_path(output_dir)
+    if not os.path.exists(index_path):
+        return {}
+
+    with open(index_path) as f:
+        return json.load(f)
+
+def transform_files(output_dir, name):
+    """
+    transforms.json and the stored files of one entry, e.g. as checkpoint outputs.
+
+    Only the index if there is no such entry (yet), so a checkpoint written
+    after save_transforms no longer matches once the entry is gone.
+    """
+    try:
+        entry = load_transform_index(output_dir).get(name)
+    except ValueError:
+        entry = None
+
+    files = [transform_index_path(output_dir)]
+    if entry is None:
+        return files
+
+    transforms_dir = os.path.join(output_dir, TRANSFORMS_DIRNAME)
+    files += [os.path.join(transforms_dir, path) for path in sorted(set(entry["fwdtransforms"]) | set(entry["invtransforms"]))]
+
+    # In-memory moving images are saved in the store (see _image_reference)
+    if entry["moving"].startswith(TRANSFORMS_DIRNAME + os.sep):
+        files.append(os.path.join(output_dir, entry["moving"]))
+
+    return files
+
+def _write_transform_entry(output_dir, name, entry):
+    index = load_transform_index(output_dir)
+    index[name] = dict(entry, saved=datetime.datetime.now().isoformat(timespec="seconds"))
+
+    index_path = transform_index_path(output_dir)
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+def registration_prefix(output_dir, name):
+    """
+    outprefix for ants.registration, so that the transforms of an entry are
+    written straight into the store (transforms/<name>_0GenericAffine.mat, ...).
+    """
+    transforms_dir = os.path.join(output_dir, TRANSFORMS_DIRNAME)
+    os.makedirs(transforms_dir, exist_ok=True)
+    return os.path.join(transforms_dir, f"{name}_")
+
+def _stored_name(prefix, path):
+    # Only the files ants.registration writes after the prefix (affine, SyN warps)
+    suffix = path[len(prefix):] if path.startswith(prefix) else None
+    if suffix not in ANTS_TRANSFORM_SUFFIXES:
+        raise ValueError(f"{path} is not an ANTs transform written with outprefix {prefix} (see registration_prefix)")
+    return os.path.basename(path)
+
+def _image_reference(output_dir, transforms_dir, name, role, image):
+    # Path relative to output_dir; in-memory images are saved in the store
+    if isinstance(image, str):
+        return os.path.relpath(image, output_dir)
+
+    path = os.path.join(transforms_dir, f"{name}_{role}.nii.gz")
+    image.to_filename(path)
+    return os.path.relpath(path, output_dir)
+
+def save_transforms(output_dir, name, reg, fixed, moving):
+    """
+    Keep an ANTs registration's forward and inverse transforms in the store.
+
+    Args:
+    - output_dir (str): Directory of the registered file's outputs.
+    - name (str): Entry name (e.g. "mni").
+    - reg (dict): Result of ants.registration with outprefix=registration_prefix(output_dir, name).
+    - fixed (str): Fixed image path (e.g. the template).
+    - moving (str or ANTsImage): Moving image path, or the image itself if it is not kept on disk.
+    """
+    transforms_dir = os.path.join(output_dir, TRANSFORMS_DIRNAME)
+    prefix = registration_prefix(output_dir, name)
+
+    stored = {path: _stored_name(prefix, path) for path in set(reg["fwdtransforms"]) | set(reg["invtransforms"])}
+    invtransforms = [stored[path] for path in reg["invtransforms"]]
+
+    _write_transform_entry(output_dir, name, {
+        "tool": "ants",
+        "fixed": os.path.abspath(fixed),
+        "moving": _image_reference(output_dir, transforms_dir, name, "moving", moving),
+        "fwdtransforms": [stored[path] for path in reg["fwdtransforms"]],
+        "invtransforms": invtransforms,
+        # Affine matrices in the inverse chain are applied inverted
+        "invert": [path.endswith(".mat") for path in invtransforms]
+    })
+
+def save_fsl_warp(output_dir, name, fieldcoeff_file, ref_template, moving_path):
+    """
+    Keep a FNIRT warp in the store, with its inverse (computed with invwarp).
+
+    Args:
+    - output_dir (str): Directory of the registered file's outputs.
+    - name (str): Entry name (e.g. "mni").
+    - fieldcoeff_file (str): FNIRT field coefficients (moving -> reference).
+    - ref_template (str): FNIRT reference image.
+    - moving_path (str): FNIRT input image.
+    """
+    transforms_dir = os.path.join(output_dir, TRANSFORMS_DIRNAME)
+    os.makedirs(transforms_dir, exist_ok=True)
+
+    warp_name = f"{name}_fieldcoeff.nii.gz"
+    inverse_name = f"{name}_inverse_warp.nii.gz"
+    shutil.copyfile(fieldcoeff_file, os.path.join(transforms_dir, warp_name))
+
+    InvWarp(
+        warp=os.path.join(transforms_dir, warp_name),
+        reference=moving_path,
+        inverse_warp=os.path.join(transforms_dir, inverse_name)
+    ).run()
+
+    _write_transform_entry(output_dir, name, {
+        "tool": "fsl",
+        "fixed": os.path.abspath(ref_template),
+        "moving": os.path.relpath(moving_path, output_dir),
+        "fwdtransforms": [warp_name],
+        "invtransforms": [inverse_name],
+        "invert": [False]
+    })
+
+def reapply_transforms(output_dir, name, images, out_paths, inverse=False, num_threads=1):
+    """
+    Push new images through a saved registration, without registering again.
+
+    Args:
+    - output_dir (str): Directory holding transforms/transforms.json.
+    - name (str): Entry name (e.g. "mni").
+    - images (list): (path, interpolator) pairs, ANTs interpolator names
+      ("linear", "nearestNeighbor", ...; mapped for FSL entries).
+    - out_paths (list): Output paths, one per image.
+    - inverse (bool): Template -> subject space (e.g. an atlas) instead of subject -> template.
+    - num_threads (int): Images warped concurrently.
+    """
+    index = load_transform_index(output_dir)
+    if name not in index:
+        raise KeyError(f"No saved transform '{name}' in {transform_index_path(output_dir)}")
+
+    entry = index[name]
+    transforms_dir = os.path.join(output_dir, TRANSFORMS_DIRNAME)
+    key = "invtransforms" if inverse else "fwdtransforms"
+    transformlist = [os.path.join(transforms_dir, path) for path in entry[key]]
+    target = entry["moving"] if inverse else entry["fixed"]
+    target = os.path.join(output_dir, target)  # absolute paths are kept as is
+
+    if entry["tool"] == "fsl":
+        warp_images = [(path, out_path, FSL_INTERPOLATORS.get(interpolator, interpolator)) for (path, interpolator), out_path in zip(images, out_paths)]
+        return apply_fsl_warp_batch(target, transformlist[0], warp_images, num_workers=num_threads)
+
+    return apply_transforms_batch(
+        ants.image_read(target),
+        images,
+        transformlist=transformlist,
+        out_paths=out_paths,
+        num_threads=num_threads,
+        whichtoinvert=entry["invert"] if inverse else None
+    )
@@ -1,5 +1,9 @@
 #!/bin/bash
 
+# No longer needed for conversion / preprocessing: pass ptid_date_list.csv as
+# cohort= to convert_dicom_to_nifti_parallel and the preprocessing drivers,
+# which read the listed series in place from src_root (see Python/cohort_utils.py).
+
 src_root="/node05_storage/ADNI/fMRI/dicom"
 dst_root="/node05_storage/ADNI/Axial_rsfMRI__Eyes_Open_/dicom"
 csv_file="/home/dhseo/Project/ADNI/result/ptid_date_list.csv"
@@ -32,7 +32,10 @@ docker load -i "$IMAGE_TAR"
 
 # Run the container
 echo "Running the preprocessing MRI..."
+# The Slurm allocation is passed in for resource_utils (cores / memory budget of the job)
 docker run --rm \
+    -e SLURM_CPUS_PER_TASK \
+    -e SLURM_MEM_PER_NODE \
     -v /node05_storage:/root/data \
     -v /home/dhseo/Project:/root/Project \
     "$DOCKER_IMAGE" \
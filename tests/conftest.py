@@ -0,0 +1,10 @@
+
+# -*- coding: utf-8 -*-
+
+# python -m pytest -q tests
+
+import os
+import sys
+
+# The Python/ modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Python"))
@@ -0,0 +1,139 @@
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from atlas_utils import masked_roi_timeseries, roi_statistics, roi_timeseries_from_nifti, build_atlas_index, roi_voxels, lookup_voxels, lookup_mm, label_names
+
+nilearn_maskers = pytest.importorskip("nilearn.maskers")
+
+def _atlas(shape=(10, 12, 9), seed=0):
+    rng = np.random.default_rng(seed)
+    # Labels with gaps, a label absent from the mask, negative-free like AAL
+    atlas = rng.choice([0, 0, 2001, 2002, 4021, 7001], size=shape).astype(np.int32)
+    atlas[0] = 9170
+    return atlas
+
+def _masked(atlas, timepoints=25, seed=1):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(atlas.shape, dtype=bool)
+    mask[1:, 2:10, 1:8] = True
+    data = rng.standard_normal((timepoints, int(mask.sum()))).astype(np.float32)
+    return {"data": data, "mask": mask, "affine": np.diag([2.0, 2.0, 2.0, 1.0]), "tr": 2.0}
+
+def test_roi_means_count_out_of_mask_voxels_as_zero():
+    atlas = _atlas()
+    masked = _masked(atlas)
+
+    roi_df = masked_roi_timeseries(masked, atlas, {2001: "Precentral_L", 4021: "Cingulum_Post_L"})
+
+    assert list(roi_df.columns) == ["Precentral_L", "ROI_2002", "Cingulum_Post_L", "ROI_7001", "ROI_9170"]
+    # Naive reference: sum of the ROI's in-mask voxels over all of its voxels
+    full = np.zeros((masked["data"].shape[0],) + atlas.shape, dtype=np.float64)
+    full[:, masked["mask"]] = masked["data"]
+    for label, column in zip([2001, 2002, 4021, 7001, 9170], roi_df.columns):
+        expected = full[:, atlas == label].sum(axis=1) / np.count_nonzero(atlas == label)
+        np.testing.assert_allclose(roi_df[column].to_numpy(), expected, rtol=1e-5, atol=1e-7)
+
+    # Label 9170 lies entirely outside the mask
+    assert not roi_df["ROI_9170"].any()
+
+def test_matches_nifti_labels_masker():
+    atlas = _atlas()
+    masked = _masked(atlas)
+
+    full = np.zeros(atlas.shape + (masked["data"].shape[0],), dtype=np.float32)
+    full[masked["mask"]] = masked["data"].T
+    expected = nilearn_maskers.NiftiLabelsMasker(nib.Nifti1Image(atlas, masked["affine"])).fit_transform(nib.Nifti1Image(full, masked["affine"]))
+
+    np.testing.assert_allclose(masked_roi_timeseries(masked, atlas).to_numpy(), expected, atol=1e-6)
+
+def test_roi_statistics_match_per_roi_masks():
+    atlas = _atlas()
+    rng = np.random.default_rng(2)
+    maps = {"T1": rng.random(atlas.shape) * 1000, "GM": rng.random(atlas.shape)}
+
+    stats = roi_statistics(atlas, maps, voxel_volume=8.0, roi_labels_dict={2001: "Precentral_L"})
+
+    assert len(stats) == 5 * 2
+    assert stats[stats["roi_index"] == 2001]["roi_name"].unique().tolist() == ["Precentral_L"]
+    for row in stats.itertuples():
+        values = maps[row.map][atlas == row.roi_index]
+        assert row.voxel_count == values.size
+        assert row.volume_mm3 == 8.0 * values.size
+        assert np.isclose(row.sum, values.sum())
+        assert np.isclose(row.mean, values.mean())
+        assert np.isclose(row.std, values.std())
+        assert np.isclose(row.weighted_volume_mm3, 8.0 * values.sum())
+
+def test_roi_statistics_rejects_maps_off_the_atlas_grid():
+    with pytest.raises(ValueError):
+        roi_statistics(_atlas(), {"GM": np.zeros((2, 2, 2))}, voxel_volume=1.0)
+
+def _index(atlas, roi_labels_dict=None, affine=np.diag([2.0, 2.0, 2.0, 1.0])):
+    return build_atlas_index(nib.Nifti1Image(atlas.astype(np.int16), affine), roi_labels_dict)
+
+def test_atlas_index_groups_voxels_by_label():
+    atlas = _atlas()
+    atlas_index = _index(atlas, {2001: "Precentral_L"})
+
+    np.testing.assert_array_equal(atlas_index["label_values"], [2001, 2002, 4021, 7001, 9170])
+    assert atlas_index["names"][:2] == ["Precentral_L", "ROI_2002"]
+    for label, count in zip(atlas_index["label_values"], atlas_index["counts"]):
+        voxels = roi_voxels(atlas_index, label)
+        assert count == len(voxels)
+        np.testing.assert_array_equal(np.sort(voxels), np.flatnonzero(atlas.ravel() == label))
+    assert len(roi_voxels(atlas_index, 1234)) == 0
+
+    centroid = np.argwhere(atlas == 4021).mean(axis=0)
+    np.testing.assert_allclose(atlas_index["centroids_vox"][2], centroid)
+    np.testing.assert_allclose(atlas_index["centroids_mm"][2], 2.0 * centroid)
+
+def test_atlas_index_lookups():
+    atlas = _atlas()
+    atlas_index = _index(atlas, {2001: "Precentral_L"})
+    x, y, z = np.argwhere(atlas == 2001)[0]
+
+    np.testing.assert_array_equal(lookup_voxels(atlas_index, [[x, y, z], [-1, 0, 0]]), [2001, -1])
+    np.testing.assert_array_equal(lookup_mm(atlas_index, [[2.0 * x, 2.0 * y, 2.0 * z]]), [2001])
+    assert label_names(atlas_index, [2001, 0, 1234]) == ["Precentral_L", "background", None]
+
+def test_reductions_accept_an_atlas_index(tmp_path):
+    atlas = _atlas()
+    atlas_index = _index(atlas)
+    masked = _masked(atlas)
+
+    from_index = masked_roi_timeseries(masked, atlas_index)
+    from_array = masked_roi_timeseries(masked, atlas)
+    assert list(from_index.columns) == list(from_array.columns)
+    np.testing.assert_allclose(from_index.to_numpy(), from_array.to_numpy())
+
+    maps = {"GM": np.random.default_rng(3).random(atlas.shape)}
+    np.testing.assert_allclose(
+        roi_statistics(atlas_index, maps, 8.0).drop(columns=["roi_name", "map"]).to_numpy(),
+        roi_statistics(atlas, maps, 8.0).drop(columns=["roi_name", "map"]).to_numpy()
+    )
+
+def test_roi_timeseries_from_nifti(tmp_path):
+    atlas = _atlas()
+    masked = _masked(atlas)
+    run = np.zeros(atlas.shape + (masked["data"].shape[0],), dtype=np.float32)
+    run[masked["mask"]] = masked["data"].T
+    run_path = str(tmp_path / "run.nii.gz")
+    nib.save(nib.Nifti1Image(run, masked["affine"]), run_path)
+
+    # Reported labels: one missing from the grid (NaN column), one present but not reported
+    roi_df = roi_timeseries_from_nifti(run_path, _index(atlas), {2001: "Precentral_L"}, mask=masked["mask"], labels=[2001, 2002, 4021, 7001, 5000])
+
+    assert list(roi_df.columns) == ["Precentral_L", "ROI_2002", "ROI_4021", "ROI_5000", "ROI_7001"]
+    assert roi_df["ROI_5000"].isna().all()
+    for label, column in [(2001, "Precentral_L"), (7001, "ROI_7001")]:
+        expected = run[(atlas == label) & masked["mask"]].mean(axis=0)
+        np.testing.assert_allclose(roi_df[column].to_numpy(), expected, rtol=1e-5)
+
+    np.testing.assert_allclose(
+        roi_timeseries_from_nifti(run_path, atlas, mask=masked["mask"]).to_numpy(),
+        roi_timeseries_from_nifti(run_path, _index(atlas), mask=masked["mask"]).to_numpy()
+    )
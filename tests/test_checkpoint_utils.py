@@ -0,0 +1,62 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+
+from checkpoint_utils import step_is_done, mark_step_done, fingerprint_matches, file_fingerprint
+
+def _write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    return str(path)
+
+def _touch_later(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def _step(tmp_path):
+    inputs = [_write(tmp_path / "in.txt", "input")]
+    outputs = [_write(tmp_path / "out.txt", "output")]
+    mark_step_done(str(tmp_path), "step1", inputs, outputs, params={"fwhm": 4}, tool_version="1.0")
+    return inputs, outputs
+
+def test_marker_valid_until_something_changes(tmp_path):
+    inputs, outputs = _step(tmp_path)
+
+    assert step_is_done(str(tmp_path), "step1", inputs, outputs, params={"fwhm": 4}, tool_version="1.0")
+    assert not step_is_done(str(tmp_path), "step2", inputs, outputs, params={"fwhm": 4}, tool_version="1.0")
+    assert not step_is_done(str(tmp_path), "step1", inputs, outputs, params={"fwhm": 6}, tool_version="1.0")
+    assert not step_is_done(str(tmp_path), "step1", inputs, outputs, params={"fwhm": 4}, tool_version="2.0")
+
+def test_changed_input_invalidates(tmp_path):
+    inputs, outputs = _step(tmp_path)
+
+    _write(inputs[0], "INPUT")
+    assert not step_is_done(str(tmp_path), "step1", inputs, outputs, params={"fwhm": 4}, tool_version="1.0")
+
+def test_missing_or_extra_output_invalidates(tmp_path):
+    inputs, outputs = _step(tmp_path)
+
+    extra = _write(tmp_path / "extra.txt", "extra")
+    assert not step_is_done(str(tmp_path), "step1", inputs, outputs + [extra], params={"fwhm": 4}, tool_version="1.0")
+
+    os.remove(outputs[0])
+    assert not step_is_done(str(tmp_path), "step1", inputs, outputs, params={"fwhm": 4}, tool_version="1.0")
+
+def test_touched_file_with_same_content_still_matches(tmp_path):
+    path = _write(tmp_path / "a.txt", "same")
+    fingerprint = file_fingerprint(path)
+
+    _touch_later(path)
+    assert fingerprint_matches(path, fingerprint)
+
+    # Same size, new content: caught by the hash once the mtime changed
+    _write(path, "SAME")
+    _touch_later(path)
+    assert not fingerprint_matches(path, fingerprint)
+
+def test_corrupt_marker_is_not_done(tmp_path):
+    inputs, outputs = _step(tmp_path)
+
+    _write(tmp_path / ".checkpoints" / "step1.json", "{")
+    assert not step_is_done(str(tmp_path), "step1", inputs, outputs, params={"fwhm": 4}, tool_version="1.0")
@@ -0,0 +1,39 @@
+
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import pytest
+
+from cohort_utils import parse_file_id, load_cohort_manifest, filter_by_cohort, dicom_series_key, nifti_file_key
+
+def test_parse_file_id():
+    assert parse_file_id("2024-08-08_12_03_24.0_I10910954") == ("2024-08-08", "I10910954")
+    assert parse_file_id("2024-08-08_12_03_24.0") == ("2024-08-08", None)
+
+def test_load_cohort_manifest_columns(tmp_path):
+    path = str(tmp_path / "cohort.csv")
+    pd.DataFrame({"PTID": ["002_S_0001", "002_S_0001", " 002_S_0002 "], "fmri_date": ["2020-01-01", "2021-02-03", None], "IMAGE_ID": [None, "I2", "I3"]}).to_csv(path, index=False)
+
+    assert load_cohort_manifest(path) == {"002_S_0001": [("2020-01-01", None), ("2021-02-03", "I2")], "002_S_0002": [(None, "I3")]}
+    # The first column containing "date" is the scan date; other formats are normalized
+    assert load_cohort_manifest(pd.DataFrame({"subject_id": ["S"], "DATE": ["2020/01/05"], "EXAMDATE": ["1999-01-01"]})) == {"S": [("2020-01-05", None)]}
+
+    with pytest.raises(ValueError):
+        load_cohort_manifest(pd.DataFrame({"PTID": ["S"], "VISCODE": ["bl"]}))
+    with pytest.raises(ValueError):
+        load_cohort_manifest(pd.DataFrame({"RID": ["1"], "DATE": ["2020-01-01"]}))
+
+def test_filter_dicom_series_and_nifti_files():
+    manifest = {"S1": [("2020-01-01", None)], "S2": [(None, "I7"), ("2022-01-01", "I9")]}
+
+    series = [
+        ("S1", "rsfMRI", "2020-01-01_10_00_00.0", "I1"),
+        ("S1", "rsfMRI", "2021-01-01_10_00_00.0", "I2"),
+        ("S2", "rsfMRI", "2020-06-01_09_00_00.0", "I7"),
+        ("S2", "rsfMRI", "2020-06-01_09_00_00.0", "I9"),
+        ("S3", "rsfMRI", "2020-01-01_10_00_00.0", "I5")
+    ]
+    assert filter_by_cohort(series, manifest, dicom_series_key) == [series[0], series[2]]
+
+    files = [("S1", "/nifti/S1/rsfMRI/2020-01-01_10_00_00.0_I1.nii.gz"), ("S2", "/nifti/S2/rsfMRI/2022-01-01_08_00_00.0_I9.nii.gz"), ("S2", "/nifti/S2/rsfMRI/2022-01-01_08_00_00.0_I8.nii.gz")]
+    assert filter_by_cohort(files, manifest, nifti_file_key) == files[:2]
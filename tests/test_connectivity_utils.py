@@ -0,0 +1,129 @@
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from connectivity_utils import (
+    pearson_batch, partial_from_pearson, fisher_z, connectivity_batch, window_starts, sliding_window_batch,
+    to_upper_triangle, from_upper_triangle, n_rois_from_edges, save_connectivity, load_connectivity
+)
+from connectivity_cohort import batches_by_length, cohort_connectivity, cohort_dynamic_connectivity
+
+def _timeseries(subjects=4, timepoints=60, rois=7, seed=0):
+    rng = np.random.default_rng(seed)
+    # Correlated ROIs: a shared signal plus noise
+    shared = rng.standard_normal((subjects, timepoints, 1))
+    return shared + rng.standard_normal((subjects, timepoints, rois))
+
+def _partial_reference(x):
+    precision = np.linalg.inv(np.corrcoef(x, rowvar=False))
+    scale = np.sqrt(np.diag(precision))
+    partial = -precision / np.outer(scale, scale)
+    np.fill_diagonal(partial, 1.0)
+    return partial
+
+def test_pearson_and_partial_match_per_subject_reference():
+    x = _timeseries()
+
+    corr = pearson_batch(x)
+    partial = partial_from_pearson(corr)
+
+    for s in range(x.shape[0]):
+        np.testing.assert_allclose(corr[s], np.corrcoef(x[s], rowvar=False), atol=1e-12)
+        np.testing.assert_allclose(partial[s], _partial_reference(x[s]), atol=1e-8)
+
+def test_constant_roi_gets_nan_edges_only():
+    x = _timeseries()
+    x[1, :, 2] = 5.0
+
+    corr = pearson_batch(x)
+    partial = partial_from_pearson(corr)
+
+    assert np.isnan(corr[1, 2]).all() and np.isnan(corr[1, :, 2]).all()
+    assert np.isnan(partial[1, 2]).all()
+    # The other ROIs' partial correlations are those of the run without ROI 2
+    others = [0, 1, 3, 4, 5, 6]
+    np.testing.assert_allclose(partial[1][np.ix_(others, others)], _partial_reference(x[1][:, others]), atol=1e-8)
+    # Other subjects are unaffected
+    assert not np.isnan(corr[[0, 2, 3]]).any()
+
+def test_upper_triangle_features():
+    x = _timeseries(rois=5)
+    features = connectivity_batch(x)
+
+    assert set(features) == {"pearson", "partial", "fisher_z"}
+    assert features["pearson"].shape == (4, 10) and features["pearson"].dtype == np.float32
+    np.testing.assert_allclose(from_upper_triangle(features["pearson"], 5), pearson_batch(x), atol=1e-6)
+    np.testing.assert_allclose(features["fisher_z"], np.arctanh(features["pearson"].astype(np.float64)), atol=1e-5)
+    assert np.isfinite(fisher_z(np.array([1.0, -1.0]))).all()
+
+    assert n_rois_from_edges(6670) == 116
+    np.testing.assert_array_equal(to_upper_triangle(np.arange(9).reshape(3, 3)), [1, 2, 5])
+
+def test_save_and_load(tmp_path):
+    features = connectivity_batch(_timeseries(subjects=2, rois=3), kinds=("pearson",))
+    path = str(tmp_path / "connectivity.npz")
+
+    save_connectivity(path, features, ["A", "B", "C"], PTID=["002_S_0001", "002_S_0002"])
+    loaded = load_connectivity(path)
+
+    np.testing.assert_array_equal(loaded["pearson"], features["pearson"])
+    assert loaded["roi_names"].tolist() == ["A", "B", "C"]
+    assert loaded["PTID"].tolist() == ["002_S_0001", "002_S_0002"]
+    assert list(zip(loaded["edge_rows"], loaded["edge_cols"])) == [(0, 1), (0, 2), (1, 2)]
+
+def test_cohort_batches_runs_of_equal_length():
+    rng = np.random.default_rng(1)
+    lengths = [40, 60, 40, 60, 60]
+    runs = [({"PTID": str(i)}, rng.standard_normal((length, 6)).astype(np.float32)) for i, length in enumerate(lengths)]
+
+    batches = list(batches_by_length(runs, batch_size=2))
+    assert sorted(i for batch in batches for i in batch) == list(range(5))
+    assert all(len({lengths[i] for i in batch}) == 1 and len(batch) <= 2 for batch in batches)
+
+    features = cohort_connectivity(runs, batch_size=2)
+    for i, (_, timeseries) in enumerate(runs):
+        expected = connectivity_batch(timeseries[None])
+        for kind in features:
+            np.testing.assert_allclose(features[kind][i], expected[kind][0], atol=1e-6)
+
+def test_sliding_window_matches_per_window_reference():
+    x = _timeseries(subjects=2, timepoints=50, rois=5)
+    x[1, 20:32, 3] = 1.0  # flat stretch: constant within some windows only
+    window, stride = 10, 3
+
+    dynamic = sliding_window_batch(x, window, stride)
+    fisher = sliding_window_batch(x, window, stride, fisher=True, dtype=np.float64)
+
+    starts = window_starts(50, window, stride)
+    assert dynamic.shape == (2, len(starts), 10)
+    for s in range(2):
+        for w, start in enumerate(starts):
+            segment = x[s, start:start + window]
+            if np.ptp(segment, axis=0).min() == 0:
+                assert np.isnan(dynamic[s, w]).any()
+                continue
+            expected = to_upper_triangle(np.corrcoef(segment, rowvar=False))
+            np.testing.assert_allclose(dynamic[s, w], expected, atol=1e-5)
+            np.testing.assert_allclose(fisher[s, w], np.arctanh(expected), atol=1e-6)
+    # Windows inside the flat stretch have NaN edges for that ROI only
+    assert np.isnan(dynamic[1, starts.tolist().index(21)]).sum() == 4
+
+def test_window_starts():
+    np.testing.assert_array_equal(window_starts(10, 4, 3), [0, 3, 6])
+    with pytest.raises(ValueError):
+        window_starts(10, 1)
+    with pytest.raises(ValueError):
+        window_starts(10, 11)
+
+def test_cohort_dynamic_pads_shorter_runs():
+    rng = np.random.default_rng(2)
+    runs = [({"PTID": str(i)}, rng.standard_normal((length, 4)).astype(np.float32)) for i, length in enumerate([30, 20, 30])]
+
+    dynamic, n_windows = cohort_dynamic_connectivity(runs, window=10, stride=5, batch_size=2)
+
+    np.testing.assert_array_equal(n_windows, [5, 3, 5])
+    assert dynamic.shape == (3, 5, 6)
+    assert np.isnan(dynamic[1, 3:]).all() and not np.isnan(dynamic[1, :3]).any()
+    np.testing.assert_allclose(dynamic[1, :3], sliding_window_batch(runs[1][1][None], 10, 5)[0], atol=1e-6)
@@ -0,0 +1,173 @@
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+from dicom_prescan import prescan_series, series_geometry, prescan_dicom_tree, select_series, series_from_index
+
+COLUMNS = ["subject_id", "seq", "scan_date", "dicom_folder", "file_count", "series_uid", "series_description", "protocol_name", "acquisition_date", "timepoints", "tr", "error"]
+
+def _index(rows):
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+def _keys(selected):
+    return [(row[0], row[3]) for row in series_from_index(selected)]
+
+INDEX = _index([
+    # S1: the same series filed under two folders, a later scan, and an unreadable folder
+    ("S1", "rsfMRI", "2020-01-01_10_00_00.0", "I1", 200, "uid1", "rsfMRI", "rsfMRI", "20200101", 200, 3.0, None),
+    ("S1", "rsfMRI_copy", "2020-01-01_10_00_00.0", "I2", 150, "uid1", "rsfMRI", "rsfMRI", "20200101", 200, 3.0, None),
+    ("S1", "rsfMRI", "2021-01-01_10_00_00.0", "I3", 200, "uid3", "rsfMRI", "rsfMRI", "20210101", 200, 3.0, None),
+    ("S1", "rsfMRI", "2019-01-01_10_00_00.0", "I4", np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, "InvalidDicomError"),
+    # S2: an aborted run and a full run on the baseline date (no acquisition date: folder date), a T1
+    ("S2", "rsfMRI", "2020-06-01_09_00_00.0", "I5", 40, "uid5", "rsfMRI", "rsfMRI", np.nan, 40, 3.0, None),
+    ("S2", "rsfMRI", "2020-06-01_09_30_00.0", "I6", 200, "uid6", "rsfMRI", "rsfMRI", np.nan, 200, 3.0, None),
+    ("S2", "MPRAGE", "2020-06-01_09_00_00.0", "I7", 176, "uid7", "MPRAGE", "t1_mprage", "20200601", 1, 2.3, None),
+    # S3: resting state named only in the protocol, with a different TR
+    ("S3", "Axial", "2020-03-01_08_00_00.0", "I8", 300, "uid8", "Axial", "ep2d_resting", "20200301", 300, 0.8, None),
+])
+
+def test_drops_errors_and_dedupes_by_series_uid():
+    selected = select_series(INDEX)
+    assert _keys(selected) == [("S1", "I1"), ("S1", "I3"), ("S2", "I7"), ("S2", "I5"), ("S2", "I6"), ("S3", "I8")]
+
+    assert len(select_series(INDEX, dedupe=False)) == 7
+
+def test_protocol_timepoints_and_tr():
+    assert _keys(select_series(INDEX, protocol=r"rsfMRI|resting")) == [("S1", "I1"), ("S1", "I3"), ("S2", "I5"), ("S2", "I6"), ("S3", "I8")]
+    assert _keys(select_series(INDEX, protocol="mprage")) == [("S2", "I7")]
+    assert _keys(select_series(INDEX, protocol="resting", min_timepoints=100, tr=0.8)) == [("S3", "I8")]
+    assert select_series(INDEX, protocol="resting", tr=3.0).empty
+
+def test_baseline_keeps_earliest_date_then_most_timepoints():
+    selected = select_series(INDEX, protocol=r"rsfMRI|resting", baseline_only=True)
+
+    assert _keys(selected) == [("S1", "I1"), ("S2", "I6"), ("S3", "I8")]
+    assert "_date" not in selected.columns
+
+# ==========================================
+# Header prescan on small synthetic series
+# ==========================================
+
+def _write_dicom(path, series_uid, transfer_syntax=ExplicitVRLittleEndian, pixels=None, **tags):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MRImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = transfer_syntax
+
+    ds = FileDataset(str(path), {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.StudyInstanceUID = "1.2.3"
+    ds.RepetitionTime = 3000
+    for keyword, value in tags.items():
+        setattr(ds, keyword, value)
+
+    if pixels is not None:
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.PixelData = pixels.astype("<u2").tobytes()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ds.save_as(str(path), enforce_file_format=True)
+    return ds
+
+def _mosaic(folder, volumes, csa_images=None):
+    """Siemens mosaic series: an 8x8 mosaic of 4x4 tiles, 3 filled (the 4th is padding)."""
+    pixels = np.zeros((8, 8), dtype=np.uint16)
+    pixels[:4, :4], pixels[:4, 4:], pixels[4:, :4] = 1, 2, 3
+
+    series_uid = generate_uid()
+    for volume in range(volumes):
+        path = folder / f"MR{volume:04d}.dcm"
+        tags = {"ImageType": ["ORIGINAL", "PRIMARY", "M", "MOSAIC"], "AcquisitionMatrix": [4, 0, 0, 4], "SeriesDescription": "rsfMRI"}
+        ds = _write_dicom(path, series_uid, ImplicitVRLittleEndian, pixels, **tags)
+        if csa_images is not None:
+            ds.add_new((0x0019, 0x0010), "LO", "SIEMENS CSA HEADER")
+            ds.add_new((0x0019, 0x100A), "US", csa_images)
+            ds.save_as(str(path), enforce_file_format=True)
+
+def _per_slice(folder, slices, timepoints, temporal_tag=True):
+    """One file per slice (GE / Philips), ImagesInAcquisition holding the total image count."""
+    series_uid = generate_uid()
+    for t in range(timepoints):
+        for z in range(slices):
+            tags = {"ImagePositionPatient": [0.0, 0.0, 4.0 * z], "SliceLocation": 4.0 * z, "ImagesInAcquisition": slices * timepoints}
+            if temporal_tag:
+                tags["NumberOfTemporalPositions"] = timepoints
+            _write_dicom(folder / f"IM{t * slices + z:05d}.dcm", series_uid, **tags)
+
+def _header(**tags):
+    ds = pydicom.Dataset()
+    for keyword, value in tags.items():
+        setattr(ds, keyword, value)
+    return ds
+
+def test_mosaic_slices_from_csa_tag_in_implicit_vr(tmp_path):
+    folder = tmp_path / "S1" / "rsfMRI" / "2020-01-01_10_00_00.0" / "I1"
+    _mosaic(folder, volumes=5, csa_images=4)
+
+    row = prescan_series(("S1", "rsfMRI", "2020-01-01_10_00_00.0", "I1"), str(tmp_path))
+
+    # The tag wins over the tile count (a slice may be all zero)
+    assert (row["slices"], row["timepoints"], row["file_count"]) == (4, 5, 5)
+    assert row["error"] is None and row["uid_consistent"] and row["tr"] == 3.0
+
+def test_mosaic_without_csa_tag_counts_tiles(tmp_path):
+    folder = tmp_path / "I2"
+    _mosaic(folder, volumes=2)
+
+    assert series_geometry(pydicom.dcmread(str(folder / "MR0000.dcm")), sorted(str(p) for p in folder.iterdir())) == (3, 2)
+
+def test_enhanced_multiframe_splits_frames():
+    assert series_geometry(_header(NumberOfFrames=120, NumberOfTemporalPositions=4), ["f.dcm"]) == (30, 4)
+    assert series_geometry(_header(NumberOfFrames=176), ["f.dcm"]) == (176, 1)
+
+def test_per_slice_with_temporal_positions(tmp_path):
+    folder = tmp_path / "S2" / "rsfMRI" / "2020-01-01_10_00_00.0" / "I3"
+    _per_slice(folder, slices=3, timepoints=4)
+
+    row = prescan_series(("S2", "rsfMRI", "2020-01-01_10_00_00.0", "I3"), str(tmp_path))
+
+    # ImagesInAcquisition (12) is the total, not the slices
+    assert (row["slices"], row["timepoints"]) == (3, 4)
+
+def test_per_slice_without_temporal_positions_counts_positions(tmp_path):
+    folder = tmp_path / "I4"
+    _per_slice(folder, slices=3, timepoints=4, temporal_tag=False)
+    files = sorted(str(p) for p in folder.iterdir())
+
+    assert series_geometry(pydicom.dcmread(files[0], stop_before_pixels=True), files) == (3, 4)
+
+def test_prescan_tree_is_incremental(tmp_path, capsys):
+    dicom_dir = tmp_path / "dicom"
+    _mosaic(dicom_dir / "S1" / "rsfMRI" / "2020-01-01_10_00_00.0" / "I1", volumes=5, csa_images=4)
+    _per_slice(dicom_dir / "S2" / "rsfMRI" / "2020-02-01_10_00_00.0" / "I2", slices=3, timepoints=4)
+    (dicom_dir / "S3" / "rsfMRI" / "2020-03-01_10_00_00.0" / "I3").mkdir(parents=True)
+    index_path = tmp_path / "index.csv"
+
+    index = prescan_dicom_tree(str(dicom_dir), ["rsfMRI"], str(index_path), num_threads=2)
+
+    assert list(index["subject_id"]) == ["S1", "S2", "S3"]
+    assert list(index["slices"].iloc[:2]) == [4, 3] and list(index["timepoints"].iloc[:2]) == [5, 4]
+    assert index["error"].iloc[2] == "no files"
+    assert _keys(select_series(index, min_timepoints=5)) == [("S1", "I1")]
+
+    # Unchanged series keep their row; a new volume rescans its series, unreadable ones are retried
+    _mosaic(dicom_dir / "S1" / "rsfMRI" / "2020-01-01_10_00_00.0" / "I1", volumes=6, csa_images=4)
+    capsys.readouterr()
+    updated = prescan_dicom_tree(str(dicom_dir), ["rsfMRI"], str(index_path), num_threads=2)
+
+    assert "Prescan: 2 new or changed series, 1 unchanged" in capsys.readouterr().out
+    assert list(updated["timepoints"].iloc[:2]) == [6, 4]
+    assert updated["series_uid"].iloc[1] == index["series_uid"].iloc[1]
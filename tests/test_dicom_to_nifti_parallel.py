@@ -0,0 +1,37 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+
+import dicom_to_nifti_parallel
+from dicom_to_nifti_parallel import convert_dicom_to_nifti_parallel
+from manifest_utils import load_manifest
+
+def _fake_dcm2niix(out_dir, filename, dicom_path):
+    if dicom_path.endswith("I2"):
+        return ["/nonexistent/dcm2niix", "-o", out_dir, "-f", filename, dicom_path]
+    return ["sh", "-c", f"echo nifti > {os.path.join(out_dir, filename)}.nii.gz"]
+
+def test_missing_binary_fails_only_its_series(tmp_path, monkeypatch):
+    dicom_dir = tmp_path / "dicom"
+    for folder in ("I1", "I2", "I3"):
+        series_path = dicom_dir / "S1" / "rsfMRI" / "2020-01-01_10_00_00.0" / folder
+        series_path.mkdir(parents=True)
+        (series_path / "1.dcm").write_bytes(b"dicom")
+
+    monkeypatch.setattr(dicom_to_nifti_parallel, "dcm2niix_command", _fake_dcm2niix)
+    report = str(tmp_path / "failures.csv")
+    nifti_dir = str(tmp_path / "nifti")
+
+    convert_dicom_to_nifti_parallel(str(dicom_dir), nifti_dir, ["rsfMRI"], num_workers=2, retries=1, failure_report=report)
+
+    manifest = load_manifest(os.path.join(nifti_dir, "conversion_manifest.jsonl"))
+    status = {series.split(os.sep)[-1]: entry["status"] for series, entry in manifest.items()}
+    assert status == {"I1": "ok", "I2": "error", "I3": "ok"}
+    assert os.path.exists(os.path.join(nifti_dir, "S1", "rsfMRI", "2020-01-01_10_00_00.0_I3.nii.gz"))
+
+    failed = manifest[os.path.join("S1", "rsfMRI", "2020-01-01_10_00_00.0", "I2")]
+    assert failed["attempts"] == 2 and failed["message"].startswith("FileNotFoundError")
+    with open(report) as f:
+        assert [row["status"] for row in csv.DictReader(f)] == ["error"]
@@ -0,0 +1,56 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+
+from manifest_utils import series_fingerprint, output_fingerprints, load_manifest, append_manifest, series_is_converted
+
+def _converted_series(tmp_path):
+    dicom_dir = tmp_path / "dicom"
+    dicom_dir.mkdir()
+    for i in range(3):
+        (dicom_dir / f"{i}.dcm").write_bytes(b"x" * (i + 1))
+
+    nifti_dir = tmp_path / "nifti"
+    nifti_dir.mkdir()
+    (nifti_dir / "run.nii.gz").write_bytes(b"nifti")
+    (nifti_dir / "run.json").write_text("{}")
+    (nifti_dir / "other.nii.gz").write_bytes(b"other")
+
+    fingerprint = series_fingerprint(str(dicom_dir))
+    entry = {"series": "S/seq/date/I1", "status": "ok", "fingerprint": fingerprint, "outputs": output_fingerprints(str(nifti_dir), str(nifti_dir / "run"))}
+    return dicom_dir, nifti_dir, entry
+
+def test_last_line_wins_and_partial_line_is_skipped(tmp_path):
+    manifest_path = str(tmp_path / "manifest.jsonl")
+    assert load_manifest(manifest_path) == {}
+
+    append_manifest(manifest_path, {"series": "a", "status": "error"})
+    append_manifest(manifest_path, {"series": "b", "status": "ok"})
+    append_manifest(manifest_path, {"series": "a", "status": "ok"})
+    with open(manifest_path, "a") as f:
+        f.write('{"series": "b", "sta')  # interrupted write
+
+    manifest = load_manifest(manifest_path)
+    assert {series: entry["status"] for series, entry in manifest.items()} == {"a": "ok", "b": "ok"}
+    assert "recorded_at" in manifest["a"]
+
+def test_series_is_converted(tmp_path):
+    dicom_dir, nifti_dir, entry = _converted_series(tmp_path)
+    fingerprint = entry["fingerprint"]
+
+    assert sorted(entry["outputs"]) == ["run.json", "run.nii.gz"]
+    assert series_is_converted(entry, fingerprint, str(nifti_dir))
+    assert not series_is_converted(None, fingerprint, str(nifti_dir))
+    assert not series_is_converted(dict(entry, status="timeout"), fingerprint, str(nifti_dir))
+    assert not series_is_converted(dict(entry, outputs={}), fingerprint, str(nifti_dir))
+
+    # A DICOM file added to the series
+    (dicom_dir / "3.dcm").write_bytes(b"new")
+    assert not series_is_converted(entry, series_fingerprint(str(dicom_dir)), str(nifti_dir))
+
+    # An output rewritten or removed
+    (nifti_dir / "run.json").write_text('{"changed": true}')
+    assert not series_is_converted(entry, fingerprint, str(nifti_dir))
+    os.remove(nifti_dir / "run.json")
+    assert not series_is_converted(entry, fingerprint, str(nifti_dir))
@@ -0,0 +1,65 @@
+
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from masked_utils import masked_from_nifti, clean_masked, save_masked, load_masked, masked_to_nifti
+
+nilearn_image = pytest.importorskip("nilearn.image")
+
+@pytest.fixture
+def run(tmp_path):
+    rng = np.random.default_rng(0)
+    affine = np.diag([3.0, 3.0, 4.0, 1.0])
+
+    data = (1000 + 50 * rng.standard_normal((12, 14, 10, 40))).astype(np.float32)
+    mask = np.zeros((12, 14, 10), dtype=np.uint8)
+    mask[3:9, 4:11, 2:8] = 1
+
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_zooms((3.0, 3.0, 4.0, 2.0))
+    run_path, mask_path = str(tmp_path / "run.nii.gz"), str(tmp_path / "mask.nii.gz")
+    nib.save(img, run_path)
+    nib.save(nib.Nifti1Image(mask, affine), mask_path)
+    return run_path, mask_path
+
+def test_smoothing_matches_smooth_img(run):
+    run_path, mask_path = run
+
+    masked = masked_from_nifti(run_path, mask_path, fwhm=6)
+    expected = nilearn_image.smooth_img(run_path, fwhm=6).get_fdata()[nib.load(mask_path).get_fdata() > 0].T
+
+    assert masked["data"].dtype == np.float32
+    assert masked["data"].shape == (40, 6 * 7 * 6)
+    assert masked["tr"] == 2.0
+    np.testing.assert_allclose(masked["data"], expected, rtol=1e-5)
+
+def test_clean_matches_clean_img(run):
+    run_path, mask_path = run
+    params = {"detrend": True, "standardize": "zscore_sample", "low_pass": 0.1, "high_pass": 0.01}
+
+    cleaned = clean_masked(masked_from_nifti(run_path, mask_path), **params)
+    expected = nilearn_image.clean_img(run_path, t_r=2.0, mask_img=mask_path, **params).get_fdata()[nib.load(mask_path).get_fdata() > 0].T
+
+    np.testing.assert_allclose(cleaned["data"], expected, atol=1e-4)
+
+def test_save_load_and_expand(run, tmp_path):
+    run_path, mask_path = run
+    masked = masked_from_nifti(run_path, mask_path)
+
+    path = str(tmp_path / "run_masked.npz")
+    save_masked(path, masked)
+    loaded = load_masked(path)
+
+    np.testing.assert_array_equal(loaded["data"], masked["data"])
+    np.testing.assert_array_equal(loaded["mask"], masked["mask"])
+    assert loaded["tr"] == masked["tr"]
+
+    img = masked_to_nifti(loaded)
+    original = nib.load(run_path).get_fdata()
+    inside = nib.load(mask_path).get_fdata() > 0
+    np.testing.assert_allclose(img.get_fdata()[inside], original[inside], rtol=1e-6)
+    assert not img.get_fdata()[~inside].any()
+    assert img.header.get_zooms()[3] == 2.0
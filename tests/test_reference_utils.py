@@ -0,0 +1,88 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+import reference_utils
+from reference_utils import get_template_data, get_template, get_atlas_on_grid, get_aal_labels, get_atlas_index, preload_references
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(reference_utils, "_CACHE", {})
+
+@pytest.fixture
+def references(tmp_path):
+    template = np.random.default_rng(0).random((20, 24, 18)).astype(np.float32)
+    template_path = str(tmp_path / "template.nii.gz")
+    # MNI-like: x flipped, origin away from the corner
+    affine = np.array([[-2.0, 0, 0, 20], [0, 2.0, 0, -24], [0, 0, 2.0, -18], [0, 0, 0, 1]])
+    nib.save(nib.Nifti1Image(template, affine), template_path)
+
+    atlas = np.zeros((10, 12, 9), dtype=np.int16)
+    atlas[2:5, 3:8, 2:6] = 2001
+    atlas[5:9, 3:8, 2:6] = 2002
+    atlas_path = str(tmp_path / "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(atlas, np.array([[-4.0, 0, 0, 21], [0, 4.0, 0, -23], [0, 0, 4.0, -17], [0, 0, 0, 1]])), atlas_path)
+
+    label_path = str(tmp_path / "labels.txt")
+    with open(label_path, "w") as f:
+        f.write("PreCG.L\tPrecentral_L\t2001\nPreCG.R\tPrecentral_R\t2002\n")
+
+    return template_path, atlas_path, label_path
+
+def test_template_data_is_cached_and_memory_mapped(references, tmp_path):
+    template_path, _, _ = references
+    cache_dir = str(tmp_path / "cache")
+
+    data, img = get_template_data(template_path, cache_dir)
+
+    assert isinstance(data, np.memmap) and not data.flags.writeable
+    np.testing.assert_array_equal(data, nib.load(template_path).get_fdata(dtype=np.float32))
+    assert get_template_data(template_path, cache_dir)[0] is data
+    assert len(os.listdir(cache_dir)) == 1
+
+def test_changed_source_is_reloaded(references, tmp_path):
+    template_path, _, _ = references
+    cache_dir = str(tmp_path / "cache")
+    get_template_data(template_path, cache_dir)
+
+    nib.save(nib.Nifti1Image(np.ones((20, 24, 18), dtype=np.float32), nib.load(template_path).affine), template_path)
+    stat = os.stat(template_path)
+    os.utime(template_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    assert (get_template_data(template_path, cache_dir)[0] == 1).all()
+
+def test_atlas_on_template_grid(references, tmp_path):
+    template_path, atlas_path, label_path = references
+    cache_dir = str(tmp_path / "cache")
+
+    preload_references(template_path, atlas_path=atlas_path, atlas_label_path=label_path, cache_dir=cache_dir)
+    atlas = get_atlas_on_grid(atlas_path, template_path, cache_dir)
+
+    assert atlas.shape == (20, 24, 18)
+    assert set(np.unique(atlas)) == {0, 2001, 2002}
+    # Nearest neighbour: each 4 mm atlas voxel covers 2 x 2 x 2 template voxels
+    assert np.count_nonzero(atlas == 2001) == 8 * 3 * 5 * 4
+    assert get_aal_labels(label_path) == {2001: "Precentral_L", 2002: "Precentral_R"}
+
+    # The preloaded index is of the atlas on the template grid
+    atlas_index = get_atlas_index(atlas_path, label_path, template_path, cache_dir)
+    assert atlas_index["labels"].shape == (20, 24, 18)
+    assert atlas_index["names"] == ["Precentral_L", "Precentral_R"]
+    assert get_atlas_index(atlas_path, label_path, template_path, cache_dir) is atlas_index
+    assert get_atlas_index(atlas_path, label_path)["labels"].shape == (10, 12, 9)
+
+def test_ants_template_matches_image_read(references, tmp_path):
+    ants = pytest.importorskip("ants")
+    template_path, _, _ = references
+
+    template = get_template(template_path, str(tmp_path / "cache"))
+    expected = ants.image_read(template_path)
+
+    np.testing.assert_array_equal(template.numpy(), expected.numpy())
+    np.testing.assert_allclose(template.origin, expected.origin)
+    np.testing.assert_allclose(template.spacing, expected.spacing)
+    np.testing.assert_allclose(template.direction, expected.direction)
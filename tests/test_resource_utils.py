@@ -0,0 +1,46 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+
+from resource_utils import available_cores, available_memory, plan_resources, step_threads, thread_limits, THREAD_ENV_VARS
+
+def test_slurm_allocation_wins(monkeypatch):
+    monkeypatch.setenv("SLURM_CPUS_PER_TASK", "7")
+    monkeypatch.setenv("SLURM_MEM_PER_NODE", "2048")
+
+    assert available_cores() == 7
+    assert available_memory() == 2048 * 1024 * 1024
+
+def test_without_slurm(monkeypatch):
+    monkeypatch.delenv("SLURM_CPUS_PER_TASK", raising=False)
+    # --mem=0: the whole node
+    monkeypatch.setenv("SLURM_MEM_PER_NODE", "0")
+
+    assert available_cores() == len(os.sched_getaffinity(0))
+    assert available_memory() > 0
+
+def test_plan_resources_fits_the_cores():
+    assert plan_resources(total_cores=32) == (32, 1)
+    assert plan_resources(threads_per_worker=4, total_cores=34) == (8, 4)
+    assert plan_resources(num_workers=5, total_cores=34) == (5, 6)
+    assert plan_resources(num_workers=64, total_cores=8) == (8, 1)
+    assert plan_resources(threads_per_worker=64, total_cores=8) == (1, 8)
+    # Both given: kept if they fit, otherwise the threads are cut
+    assert plan_resources(num_workers=4, threads_per_worker=2, total_cores=8) == (4, 2)
+    assert plan_resources(num_workers=4, threads_per_worker=4, total_cores=8) == (4, 2)
+    assert plan_resources(num_workers=16, threads_per_worker=2, total_cores=8) == (8, 1)
+
+def test_step_threads():
+    assert step_threads("registration", 6) == 6
+    assert step_threads("bet", 6) == 1
+
+def test_thread_limits_restores_environment(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "8")
+    monkeypatch.delenv("MKL_NUM_THREADS", raising=False)
+
+    with thread_limits(1):
+        assert all(os.environ[var] == "1" for var in THREAD_ENV_VARS)
+
+    assert os.environ["OMP_NUM_THREADS"] == "8"
+    assert "MKL_NUM_THREADS" not in os.environ
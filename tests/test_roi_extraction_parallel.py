@@ -0,0 +1,131 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import reference_utils
+from masked_utils import save_masked
+from roi_extraction_parallel import extract_roi_cohort_parallel, load_roi_store
+
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+SHAPE = (6, 5, 4)
+ROIS = {2001: "Precentral_L", 2002: "Precentral_R"}
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch, tmp_path):
+    # Set before the tasks fork, so they inherit it
+    monkeypatch.setattr(reference_utils, "_CACHE", {})
+    monkeypatch.setattr(reference_utils, "REFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+
+@pytest.fixture
+def atlas(tmp_path):
+    labels = np.zeros(SHAPE, dtype=np.int16)
+    labels[:3] = 2001
+    labels[3:, :, 1:] = 2002
+    atlas_path = str(tmp_path / "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(labels, AFFINE), atlas_path)
+
+    label_path = str(tmp_path / "labels.txt")
+    with open(label_path, "w") as f:
+        f.write("PreCG.L\tPrecentral_L\t2001\nPreCG.R\tPrecentral_R\t2002\n")
+
+    return labels, atlas_path, label_path
+
+def _run(seed, timepoints=8):
+    return np.random.default_rng(seed).standard_normal(SHAPE + (timepoints,)).astype(np.float32)
+
+def _roi_means(labels, data):
+    return pd.DataFrame({name: data[labels == label].mean(axis=0) for label, name in ROIS.items()})
+
+def _output_dir(base_dir, subject_id, file_id):
+    output_dir = os.path.join(base_dir, subject_id, "fMRI", "preprocessed", file_id)
+    os.makedirs(output_dir)
+    return output_dir
+
+def _write_nifti(output_dir, file_id, data):
+    nib.save(nib.Nifti1Image(data, AFFINE), os.path.join(output_dir, f"bandpass_filtered_{file_id}.nii.gz"))
+    nib.save(nib.Nifti1Image(np.ones(SHAPE, dtype=np.uint8), AFFINE), os.path.join(output_dir, f"brain_mean_{file_id}_mask_mni.nii.gz"))
+
+def _write_masked(output_dir, file_id, data):
+    mask = np.ones(SHAPE, dtype=bool)
+    save_masked(os.path.join(output_dir, f"bandpass_filtered_{file_id}_masked.npz"), {"data": data[mask].T, "mask": mask, "affine": AFFINE, "tr": 2.0})
+
+def _cohort(base_dir, labels):
+    """Four runs: TSV over NIfTI, NIfTI over masked, masked only, and one not preprocessed yet."""
+    expected = {}
+
+    file_id = "2020-01-01_10_00_00.0_I1"
+    output_dir = _output_dir(base_dir, "S1", file_id)
+    tsv = _roi_means(labels, _run(1))
+    tsv.to_csv(os.path.join(output_dir, f"roi_AAL_timeseries_{file_id}.tsv"), sep="\t", index=False)
+    _write_nifti(output_dir, file_id, _run(2))
+    expected["I1"] = tsv
+
+    file_id = "2020-02-02_10_00_00.0_I2"
+    output_dir = _output_dir(base_dir, "S2", file_id)
+    _write_nifti(output_dir, file_id, _run(3))
+    _write_masked(output_dir, file_id, _run(4))
+    expected["I2"] = _roi_means(labels, _run(3))
+
+    file_id = "2020-03-03_10_00_00.0_I3"
+    _write_masked(_output_dir(base_dir, "S3", file_id), file_id, _run(5, timepoints=6))
+    expected["I3"] = _roi_means(labels, _run(5, timepoints=6))
+
+    _output_dir(base_dir, "S4", "2020-04-04_10_00_00.0_I4")
+    return expected
+
+def _extract(tmp_path, atlas):
+    _, atlas_path, label_path = atlas
+    extract_roi_cohort_parallel(str(tmp_path / "nifti"), "fMRI", str(tmp_path / "store"), "fmri", num_workers=2, atlas_path=atlas_path, atlas_label_path=label_path, failure_report=str(tmp_path / "failures.csv"))
+
+def _part_mtimes(part_dir):
+    return {name: os.stat(os.path.join(part_dir, name)).st_mtime_ns for name in os.listdir(part_dir)}
+
+def test_parts_from_the_best_source(tmp_path, atlas):
+    expected = _cohort(str(tmp_path / "nifti"), atlas[0])
+
+    _extract(tmp_path, atlas)
+
+    part_dir = str(tmp_path / "store" / "fmri_roi_timeseries")
+    assert sorted(os.listdir(part_dir)) == ["S1_I1.parquet", "S2_I2.parquet", "S3_I3.parquet"]
+
+    store = load_roi_store(str(tmp_path / "store"), "fmri")
+    assert list(store.columns) == ["PTID", "scan_date", "image_id", "space", "timepoint", "Precentral_L", "Precentral_R"]
+    for (ptid, scan_date, image_id), part in store.groupby(["PTID", "scan_date", "image_id"]):
+        assert (ptid, scan_date) == ({"I1": "S1", "I2": "S2", "I3": "S3"}[image_id], f"2020-0{image_id[1]}-0{image_id[1]}")
+        assert (part["space"] == "MNI").all()
+        part = part.sort_values("timepoint")
+        np.testing.assert_array_equal(part["timepoint"], np.arange(len(expected[image_id])))
+        np.testing.assert_allclose(part[list(ROIS.values())].to_numpy(), expected[image_id].to_numpy(), atol=1e-5)
+
+def test_second_run_only_rewrites_new_or_changed_images(tmp_path, atlas):
+    labels = atlas[0]
+    _cohort(str(tmp_path / "nifti"), labels)
+    _extract(tmp_path, atlas)
+
+    part_dir = str(tmp_path / "store" / "fmri_roi_timeseries")
+    first = _part_mtimes(part_dir)
+
+    _extract(tmp_path, atlas)
+    assert _part_mtimes(part_dir) == first
+
+    # S4 gets its TSV, S1's TSV changes: only those two parts are written
+    file_id = "2020-04-04_10_00_00.0_I4"
+    output_dir = os.path.join(str(tmp_path / "nifti"), "S4", "fMRI", "preprocessed", file_id)
+    _roi_means(labels, _run(6)).to_csv(os.path.join(output_dir, f"roi_AAL_timeseries_{file_id}.tsv"), sep="\t", index=False)
+    changed = _roi_means(labels, _run(7))
+    changed.to_csv(str(tmp_path / "nifti" / "S1" / "fMRI" / "preprocessed" / "2020-01-01_10_00_00.0_I1" / "roi_AAL_timeseries_2020-01-01_10_00_00.0_I1.tsv"), sep="\t", index=False)
+
+    _extract(tmp_path, atlas)
+    third = _part_mtimes(part_dir)
+
+    assert sorted(third) == ["S1_I1.parquet", "S2_I2.parquet", "S3_I3.parquet", "S4_I4.parquet"]
+    assert [name for name in sorted(third) if third[name] != first.get(name)] == ["S1_I1.parquet", "S4_I4.parquet"]
+    part = pd.read_parquet(os.path.join(part_dir, "S1_I1.parquet"))
+    np.testing.assert_allclose(part[list(ROIS.values())].to_numpy(), changed.to_numpy(), atol=1e-6)
@@ -0,0 +1,203 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import subprocess
+import multiprocessing
+import numpy as np
+import nibabel as nib
+
+from scheduling_utils import run_tasks, start_task_stream, stream_task, finish_task_stream, stop_task_stream, estimate_fmri_memory, load_memory_calibration
+
+# Task bodies (module level: run in forked processes)
+
+def _succeed(value):
+    return value * 2
+
+def _fail_first_attempt(marker_path):
+    if not os.path.exists(marker_path):
+        open(marker_path, "w").close()
+        raise RuntimeError("first attempt")
+    return "second attempt"
+
+def _raise():
+    raise ValueError("bad input")
+
+def _crash():
+    os._exit(3)
+
+def _sleep_with_subprocess(pid_path):
+    # A child (like dcm2niix/FSL) that must die with its task
+    child = subprocess.Popen(["sleep", "60"])
+    with open(pid_path, "w") as f:
+        f.write(str(child.pid))
+    time.sleep(60)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A killed but unreaped child is a zombie
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().split(")")[-1].split()[0] != "Z"
+
+def _wait_for(path, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not (os.path.exists(path) and os.path.getsize(path)):
+        assert time.monotonic() < deadline, f"{path} not written"
+        time.sleep(0.05)
+    with open(path) as f:
+        return int(f.read())
+
+def test_results_in_parent():
+    results = []
+    failures = run_tasks(_succeed, [{"args": (i,), "name": str(i)} for i in range(5)], num_workers=3, on_result=lambda task, status, result: results.append((task["name"], status, result)))
+
+    assert failures == []
+    assert sorted(results) == [(str(i), "ok", 2 * i) for i in range(5)]
+
+def test_retry_after_failure(tmp_path):
+    results = []
+    failures = run_tasks(_fail_first_attempt, [{"args": (str(tmp_path / "marker"),), "name": "flaky"}], num_workers=1, retries=1, on_result=lambda task, status, result: results.append((status, result)))
+
+    assert failures == []
+    assert results == [("ok", "second attempt")]
+
+def test_error_and_crash_fail_only_their_task(tmp_path):
+    report = str(tmp_path / "failures.csv")
+    tasks = [{"args": (), "name": "error"}, {"args": (), "name": "crash"}]
+
+    failures = run_tasks(_raise, tasks[:1], num_workers=2, retries=2, failure_report=report) + run_tasks(_crash, tasks[1:], num_workers=2)
+
+    assert [(f["task"], f["status"], f["attempts"]) for f in failures] == [("error", "error", 3), ("crash", "crashed", 1)]
+    assert "ValueError: bad input" in failures[0]["message"]
+    assert "Exit code 3" in failures[1]["message"]
+    assert os.path.exists(report)
+
+def test_timeout_kills_task_subprocesses(tmp_path):
+    pid_path = str(tmp_path / "child.pid")
+
+    start = time.monotonic()
+    failures = run_tasks(_sleep_with_subprocess, [{"args": (pid_path,), "name": "slow"}], num_workers=1, timeout=1)
+
+    assert time.monotonic() - start < 30
+    assert [(f["task"], f["status"]) for f in failures] == [("slow", "timeout")]
+    assert not _pid_alive(_wait_for(pid_path))
+
+def _run_slow_tasks(pid_path):
+    run_tasks(_sleep_with_subprocess, [{"args": (pid_path,)}], num_workers=1)
+
+def test_sigterm_kills_running_tasks(tmp_path):
+    pid_path = str(tmp_path / "child.pid")
+
+    runner = multiprocessing.Process(target=_run_slow_tasks, args=(pid_path,))
+    runner.start()
+    child_pid = _wait_for(pid_path)
+
+    os.kill(runner.pid, signal.SIGTERM)
+    runner.join(timeout=10)
+
+    assert runner.exitcode == 128 + signal.SIGTERM
+    deadline = time.monotonic() + 5
+    while _pid_alive(child_pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _pid_alive(child_pid)
+
+def _write_value(path, value):
+    if value < 0:
+        raise ValueError(f"negative value {value}")
+    with open(path, "w") as f:
+        f.write(str(value))
+
+def _cpu_ticks(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().split(")")[-1].split()
+    return int(fields[11]) + int(fields[12])
+
+def test_task_stream_runs_tasks_as_they_arrive(tmp_path):
+    stream = start_task_stream(_write_value, num_workers=2)
+    try:
+        # Idle until the first task arrives: blocked, not polling
+        time.sleep(0.2)
+        ticks = _cpu_ticks(stream["process"].pid)
+        time.sleep(1)
+        assert _cpu_ticks(stream["process"].pid) - ticks <= 2
+
+        stream_task(stream, {"args": (str(tmp_path / "0"), 0), "name": "0"})
+        assert _wait_for(str(tmp_path / "0")) == 0
+
+        for i in range(1, 4):
+            stream_task(stream, {"args": (str(tmp_path / str(i)), i), "name": str(i)})
+        stream_task(stream, {"args": (str(tmp_path / "bad"), -1), "name": "bad"})
+
+        failures = finish_task_stream(stream)
+    finally:
+        stop_task_stream(stream)
+
+    assert stream["submitted"] == 5
+    assert [(f["task"], f["status"]) for f in failures] == [("bad", "error")]
+    assert [_wait_for(str(tmp_path / str(i))) for i in range(4)] == [0, 1, 2, 3]
+
+def test_stopping_a_task_stream_kills_its_tasks(tmp_path):
+    pid_path = str(tmp_path / "child.pid")
+
+    stream = start_task_stream(_sleep_with_subprocess, num_workers=1)
+    try:
+        stream_task(stream, {"args": (pid_path,)})
+        child_pid = _wait_for(pid_path)
+    finally:
+        stop_task_stream(stream)
+
+    assert stream["process"].exitcode == 128 + signal.SIGTERM
+    deadline = time.monotonic() + 5
+    while _pid_alive(child_pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _pid_alive(child_pid)
+
+def _write_history(path, rows, header="task,kind,estimate,peak_rss"):
+    with open(path, "w") as f:
+        f.write(header + "\n")
+        for row in rows:
+            f.write(",".join(str(v) for v in row) + "\n")
+
+def test_calibration_per_kind_from_recent_rows(tmp_path):
+    history = str(tmp_path / "history.csv")
+    assert load_memory_calibration(history) == 1.0
+
+    # An old outlier of "nifti", then 100 recent runs at ratio 1.5; "fused" runs at 0.5
+    rows = [("old", "nifti", 100, 1000)] + [(f"n{i}", "nifti", 100, 150) for i in range(100)] + [(f"f{i}", "fused", 100, 50) for i in range(10)]
+    _write_history(history, rows)
+
+    assert np.isclose(load_memory_calibration(history, kind="nifti", recent=100, margin=1.0), 1.5)
+    assert np.isclose(load_memory_calibration(history, kind="fused", margin=1.0), 0.5)
+    assert load_memory_calibration(history, kind="nifti", recent=1000, quantile=1.0, margin=1.0) == 10.0
+    assert load_memory_calibration(history, kind="native") == 1.0
+
+def test_memory_history_records_kind(tmp_path):
+    history = str(tmp_path / "history.csv")
+    _write_history(history, [("old", 100, 150)], header="task,estimate,peak_rss")
+
+    tasks = [{"args": (1,), "name": "a", "memory": 10**9, "memory_estimate": 10**9, "memory_kind": "fused"}]
+    run_tasks(_succeed, tasks, num_workers=1, memory_budget=2 * 10**9, memory_history=history)
+
+    # The history without a kind column is set aside
+    assert os.path.exists(f"{history}.old")
+    with open(history) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "task,kind,estimate,peak_rss"
+    assert lines[1].startswith(f"a,fused,{10**9},")
+    assert load_memory_calibration(history, kind="fused", margin=1.0) > 0
+
+def test_fmri_memory_by_output_format(tmp_path):
+    path = str(tmp_path / "run.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros((64, 64, 36, 200), dtype=np.int16), np.eye(4)), path)
+
+    estimates = {fmt: estimate_fmri_memory(path, output_format=fmt) for fmt in ("nifti", "masked", "fused", "native")}
+
+    assert estimates["nifti"] > estimates["fused"] == estimates["masked"] > estimates["native"]
+    assert estimate_fmri_memory(path, output_format="fused", write_voxelwise=True) > estimates["fused"]
+    # Native space only: the raw run plus two float32 copies
+    assert estimates["native"] == 64 * 64 * 36 * 200 * (2 + 8) + 512 * 1024 * 1024
@@ -0,0 +1,44 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+ants = pytest.importorskip("ants")
+pytest.importorskip("nipype")
+
+from transform_utils import registration_prefix, save_transforms, transform_files, load_transform_index, reapply_transforms
+
+def _blob(path, center):
+    grid = np.indices((24, 24, 24)).astype(np.float32)
+    data = np.exp(-sum((g - c) ** 2 for g, c in zip(grid, center)) / 20.0) * 100
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.diag([2.0, 2.0, 2.0, 1.0])), path)
+    return path
+
+def test_registration_kept_under_entry_names(tmp_path):
+    # An output directory ending in digits, like the temp prefixes that used to leak into the names
+    output_dir = str(tmp_path / "sub50")
+    os.makedirs(output_dir)
+    fixed = _blob(str(tmp_path / "fixed.nii.gz"), (12, 12, 12))
+    moving = _blob(os.path.join(output_dir, "moving.nii.gz"), (10, 13, 12))
+
+    reg = ants.registration(fixed=ants.image_read(fixed), moving=ants.image_read(moving), type_of_transform="Affine", outprefix=registration_prefix(output_dir, "mni"))
+    save_transforms(output_dir, "mni", reg, fixed=fixed, moving=moving)
+
+    entry = load_transform_index(output_dir)["mni"]
+    assert entry["fwdtransforms"] == entry["invtransforms"] == ["mni_0GenericAffine.mat"]
+    assert sorted(os.listdir(os.path.join(output_dir, "transforms"))) == ["mni_0GenericAffine.mat", "transforms.json"]
+    assert transform_files(output_dir, "mni")[1:] == [os.path.join(output_dir, "transforms", "mni_0GenericAffine.mat")]
+
+    # The fixed image back in the moving space, through the stored inverse
+    out_path = str(tmp_path / "fixed_native.nii.gz")
+    reapply_transforms(output_dir, "mni", [(fixed, "linear")], [out_path], inverse=True)
+    assert nib.load(out_path).shape == (24, 24, 24)
+
+def test_transforms_from_another_prefix_are_rejected(tmp_path):
+    reg = {"fwdtransforms": ["/tmp/tmpab1250GenericAffine.mat"], "invtransforms": ["/tmp/tmpab1250GenericAffine.mat"]}
+
+    with pytest.raises(ValueError):
+        save_transforms(str(tmp_path), "mni", reg, fixed=str(tmp_path / "fixed.nii.gz"), moving=str(tmp_path / "moving.nii.gz"))